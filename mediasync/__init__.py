@@ -4,9 +4,15 @@ sync() in directing the syncing of local media assets to the remote source.
 """
 import os
 import cStringIO
+import hashlib
 import mimetypes
-from mediasync.msettings import CSS_PATH, JS_PATH, JS_MIMETYPES, CSS_MIMETYPES, TYPES_TO_COMPRESS, JOINED
-from mediasync import backends
+import sys
+import time
+from mediasync.msettings import CSS_PATH, JS_PATH, JS_MIMETYPES, CSS_MIMETYPES, TYPES_TO_COMPRESS, JOINED, SYNC_WORKERS, SYNC_PROCESS_WORKERS, SYNC_FAILURE_BUDGET, MANIFEST, CHECKPOINT, CHECKPOINT_INTERVAL, JOURNAL, STREAM_THRESHOLD, FINGERPRINT, STATE_DIR, PROCESSOR_CACHE, COMPRESSION_CACHE
+from mediasync import assets, backends, bundles, fingerprints, journal, pool, retry, signals, stats
+from mediasync.manifest import Manifest, manifest_target
+from mediasync.plan import SyncPlan
+from mediasync.stats import SyncStats
 
 class SyncException(Exception):
     pass
@@ -23,6 +29,35 @@ def is_syncable_file(file_str):
     """
     return not file_str.startswith('.') and not file_str.startswith('_')
 
+def is_syncable_path(path):
+    """
+    Returns True if the given path, relative to the media root, is one that
+    sync() would pick up when walking the tree.
+    """
+    parts = path.strip('/').split('/')
+    if len(parts) < 2:
+        # Only files in directories under the media root are synced.
+        return False
+    for dirname in parts[:-1]:
+        if not is_syncable_dir(dirname):
+            return False
+    return is_syncable_file(parts[-1])
+
+def is_state_path(filepath):
+    """
+    Returns True if filepath is in (or is) the directory sync() keeps its
+    state in, or one of the processor and compression caches. These are
+    never synced, even if they live under the media root.
+    """
+    filepath = os.path.abspath(filepath)
+    for dirname in (STATE_DIR, PROCESSOR_CACHE, COMPRESSION_CACHE):
+        if not dirname:
+            continue
+        dirname = os.path.abspath(dirname)
+        if filepath == dirname or filepath.startswith(dirname + os.sep):
+            return True
+    return False
+
 def listdir_recursive(dir_str):
     """
     Recursively walk through the directories under the media root. Yields
@@ -31,13 +66,12 @@ def listdir_recursive(dir_str):
     for root, dirs, files in os.walk(dir_str):
         # Go through and yank any directories that don't pass our syncable
         # dir test. This needs to be done in place so that walk() will avoid.
-        for dir_candidate in dirs:
-            if not is_syncable_dir(dir_candidate):
-                dirs.remove(dir_candidate)
+        # Sorted so that files are always synced in the same order.
+        dirs[:] = sorted(d for d in dirs if is_syncable_dir(d))
 
         basename = os.path.basename(root)
         if is_syncable_dir(basename):
-            for file in files:
+            for file in sorted(files):
                 fname = os.path.join(root, file).replace(dir_str, '', 1)
                 if fname.startswith('/'):
                     fname = fname[1:]
@@ -46,6 +80,21 @@ def listdir_recursive(dir_str):
             # "Skipping directory %s" % root
             pass
 
+def joined_dirname(joinfile):
+    """
+    Returns the directory (CSS_PATH or JS_PATH) a combo file and its source
+    files live in, or None if the file can not be combo'd.
+    """
+    joinfile = joinfile.strip('/')
+
+    if joinfile.endswith('.css'):
+        return CSS_PATH.strip('/')
+    elif joinfile.endswith('.js'):
+        return JS_PATH.strip('/')
+    else:
+        # We only join CSS and JS.
+        return None
+
 def combine_files(joinfile, sourcefiles, client):
     """
     Given a combo file name (joinfile), combine the sourcefiles into a single
@@ -54,13 +103,8 @@ def combine_files(joinfile, sourcefiles, client):
     Returns a tuple containing a string with the combo file contents and
     the CSS or JS dirname, or None if the specified file can not be combo'd.
     """
-    joinfile = joinfile.strip('/')
-
-    if joinfile.endswith('.css'):
-        dirname = CSS_PATH.strip('/')
-    elif joinfile.endswith('.js'):
-        dirname = JS_PATH.strip('/')
-    else:
+    dirname = joined_dirname(joinfile)
+    if dirname is None:
         # By-pass this file since we only join CSS and JS.
         return None
 
@@ -78,66 +122,494 @@ def combine_files(joinfile, sourcefiles, client):
     buffer.close()
     return (filedata, dirname)
 
-def sync(client=None, force=False):
-    """ 
-    Let's face it... pushing this stuff to S3 is messy. A lot of different 
-    things need to be calculated for each file and they have to be in a certain 
-    order as some variables rely on others.
+class SyncItem(object):
     """
-    # create client connection
-    if client is None:
-        client = backends.client()
+    A single file that sync() will push to the backend. This is either a
+    static file somewhere under the media root, or a combo file generated
+    from the JOINED setting.
+    """
+    def __init__(self, remote_path, content_type, filepath=None,
+                 joinfile=None, sourcefiles=None):
+        self.remote_path = remote_path
+        self.content_type = content_type
+        self.filepath = filepath
+        self.joinfile = joinfile
+        self.sourcefiles = sourcefiles
+        self.state = None
 
-    client.open()
-    client.serve_remote = True
+    def sourcepaths(self):
+        """
+        Returns the paths, relative to the media root, of a joined file's
+        source files.
+        """
+        return bundles.get_index().sources_for(self.joinfile)
+
+    def stat(self):
+        """
+        Returns a (size, mtime) tuple for static files, or (None, None) for
+        joined files.
+        """
+        if self.filepath is None:
+            return (None, None)
+        st = os.stat(self.filepath)
+        # What the change journal will record for this file.
+        self.state = journal.file_state(st)
+        return (st.st_size, st.st_mtime)
+
+    def is_streamed(self, size):
+        """
+        Returns True if the file is too big to be read into memory and should
+        be streamed to the backend unprocessed.
+        """
+        return self.filepath is not None and size > STREAM_THRESHOLD
+
+    def checksum(self):
+        """
+        Returns the MD5 hexdigest of the raw file, read in chunks.
+        """
+        return backends.file_checksum(self.filepath)
+
+    def read(self, client):
+        """
+        Returns the raw (unprocessed) contents of the file.
+        """
+        if self.joinfile is not None:
+            return combine_files(self.joinfile, self.sourcefiles, client)[0]
+        f = open(self.filepath, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+def static_files(media_root):
+    """
+    Yields a (remote_path, filepath) tuple for every static file under the
+    media root that should be synced, in a stable order.
+    """
+    for dirname in sorted(os.listdir(media_root)):
+
+        dirpath = os.path.abspath(os.path.join(media_root, dirname))
+
+        if not is_syncable_dir(dirname) or is_state_path(dirpath):
+            continue # hidden directory, or sync()'s own state
+
+        if os.path.isdir(dirpath):
+
+            for filename in listdir_recursive(dirpath):
+
+                # calculate local and remote paths
+                filepath = os.path.join(dirpath, filename)
+                remote_path = "%s/%s" % (dirname, filename)
+
+                if not is_syncable_file(os.path.basename(filename)) or not os.path.isfile(filepath):
+                    continue # hidden file or directory, do not upload
+
+                if is_state_path(filepath):
+                    continue # a cache kept under the media root
 
+                yield (remote_path, filepath)
+
+def sync_items(client, paths=None):
+    """
+    Yields a SyncItem for every joined and static file that should be synced,
+    in a stable order. If paths is given, only the static files with those
+    paths (relative to the media root) are looked at, and the tree isn't
+    walked at all.
+    """
     #
-    # sync joined media
+    # joined media
     #
 
-    for joinfile, sourcefiles in JOINED.iteritems():
-        filedata = combine_files(joinfile, sourcefiles, client)
-        if filedata is None:
+    for joinfile in sorted(JOINED.keys()):
+        joinpath = joinfile.strip('/')
+
+        dirname = joined_dirname(joinpath)
+        if dirname is None:
             # combine_files() is only interested in CSS/JS files.
             continue
-        filedata, dirname = filedata
 
-        content_type = mimetypes.guess_type(joinfile)[0] or 'application/octet-stream'
+        content_type = mimetypes.guess_type(joinpath)[0] or 'application/octet-stream'
 
-        remote_path = joinfile
+        remote_path = joinpath
         if dirname:
             remote_path = "%s/%s" % (dirname, remote_path)
 
-        if client.process_and_put(filedata, content_type, remote_path, force=force):
-            print "[%s] %s" % (content_type, remote_path)
+        yield SyncItem(remote_path, content_type, joinfile=joinfile,
+                       sourcefiles=JOINED[joinfile])
 
     #
-    # sync static media
+    # static media
     #
 
-    for dirname in os.listdir(client.media_root):
+    if paths is None:
+        files = static_files(client.media_root)
+    else:
+        files = ((path, os.path.join(client.media_root, path))
+                 for path in sorted(paths)
+                 if is_syncable_path(path)
+                 and not is_state_path(os.path.join(client.media_root, path)))
 
-        dirpath = os.path.abspath(os.path.join(client.media_root, dirname))
+    for remote_path, filepath in files:
+        if paths is not None and not os.path.isfile(filepath):
+            # Deleted since.
+            continue
+        content_type = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+        yield SyncItem(remote_path, content_type, filepath=filepath)
 
-        if os.path.isdir(dirpath):
+def sync(client=None, force=False, workers=None, verify=False, process_workers=None,
+         dry_run=False, incremental=False, since=None, paths=None, opened=False,
+         resume=False, sync_stats=None):
+    """ 
+    Let's face it... pushing this stuff to S3 is messy. A lot of different 
+    things need to be calculated for each file and they have to be in a certain 
+    order as some variables rely on others.
 
-            for filename in listdir_recursive(dirpath):
+    args:
+      client: (BaseClient) The backend client to sync with. Defaults to the
+                           client for the configured BACKEND.
+      force: (bool) If True, push every file even if it hasn't changed.
+      workers: (int) Number of files to read, process and upload at once.
+                     Defaults to MEDIASYNC['SYNC_WORKERS']. Each worker gets
+                     its own backend connection.
+      verify: (bool) If True, don't trust the local manifest and let the
+                     backend check each file against remote storage.
+      process_workers: (int) Number of processes to run processors in.
+                             Defaults to MEDIASYNC['SYNC_PROCESS_WORKERS'].
+      dry_run: (bool) If True, work out what would be uploaded without
+                      writing anything, remotely or locally, and return it
+                      as a SyncPlan.
+      incremental: (bool) If True, only look at files that changed since the
+                          last sync according to the change journal, instead
+                          of reading every file.
+      since: (str) A git revision. Implies incremental, and only looks at the
+                   files git says changed since then, so the media tree isn't
+                   even walked.
+      paths: (list) Paths, relative to the media root, of files known to have
+                    changed. Like since, but the caller provides the list.
+      opened: (bool) If True, the client has already been opened, and the
+                     caller will close it. Used to keep a connection open
+                     between syncs.
+      resume: (bool) If True, trust the checkpoint left by a sync that
+                     failed, and skip the files it had already uploaded.
+      sync_stats: (SyncStats) Collects counters and per-phase timings of the
+                              sync. It's also sent with the pre_sync and
+                              post_sync signals.
+    """
+    # create client connection
+    if client is None:
+        client = backends.client()
+    if sync_stats is None:
+        sync_stats = SyncStats()
 
-                # calculate local and remote paths
-                filepath = os.path.join(dirpath, filename)
-                remote_path = "%s/%s" % (dirname, filename)
+    signals.pre_sync.send(sender=client, stats=sync_stats)
+    stats.collect(sync_stats)
+    success = False
+    try:
+        result = _sync(client, force, workers, verify, process_workers, dry_run,
+                       incremental, since, paths, opened, resume)
+        success = True
+        return result
+    finally:
+        stats.collect(None)
+        sync_stats.finish()
+        signals.post_sync.send(sender=client, stats=sync_stats, success=success)
 
-                content_type = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
+def _sync(client, force, workers, verify, process_workers, dry_run,
+          incremental, since, paths, opened, resume):
+    """
+    Does the work of sync(), which sets up the stats and sends the signals.
+    """
+    if workers is None:
+        workers = SYNC_WORKERS
+    if process_workers is None:
+        process_workers = SYNC_PROCESS_WORKERS
 
-                if not is_syncable_file(os.path.basename(filename)) or not os.path.isfile(filepath):
-                    continue # hidden file or directory, do not upload
+    # The change journal is a snapshot of the tree as of the last sync.
+    sync_journal = None
+    if JOURNAL:
+        sync_journal = journal.Journal(JOURNAL, manifest_target(client)).load()
+
+    # The manifest lets us skip unchanged files without asking the backend.
+    manifest = None
+    if MANIFEST:
+        manifest = Manifest(MANIFEST, manifest_target(client)).load()
+
+    # Relative path -> file state for the new journal.
+    snapshot = {}
+    # Only the static files in candidates are looked at, unless it's None.
+    candidates = None
+    if incremental or since or paths is not None:
+        if sync_journal is None:
+            raise SyncException("Incremental syncs need MEDIASYNC['JOURNAL'].")
+        if since:
+            paths = journal.git_changes(client.media_root, since)
+        if paths is not None:
+            listed = [(path, os.path.join(client.media_root, path))
+                      for path in paths if is_syncable_path(path)
+                      and not is_state_path(os.path.join(client.media_root, path))]
+            snapshot = sync_journal.update(listed)
+        else:
+            snapshot = stats.timed('walk', journal.scan, static_files(client.media_root))
+        if not force:
+            candidates = sync_journal.changed(snapshot)
+
+    # Logical path -> fingerprinted path, for the fingerprint manifest.
+    fingerprinted = {}
+    if FINGERPRINT and candidates is not None:
+        # Unchanged files aren't looked at, so keep what they had.
+        removed = sync_journal.removed(snapshot)
+        fingerprinted = dict((path, fingerprint) for path, fingerprint
+                             in fingerprints.load().items()
+                             if path not in removed)
+        # Files that don't have a fingerprint yet need looking at too.
+        candidates.update(path for path in snapshot if path not in fingerprinted)
+
+    # Files whose processed content depends on a file that changed.
+    dependents = set()
+    if candidates is not None and manifest is not None:
+        dependents = assets.dependents(manifest.files,
+                                       candidates | sync_journal.removed(snapshot))
+        candidates.update(dependents)
+
+    items = sync_items(client, candidates)
+    if candidates is not None:
+        # Joined files only need syncing if one of their sources changed.
+        changed = bundles.get_index().bundles_for(candidates | sync_journal.removed(snapshot))
+        joined_changed = sync_journal.joined != journal.joined_state(JOINED)
+        items = (item for item in items if item.joinfile is None or
+                 joined_changed or item.joinfile in changed or
+                 item.remote_path in dependents or
+                 (FINGERPRINT and item.remote_path not in fingerprinted))
+
+    client.serve_remote = True
+    client.read_only = dry_run
+    if not opened:
+        client.open()
+
+    if dry_run:
+        # Use the processor cache, but don't add to it.
+        def process(worker_client, filedata, content_type, remote_path):
+            processed = worker_client.cached_process(filedata, content_type, remote_path)
+            if processed is None:
+                processed = worker_client.run_processors(filedata, content_type, remote_path)
+            return processed
+        processor_pool = None
+    elif process_workers > 1:
+        # Fork the processor workers before any threads are started.
+        processor_pool = pool.ProcessorPool(client, process_workers)
+        process = lambda worker_client, *args: processor_pool.process(*args)
+    else:
+        processor_pool = None
+        process = lambda worker_client, *args: worker_client.process(*args)
+
+    trust_manifest = manifest is not None and not (force or verify)
+
+    # Records what this sync uploaded as it goes, so a failed sync can be
+    # resumed. A checkpoint is only ever trusted with resume.
+    checkpoint = None
+    if manifest is not None and CHECKPOINT and not dry_run:
+        checkpoint = Manifest(CHECKPOINT, manifest.target)
+        if resume:
+            checkpoint.load()
+            manifest.files.update(checkpoint.files)
+            trust_manifest = True
+
+    def remote_paths(item, checksum):
+        """
+        Every remote path the item's content should be stored at.
+        """
+        paths = [item.remote_path]
+        if FINGERPRINT:
+            fingerprint = fingerprints.fingerprint_path(item.remote_path, checksum)
+            fingerprinted[item.remote_path] = fingerprint
+            paths.append(fingerprint)
+        return paths
+
+    asset_index = assets.get_index(client.media_root)
+
+    def assets_unchanged(entry):
+        """
+        Returns True if the files a manifest entry's processed data depended
+        on still have the same content.
+        """
+        previous = entry.get('assets')
+        if not previous:
+            return True
+        return assets.states_unchanged(asset_index.states_for(previous, previous), previous)
+
+    def put_item(worker_client, item):
+        """
+        Syncs a single item, returning a (remote_path, size, result) tuple
+        for each remote path written to. For dry runs, result is the
+        (bytes, requests) tuple from the backend's plan_put().
+        """
+        size, mtime = stats.timed('stat', item.stat)
+        entry = manifest.get(item.remote_path) if manifest is not None else None
+
+        sources = None
+        if item.joinfile is not None:
+            # Only sources that were touched since the last sync are read.
+            sources = stats.timed('stat', bundles.source_states,
+                                  worker_client.media_root, item.sourcepaths(),
+                                  entry and entry.get('sources'))
+
+        if trust_manifest and entry is not None and \
+                (manifest.is_unchanged(item.remote_path, size, mtime) or
+                 (sources is not None and
+                  bundles.sources_unchanged(sources, entry.get('sources')))) and \
+                assets_unchanged(entry):
+            paths = remote_paths(item, entry['checksum'])
+            for remote_path in paths:
+                if not manifest.is_current(remote_path, entry['checksum'],
+                                           entry['content_encoding']):
+                    break
+            else:
+                return []
+
+        asset_states = None
+        if item.is_streamed(size):
+            # Too big to hold in memory; hash it and hand the backend a file.
+            filedata = None
+            stats.count('bytes_read', size)
+            checksum = stats.timed('checksum', item.checksum)
+            content_encoding = worker_client.content_encoding(item.content_type, size)
+        else:
+            filedata = stats.timed('read', item.read, worker_client)
+            stats.count('bytes_read', len(filedata))
+            dependencies = worker_client.processor_dependencies(filedata, item.content_type,
+                                                                item.remote_path)
+            if dependencies:
+                asset_states = asset_index.states_for(dependencies, entry and entry.get('assets'))
+            filedata = stats.timed('process', process, worker_client, filedata,
+                                   item.content_type, item.remote_path)
+            stats.count('bytes_processed', len(filedata))
+            checksum = stats.timed('checksum', lambda: hashlib.md5(filedata).hexdigest())
+            content_encoding = worker_client.content_encoding(item.content_type, len(filedata))
+
+        pushed = []
+        for remote_path in remote_paths(item, checksum):
+            if trust_manifest and manifest.is_current(remote_path, checksum, content_encoding):
+                # Touched, but the result is the same as what was synced before.
+                result = False
+            elif filedata is None:
+                put_file = worker_client.plan_put_file if dry_run else worker_client.put_file
+                f = open(item.filepath, 'rb')
+                try:
+                    def attempt():
+                        f.seek(0)
+                        return put_file(f, item.content_type, remote_path, force)
+                    result = stats.timed('put', retry.call, attempt,
+                                         worker_client.is_retryable)
+                finally:
+                    f.close()
+            else:
+                put = worker_client.plan_put if dry_run else worker_client.put
+                result = stats.timed('put', retry.call,
+                                     lambda: put(filedata, item.content_type, remote_path, force),
+                                     worker_client.is_retryable)
+            if result:
+                pushed.append((remote_path, size if filedata is None else len(filedata), result))
+
+            if manifest is not None and not dry_run:
+                for m in (manifest, checkpoint):
+                    if m is not None:
+                        m.set(remote_path, checksum, size, mtime, content_encoding,
+                              sources, asset_states)
+        return pushed
+
+    def sync_item(worker_client, item):
+        """
+        put_item(), but failures are returned as an exc_info tuple instead
+        of raised, so that the other files are still synced.
+        """
+        try:
+            return (put_item(worker_client, item), None)
+        except Exception:
+            if not SYNC_FAILURE_BUDGET:
+                raise
+            return ([], sys.exc_info())
+
+    if workers > 1:
+        # Every worker thread gets a connection of its own.
+        make_client = client.clone
+        close_client = lambda worker_client: worker_client.close()
+    else:
+        make_client = lambda: client
+        close_client = None
+
+    sync_plan = SyncPlan(workers)
+    # (item, exc_info) for every file that failed.
+    failures = []
+    saved = time.time()
+    try:
+        results = pool.imap_ordered(sync_item, stats.timed_iter('walk', items),
+                                    workers, make_client, close_client)
+        for item, result, exc_info in results:
+            stats.count('files_seen')
+            if exc_info is None:
+                pushed, exc_info = result
+            if exc_info is not None:
+                stats.count('files_failed')
+                if len(failures) >= SYNC_FAILURE_BUDGET:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                print "[failed] %s: %s" % (item.remote_path, exc_info[1])
+                failures.append((item, exc_info))
+                continue
+
+            if checkpoint is not None and time.time() - saved >= CHECKPOINT_INTERVAL:
+                checkpoint.save()
+                saved = time.time()
+            if item.state is not None:
+                snapshot[item.remote_path] = item.state
+            if not pushed:
+                stats.count('files_unchanged')
+                sync_plan.unchanged += 1
+            for remote_path, size, result in pushed:
+                if dry_run:
+                    (transfer_size, requests) = result
+                    sync_plan.add(remote_path, item.content_type, size,
+                                  transfer_size, requests)
+                else:
+                    stats.count('files_uploaded')
+                    stats.count('bytes_uploaded', size)
+                    signals.file_synced.send(sender=client, remote_path=remote_path,
+                                             content_type=item.content_type, size=size)
+                    print "[%s] %s" % (item.content_type, remote_path)
+    except:
+        if checkpoint is not None:
+            checkpoint.save()
+        raise
+    finally:
+        if processor_pool is not None:
+            processor_pool.close()
+        if not opened:
+            client.close()
+        client.read_only = False
+
+    if dry_run:
+        return sync_plan
 
-                filedata = open(filepath, 'rb').read()
+    if failures:
+        if checkpoint is not None:
+            checkpoint.save()
+        # The manifests aren't saved, so the next sync looks at every file
+        # again. The checkpoint lets a resumed sync skip those that made it.
+        raise SyncException("%d files failed to sync: %s" % (
+            len(failures), ', '.join(item.remote_path for item, exc_info in failures)))
 
-                if client.process_and_put(filedata, content_type, remote_path, force=force):
-                    print "[%s] %s" % (content_type, remote_path)
+    client.commit()
 
-    client.close()
+    # Only record the manifests once everything made it to the backend.
+    if manifest is not None:
+        manifest.save()
+    if sync_journal is not None:
+        sync_journal.files = snapshot
+        sync_journal.joined = journal.joined_state(JOINED)
+        sync_journal.save()
+    if FINGERPRINT:
+        fingerprints.save(fingerprinted)
+    if checkpoint is not None and os.path.exists(CHECKPOINT):
+        os.remove(CHECKPOINT)
 
 
 __all__ = ['sync', 'SyncException']
@@ -0,0 +1,219 @@
+"""
+The files under the media root that stylesheets refer to with url(). The
+css_urls processor points each reference at the synced (or fingerprinted)
+file, or inlines it as a data URI, and sync() records the files a
+stylesheet refers to in the sync manifest, so that the stylesheet is
+processed again when one of them changes.
+
+An index of their checksums is kept for each media root, for the whole
+process: each file is hashed once for as long as its size and mtime stay
+the same, however many stylesheets refer to it.
+"""
+import base64
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+import threading
+import urllib
+from mediasync.msettings import FINGERPRINT_LENGTH
+from mediasync import fingerprints
+
+URL_RE = re.compile(r"""url\(\s*(['"]?)([^'"()\s]+)\1\s*\)""", re.IGNORECASE)
+
+# Scheme-relative, absolute and data: URLs.
+EXTERNAL_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*:|/)')
+
+# Referenced files that processors change on the way to remote storage, so
+# their synced checksum can't be told from the file on disk. Their
+# references are left alone.
+PROCESSED_EXTENSIONS = ('.css', '.js')
+
+def resolve(url, remote_path):
+    """
+    Returns a (path, suffix) tuple of the file, relative to the media root,
+    that a url() in the stylesheet at remote_path refers to, and the query
+    string and fragment that followed it. None if the url doesn't refer to
+    a file under the media root.
+    """
+    if EXTERNAL_RE.match(url) or url.startswith('#'):
+        return None
+    split = min([i for i in (url.find('?'), url.find('#')) if i != -1] or [len(url)])
+    (url, suffix) = (url[:split], url[split:])
+    path = posixpath.normpath(posixpath.join(posixpath.dirname(remote_path),
+                                             urllib.unquote(url)))
+    if path == '.' or path == '..' or path.startswith('../'):
+        return None
+    return (path, suffix)
+
+def references(filedata, remote_path):
+    """
+    Returns the sorted paths, relative to the media root, of the files the
+    stylesheet at remote_path refers to. They might not exist.
+    """
+    found = set()
+    for quote, url in URL_RE.findall(filedata):
+        resolved = resolve(url, remote_path)
+        if resolved is not None:
+            found.add(resolved[0])
+    return sorted(found)
+
+class AssetIndex(object):
+    """
+    Maps paths relative to the media root to [size, mtime, checksum] of the
+    file there.
+    """
+    def __init__(self, media_root):
+        self.media_root = media_root
+        self.states = {}
+        # path -> (checksum, data URI) of the files inlined so far.
+        self.inlined = {}
+        # Held while hashing, so that workers looking at the same file
+        # don't both hash it.
+        self._lock = threading.Lock()
+
+    def state(self, path, previous=None):
+        """
+        Returns [size, mtime, checksum] for the file at path, or None if
+        there isn't one. The file is only read if its size or mtime differ
+        from the last time it was looked at, or from previous (IE: what the
+        sync manifest recorded).
+        """
+        from mediasync.backends import file_checksum
+        filepath = os.path.join(self.media_root, path)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        self._lock.acquire()
+        try:
+            for known in (self.states.get(path), previous):
+                if known and known[0] == st.st_size and known[1] == st.st_mtime:
+                    break
+            else:
+                known = [st.st_size, st.st_mtime, file_checksum(filepath)]
+            self.states[path] = known
+            return known
+        finally:
+            self._lock.release()
+
+    def states_for(self, paths, previous=None):
+        """
+        Returns a dict of path -> state() for each of paths. previous is a
+        dict of the same.
+        """
+        previous = previous or {}
+        return dict((path, self.state(path, previous.get(path))) for path in paths)
+
+    def data_uri(self, path, state):
+        """
+        Returns the file at path, with the given state(), as a data URI.
+        """
+        self._lock.acquire()
+        try:
+            inlined = self.inlined.get(path)
+            if inlined is not None and inlined[0] == state[2]:
+                return inlined[1]
+        finally:
+            self._lock.release()
+
+        f = open(os.path.join(self.media_root, path), 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        content_type = mimetypes.guess_type(path)[0]
+        uri = 'data:%s;base64,%s' % (content_type, base64.b64encode(data))
+
+        self._lock.acquire()
+        try:
+            self.inlined[path] = (state[2], uri)
+        finally:
+            self._lock.release()
+        return uri
+
+def states_unchanged(states, previous):
+    """
+    Returns True if every file in states (a dict of path -> state()) has the
+    same content as in previous. Files that were only touched count as
+    unchanged.
+    """
+    if not previous or set(states) != set(previous):
+        return False
+    for path, state in states.items():
+        old = previous[path]
+        if (state is None) != (old is None):
+            # Added or removed.
+            return False
+        if state is not None and state[2] != old[2]:
+            return False
+    return True
+
+# Media root -> AssetIndex.
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(media_root):
+    """
+    Returns the index of the files under media_root (a client's media_root),
+    creating it on first use.
+    """
+    media_root = os.path.abspath(media_root)
+    _indexes_lock.acquire()
+    try:
+        if media_root not in _indexes:
+            _indexes[media_root] = AssetIndex(media_root)
+        return _indexes[media_root]
+    finally:
+        _indexes_lock.release()
+
+def rewrite(filedata, remote_path, media_root, fingerprint=False, inline_threshold=0):
+    """
+    Returns the stylesheet at remote_path with every url() that refers to a
+    file under media_root pointed at the synced file, relative to the
+    stylesheet. Files that exist are pointed at by their fingerprinted name
+    if fingerprint is True, or else get their checksum as a query string.
+    Files of inline_threshold bytes or less are inlined as data URIs. Other
+    references are left as they are.
+    """
+    index = get_index(media_root)
+    dirname = posixpath.dirname(remote_path) or '.'
+
+    def replace(match):
+        (quote, url) = match.groups()
+        resolved = resolve(url, remote_path)
+        if resolved is None:
+            return match.group(0)
+        (path, suffix) = resolved
+        if os.path.splitext(path)[1].lower() in PROCESSED_EXTENSIONS:
+            return match.group(0)
+        state = index.state(path)
+        if state is None:
+            return match.group(0)
+
+        (size, mtime, checksum) = state
+        if size <= inline_threshold and not suffix and mimetypes.guess_type(path)[0]:
+            url = index.data_uri(path, state)
+        elif fingerprint:
+            url = posixpath.relpath(fingerprints.fingerprint_path(path, checksum), dirname) + suffix
+        elif not suffix.startswith('?'):
+            # A query string of its own might mean something; leave it be.
+            url = "%s?%s%s" % (posixpath.relpath(path, dirname), checksum[:FINGERPRINT_LENGTH], suffix)
+        else:
+            url = posixpath.relpath(path, dirname) + suffix
+        return "url(%s%s%s)" % (quote, url, quote)
+
+    return URL_RE.sub(replace, filedata)
+
+def dependents(files, paths):
+    """
+    Returns the remote paths of the sync manifest entries (files) that
+    recorded any of paths as an asset.
+    """
+    paths = set(paths)
+    return set(remote_path for remote_path, entry in files.items()
+               if paths.intersection(entry.get('assets') or ()))
@@ -1,13 +1,96 @@
+import copy
+import hashlib
+import httplib
+import os
+import socket
+import threading
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.importlib import import_module
-from mediasync.msettings import BACKEND, PROCESSORS, EXPIRATION_DAYS, SERVE_REMOTE, MEDIA_ROOT, MEDIA_URL, EMULATE_COMBO
-from mediasync import processors
+from mediasync.msettings import BACKEND, PROCESSORS, EXPIRATION_DAYS, SERVE_REMOTE, MEDIA_ROOT, MEDIA_URL, EMULATE_COMBO, PROCESSOR_CACHE, PROCESSOR_CACHE_SIZE
+from mediasync.cache import DiskCache
+from mediasync import assets, processors, stats
+
+# Files are read in chunks of this many bytes when streaming.
+CHUNK_SIZE = 64 * 1024
+
+def file_checksum(path):
+    """
+    Returns the MD5 hexdigest of a file, read CHUNK_SIZE bytes at a time.
+    """
+    checksum = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            checksum.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    finally:
+        f.close()
+    return checksum.hexdigest()
+
+# Processor output, shared by every client in the process.
+processor_cache = DiskCache(PROCESSOR_CACHE, PROCESSOR_CACHE_SIZE) if PROCESSOR_CACHE else None
+
+def processor_identity(proc):
+    """
+    Returns a string identifying what a processor does, used as part of the
+    processor cache key, or None if its output can't be cached. Processors
+    can set a 'version' attribute, which should change whenever their
+    output does, or set 'cacheable' to False to opt out of caching. The
+    version can also be a callable that returns it, for versions that are
+    expensive to work out.
+    """
+    if not getattr(proc, 'cacheable', True):
+        return None
+
+    if hasattr(proc, '__name__'):
+        name = "%s.%s" % (proc.__module__, proc.__name__)
+    else:
+        # An instance of a processor class.
+        name = "%s.%s" % (proc.__class__.__module__, proc.__class__.__name__)
+
+    if '<lambda>' in name:
+        # Every lambda looks the same from here.
+        return None
+    version = getattr(proc, 'version', '')
+    if callable(version):
+        version = version()
+    return "%s:%s" % (name, version)
 
 def client():
     if not BACKEND:
         raise ImproperlyConfigured('must define a mediasync BACKEND property')
     return load_backend(BACKEND)
 
+# The client shared by the template tags and views, made on first use.
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the process-wide client used to render and serve media, creating
+    it the first time it's needed. Nothing is created just by importing the
+    template tags or urls, so processes that never render a media tag never
+    pay for loading the backend.
+    """
+    global _shared_client
+    if _shared_client is None:
+        _shared_client_lock.acquire()
+        try:
+            if _shared_client is None:
+                _shared_client = client()
+        finally:
+            _shared_client_lock.release()
+    return _shared_client
+
+def reset_client():
+    """
+    Forgets the shared client, so that the next get_client() makes a new one
+    from the current settings.
+    """
+    global _shared_client
+    _shared_client = None
+
 def load_backend(backend_name):
     try:
         backend = import_module(backend_name)
@@ -21,6 +104,9 @@ class BaseClient(object):
         # mediasync settings
         self.expiration_days = EXPIRATION_DAYS
         self.serve_remote = SERVE_REMOTE
+        # Set by sync() for dry runs. Backends must not change anything
+        # remotely (IE: create buckets) in open() while this is True.
+        self.read_only = False
 
         self.local_media_url = self.get_local_media_url()
         self.media_root = self.get_media_root()
@@ -41,6 +127,23 @@ class BaseClient(object):
             if callable(proc):
                 self.processors.append(proc)
 
+    def _get_processor_chain(self):
+        if not hasattr(self, '_processor_chain'):
+            identities = [processor_identity(proc) for proc in self.processors]
+            if None in identities:
+                self._processor_chain = None
+            else:
+                self._processor_chain = '|'.join(identities)
+        return self._processor_chain
+
+    def _set_processor_chain(self, processor_chain):
+        self._processor_chain = processor_chain
+
+    # Identifies the processor chain for the processor cache and the sync
+    # manifest. None if any of the processors can't be cached. Worked out on
+    # first use, since the minifiers' versions mean importing them.
+    processor_chain = property(_get_processor_chain, _set_processor_chain)
+
     def get_local_media_url(self):
         """
         Broken out to allow overriding if need be.
@@ -84,21 +187,106 @@ class BaseClient(object):
         remote_path: (basestr) Remote path where the file will be served from
             (if applicable). Most important thing is that the filename and
             extension are present.
+
+        Results are cached by content, processor chain, content type and
+        file extension, so unchanged files are only processed once.
+        """
+        # Only want to process stuff when self.serve_remote == True while
+        # running ./manage.py syncmedia, or when EMULATE_COMBO is enabled
+        # and we're running locally.
+        processors_active = self.serve_remote or EMULATE_COMBO
+
+        cache_key = self.processor_cache_key(filedata, content_type,
+                                             remote_path, processors_active)
+        if cache_key is not None:
+            cached = processor_cache.get(cache_key)
+            if cached is not None:
+                stats.count('processor_cache_hits')
+                return cached
+            stats.count('processor_cache_misses')
+
+        processed = self.run_processors(filedata, content_type, remote_path)
+
+        if cache_key is not None and processed is not filedata:
+            # Not worth a cache entry if none of the processors did anything.
+            processor_cache.set(cache_key, processed)
+        return processed
+
+    def run_processors(self, filedata, content_type, remote_path):
+        """
+        Runs the content through every processor, without looking at or
+        filling the processor cache.
         """
+        processors_active = self.serve_remote or EMULATE_COMBO
         # self.processors is a now a list of callables.
         for proc in self.processors:
-            # Only want to process stuff when self.serve_remote == True while
-            # running ./manage.py syncmedia, or when EMULATE_COMBO is enabled
-            # and we're running locally.
-            processors_active = self.serve_remote or EMULATE_COMBO
             # This will be the content after the processor runs on it.
             prcssd_filedata = proc(filedata, content_type, remote_path,
-                                   processors_active)
+                                   processors_active, **self.processor_kwargs(proc))
             if prcssd_filedata is not None:
                 # We got a useful value back from the processor, use it.
                 filedata = prcssd_filedata
         return filedata
 
+    def cached_process(self, filedata, content_type, remote_path):
+        """
+        Returns what process() would return from the processor cache, or None
+        if it would have to run the processors.
+        """
+        processors_active = self.serve_remote or EMULATE_COMBO
+        cache_key = self.processor_cache_key(filedata, content_type,
+                                             remote_path, processors_active)
+        if cache_key is None:
+            return None
+        return processor_cache.get(cache_key)
+
+    def processor_cache_key(self, filedata, content_type, remote_path, processors_active):
+        """
+        Returns the processor cache key for the given input, or None if the
+        result shouldn't be cached.
+        """
+        if processor_cache is None or not self.processors or self.processor_chain is None:
+            return None
+        if isinstance(filedata, unicode):
+            return None
+        extension = os.path.splitext(remote_path)[1].lower()
+        key = "%s\0%s\0%s\0%s\0" % (self.processor_chain, content_type,
+                                    extension, processors_active)
+        dependencies = self.processor_dependencies(filedata, content_type, remote_path)
+        if dependencies:
+            # The output changes along with the files it depends on.
+            states = assets.get_index(self.media_root).states_for(dependencies)
+            key += ''.join("%s\0%s\0" % (path, states[path] and states[path][2])
+                           for path in dependencies)
+        return hashlib.md5(key + filedata).hexdigest()
+
+    def processor_dependencies(self, filedata, content_type, remote_path):
+        """
+        Returns the sorted paths, relative to the media root, of the files
+        the processed content depends on besides filedata (IE: the images a
+        stylesheet refers to, for the css_urls processor). Processors list
+        them with a 'dependencies' attribute, a callable that takes the same
+        arguments as the processor.
+        """
+        processors_active = self.serve_remote or EMULATE_COMBO
+        found = set()
+        for proc in self.processors:
+            dependencies = getattr(proc, 'dependencies', None)
+            if dependencies is not None:
+                found.update(dependencies(filedata, content_type, remote_path,
+                                          processors_active, **self.processor_kwargs(proc)))
+        return sorted(found)
+
+    def processor_kwargs(self, proc):
+        """
+        Returns the keyword arguments a processor is called with on top of
+        the usual ones: media_root, for processors with a true
+        'uses_media_root' attribute.
+        """
+        if getattr(proc, 'uses_media_root', False):
+            return {'media_root': self.media_root}
+        return {}
+
     def process_and_put(self, filedata, content_type, remote_path, force=False):
         """
         Processes the content, then put/saves it to your backend.
@@ -106,14 +294,102 @@ class BaseClient(object):
         filedata = self.process(filedata, content_type, remote_path)
         return self.put(filedata, content_type, remote_path, force)
 
+    def content_encoding(self, content_type, size):
+        """
+        Returns the Content-Encoding (IE: 'gzip') that put() will store
+        processed data of the given type and size with, or None if it is
+        stored as-is. This is
+        recorded in the sync manifest so that a change in how a file would
+        be stored causes it to be pushed again.
+        """
+        return None
+
+    def is_retryable(self, exception):
+        """
+        Returns True if a put() or put_file() that raised exception is worth
+        trying again, IE: because of a network error. Backends should add
+        their own transient errors (IE: HTTP 503 responses).
+        """
+        return isinstance(exception, (socket.error, httplib.HTTPException))
+
     def put(self, filedata, content_type, remote_path, force=False):
         raise NotImplementedError('put not defined in ' + self.__class__.__name__)
 
+    def put_file(self, fileobj, content_type, remote_path, force=False):
+        """
+        Pushes an unprocessed file object to the backend. sync() uses this
+        for files over STREAM_THRESHOLD. Backends that can stream should
+        override this; by default the file is read into memory and handed
+        to put().
+        """
+        return self.put(fileobj.read(), content_type, remote_path, force)
+
+    def plan_put(self, filedata, content_type, remote_path, force=False):
+        """
+        Works out what put() would do with processed data, without writing
+        anything. Returns a (bytes, requests) tuple of how much put() would
+        send and in how many requests, or None if it would skip the file.
+        Backends should override this if they compress files or can tell
+        that a file is already up to date; by default every file is sent
+        as-is in a single request.
+        """
+        return (len(filedata), 1)
+
+    def plan_put_file(self, fileobj, content_type, remote_path, force=False):
+        """
+        Same as plan_put(), for files that would be sent with put_file().
+        """
+        fileobj.seek(0, os.SEEK_END)
+        return (fileobj.tell(), 1)
+
     def remote_media_url(self, with_ssl=False):
         raise NotImplementedError('remote_media_url not defined in ' + self.__class__.__name__)
 
+    def list_remote(self):
+        """
+        Returns a dict of the remote path of every file in remote storage to
+        when it was last modified, as a Unix timestamp. Used by prune() on
+        an opened client.
+        """
+        raise NotImplementedError('list_remote not defined in ' + self.__class__.__name__)
+
+    def delete(self, remote_paths):
+        """
+        Deletes the files at remote_paths from remote storage. Used by
+        prune() on an opened client.
+        """
+        raise NotImplementedError('delete not defined in ' + self.__class__.__name__)
+
+    def remote_location(self):
+        """
+        Returns a string identifying the remote storage, which the sync
+        manifest and journal are kept for. This is called before open(), so
+        backends whose remote_media_url() has to ask the remote end should
+        override it.
+        """
+        return self.remote_media_url()
+
+    def clone(self):
+        """
+        Returns an opened copy of this client with its own backend connection.
+        sync() uses this to give each upload worker a connection of its own,
+        so backends that keep per-connection state in open() should make sure
+        a shallow copy followed by open() does the right thing.
+        """
+        other = copy.copy(self)
+        other.open()
+        return other
+
     def open(self):
         pass
 
     def close(self):
         pass
+
+    def commit(self):
+        """
+        Called by sync() once every file has been pushed, after close(). It
+        isn't called for dry runs, or if any file failed. Backends that
+        stage uploads should make them live here.
+        """
+        pass
@@ -0,0 +1,357 @@
+"""
+Writes synced media to a local directory, for a web server (IE: nginx) to
+serve as static files, or for a CDN to pull from. Each sync that changes
+anything makes a new release:
+
+  FILESYSTEM_ROOT/.stage          the release being written
+  FILESYSTEM_ROOT/releases/<id>   every release kept
+  FILESYSTEM_ROOT/current         symlink to the live release
+
+The stage starts out as a copy of the live release made of hardlinks, so
+unchanged files cost neither a copy nor disk space. Files are written next
+to their final name and renamed into place, and compressible files get .gz
+(and .br, if brotli is installed) siblings for gzip_static and brotli_static.
+Once every file has been written, the stage is moved to releases/ and the
+current symlink is swapped to it in a single rename.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from mediasync.msettings import FILESYSTEM_ROOT, FILESYSTEM_URL, FILESYSTEM_KEEP_RELEASES
+from mediasync.backends import BaseClient, CHUNK_SIZE
+from mediasync import compression, stats
+
+STAGE = '.stage'
+RELEASES = 'releases'
+CURRENT = 'current'
+
+# Precompressed siblings: Content-Encoding -> extension.
+SIBLINGS = (('gzip', '.gz'), ('br', '.br'))
+
+# Written files are readable by the web server.
+FILE_MODE = 0644
+
+# Held while the stage is being created, since every worker may try to.
+_stage_lock = threading.Lock()
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        # Another worker got there first.
+        if e.errno != errno.EEXIST:
+            raise
+
+def _temp_path(path):
+    """
+    Returns an unused, hidden temporary path next to path.
+    """
+    dirname, basename = os.path.split(path)
+    if not os.path.isdir(dirname):
+        _makedirs(dirname)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename)
+    os.close(fd)
+    return tmp
+
+def _link(src, dst):
+    """
+    Hardlinks src to dst, copying it if the filesystem can't link.
+    """
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+def _link_tree(src, dst):
+    """
+    Recreates the tree under src at dst, with files hardlinked.
+    """
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            _link(os.path.join(root, name), os.path.join(target, name))
+
+def _write(path, data):
+    """
+    Writes data (a string or a file object) to path atomically: readers see
+    the old file or the new one, never part of one. A file hardlinked from
+    an older release is replaced, not changed.
+    """
+    tmp = _temp_path(path)
+    try:
+        f = open(tmp, 'wb')
+        try:
+            if isinstance(data, basestring):
+                f.write(data)
+            else:
+                data.seek(0)
+                shutil.copyfileobj(data, f, CHUNK_SIZE)
+        finally:
+            f.close()
+        os.chmod(tmp, FILE_MODE)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _link_into(src, path):
+    """
+    Same as _write(), with the contents of the file at src, by hardlinking.
+    """
+    tmp = _temp_path(path)
+    os.remove(tmp)
+    _link(src, tmp)
+    os.rename(tmp, path)
+
+def _same(path, data):
+    """
+    Returns True if the file at path holds exactly data (a string or a file
+    object).
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    try:
+        if isinstance(data, basestring):
+            return os.fstat(f.fileno()).st_size == len(data) and f.read() == data
+        data.seek(0)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if chunk != data.read(CHUNK_SIZE):
+                return False
+            if not chunk:
+                return True
+    finally:
+        f.close()
+        if not isinstance(data, basestring):
+            data.seek(0)
+
+def _release_order(name):
+    # Releases made in the same second get a -1, -2... suffix.
+    timestamp, sep, n = name.partition('-')
+    return (timestamp, int(n or 0))
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+class Client(BaseClient):
+
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+        # MD5 -> staged path of each file written by this sync, so that the
+        # same content under another name (IE: a fingerprinted one) is linked
+        # instead of written again. Shared with clones.
+        self._written = {}
+
+    def _root(self):
+        if not FILESYSTEM_ROOT:
+            raise ImproperlyConfigured("FILESYSTEM_ROOT must be set.")
+        return os.path.abspath(FILESYSTEM_ROOT)
+
+    def _live(self):
+        """
+        Returns the directory of the live release, or None.
+        """
+        current = os.path.join(self._root(), CURRENT)
+        if os.path.isdir(current):
+            return os.path.realpath(current)
+        return None
+
+    def _stage(self):
+        """
+        Returns the directory the next release is written to, creating it
+        from the live release if need be. A stage left by a sync that failed
+        is picked up again, so that a resumed sync builds on it.
+        """
+        stage = os.path.join(self._root(), STAGE)
+        _stage_lock.acquire()
+        try:
+            if not os.path.isdir(stage):
+                # Built under another name, so a stage is never half linked.
+                building = _temp_path(stage)
+                os.remove(building)
+                os.makedirs(building)
+                live = self._live()
+                if live is not None:
+                    stats.timed('stage', _link_tree, live, building)
+                os.rename(building, stage)
+            return stage
+        finally:
+            _stage_lock.release()
+
+    def _current_path(self, remote_path):
+        """
+        Returns where the current version of remote_path would be: in the
+        stage if there is one, or else in the live release. None if there
+        is neither.
+        """
+        stage = os.path.join(self._root(), STAGE)
+        base = stage if os.path.isdir(stage) else self._live()
+        if base is None:
+            return None
+        return os.path.join(base, remote_path)
+
+    def remote_media_url(self, with_ssl=False):
+        """
+        Returns FILESYSTEM_URL, where the current release is served from.
+
+        args:
+          with_ssl: (bool) If True, return an HTTPS url.
+        """
+        if not FILESYSTEM_URL:
+            raise ImproperlyConfigured("FILESYSTEM_URL must be set.")
+        url = FILESYSTEM_URL.rstrip('/')
+        if with_ssl and url.startswith('http://'):
+            url = 'https://' + url[len('http://'):]
+        return url
+
+    def remote_location(self):
+        return self._root()
+
+    def _write_siblings(self, path, filedata, content_type):
+        variants = stats.timed('compress', compression.variants, filedata, content_type)
+        for encoding, ext in SIBLINGS:
+            compressed = variants.get(encoding)
+            if compressed is not None and len(compressed) < len(filedata):
+                _write(path + ext, compressed)
+            else:
+                # Left over from an older version of the file.
+                _remove(path + ext)
+
+    def _is_current(self, remote_path, data, force):
+        if force:
+            return False
+        path = self._current_path(remote_path)
+        return path is not None and _same(path, data)
+
+    def put(self, filedata, content_type, remote_path, force=False):
+        # Checked before staging, so that a sync that changes nothing
+        # doesn't make a release.
+        if stats.timed('lookup', self._is_current, remote_path, filedata, force):
+            return None
+
+        path = os.path.join(self._stage(), remote_path)
+
+        checksum = hashlib.md5(filedata).hexdigest()
+        written = self._written.get(checksum)
+        if written is not None:
+            # Already written under another name by this sync.
+            for ext in [''] + [ext for encoding, ext in SIBLINGS]:
+                if os.path.exists(written + ext):
+                    stats.timed('upload', _link_into, written + ext, path + ext)
+                else:
+                    _remove(path + ext)
+        else:
+            stats.timed('upload', _write, path, filedata)
+            self._write_siblings(path, filedata, content_type)
+            self._written[checksum] = path
+        return True
+
+    def put_file(self, fileobj, content_type, remote_path, force=False):
+        """
+        Copies fileobj into the stage in chunks, with a gzipped sibling if
+        it is compressible.
+        """
+        if stats.timed('lookup', self._is_current, remote_path, fileobj, force):
+            return None
+
+        path = os.path.join(self._stage(), remote_path)
+        stats.timed('upload', _write, path, fileobj)
+        # Big files aren't held in memory to be compressed with brotli.
+        _remove(path + '.br')
+        if compression.is_compressible(content_type):
+            compressed = stats.timed('compress', compression.gzip_compress_file, fileobj, CHUNK_SIZE)
+            try:
+                _write(path + '.gz', compressed)
+            finally:
+                compressed.close()
+        else:
+            _remove(path + '.gz')
+        return True
+
+    def plan_put(self, filedata, content_type, remote_path, force=False):
+        if self._is_current(remote_path, filedata, force):
+            return None
+        return (len(filedata), 1)
+
+    def plan_put_file(self, fileobj, content_type, remote_path, force=False):
+        if self._is_current(remote_path, fileobj, force):
+            return None
+        return super(Client, self).plan_put_file(fileobj, content_type, remote_path, force)
+
+    def list_remote(self):
+        """
+        Lists the stage if there is one, or else the live release.
+        Precompressed siblings aren't listed; they go with their file.
+        """
+        base = self._current_path('')
+        listed = {}
+        if base is None:
+            return listed
+        for root, dirs, files in os.walk(base):
+            names = set(files)
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                stem, ext = os.path.splitext(name)
+                if ext in [ext for encoding, ext in SIBLINGS] and stem in names:
+                    continue
+                path = os.path.join(root, name)
+                listed[os.path.relpath(path, base).replace(os.sep, '/')] = os.path.getmtime(path)
+        return listed
+
+    def delete(self, remote_paths):
+        """
+        Removes the files, and their siblings, from the stage. They are gone
+        once the stage is committed.
+        """
+        stage = self._stage()
+        for remote_path in remote_paths:
+            path = os.path.join(stage, remote_path)
+            for ext in [''] + [ext for encoding, ext in SIBLINGS]:
+                _remove(path + ext)
+
+    def commit(self):
+        """
+        Makes the stage the live release: it is moved to releases/, and the
+        current symlink is swapped to it with a rename, so the web server
+        never sees a half written release. Releases past
+        FILESYSTEM_KEEP_RELEASES are then removed, oldest first.
+        """
+        self._written.clear()
+        root = self._root()
+        stage = os.path.join(root, STAGE)
+        if not os.path.isdir(stage):
+            # Nothing changed.
+            return
+
+        releases = os.path.join(root, RELEASES)
+        if not os.path.isdir(releases):
+            os.makedirs(releases)
+        name = base = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        n = 0
+        while os.path.exists(os.path.join(releases, name)):
+            n += 1
+            name = '%s-%d' % (base, n)
+        os.rename(stage, os.path.join(releases, name))
+
+        link = _temp_path(os.path.join(root, CURRENT))
+        os.remove(link)
+        os.symlink(os.path.join(RELEASES, name), link)
+        os.rename(link, os.path.join(root, CURRENT))
+
+        old = sorted(os.listdir(releases), key=_release_order)
+        for name in old[:-max(FILESYSTEM_KEEP_RELEASES, 1)]:
+            shutil.rmtree(os.path.join(releases, name))
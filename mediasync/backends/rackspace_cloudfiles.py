@@ -1,18 +1,440 @@
-import cloudfiles
-from django.conf import settings
-from mediasync.msettings import CLOUDFILES_CONTAINER, CLOUDFILES_USERNAME, CLOUDFILES_KEY
-from mediasync.backends import BaseClient
+import calendar
+import copy
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+from mediasync.msettings import CLOUDFILES_CONTAINER, CLOUDFILES_USERNAME, CLOUDFILES_KEY, CLOUDFILES_PREFIX, CLOUDFILES_AUTH_URL, CLOUDFILES_SERVICENET, CLOUDFILES_INVENTORY, CLOUDFILES_CDN_URL, CLOUDFILES_CDN_SSL_URL, CLOUDFILES_CDN_STATE
+from mediasync.backends import BaseClient, CHUNK_SIZE
+from mediasync import compression, retry, stats
+
+# Objects per container listing request; the most Cloud Files will return.
+LISTING_LIMIT = 10000
+
+# Container name -> (cdn_uri, cdn_ssl_uri), so that rendering templates
+# doesn't ask the CDN every time.
+cdn_uris = {}
+_cdn_uris_lock = threading.Lock()
+
+def _load_cdn_uris():
+    """
+    Returns the container name -> [cdn_uri, cdn_ssl_uri] dict that sync
+    saved in CLOUDFILES_CDN_STATE, or an empty dict if there isn't one.
+    """
+    if not CLOUDFILES_CDN_STATE:
+        return {}
+    try:
+        f = open(CLOUDFILES_CDN_STATE, 'rb')
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def _save_cdn_uris(uris):
+    """
+    Atomically records the container's (cdn_uri, cdn_ssl_uri) in
+    CLOUDFILES_CDN_STATE, unless it's there already.
+    """
+    saved = _load_cdn_uris()
+    if not CLOUDFILES_CDN_STATE or saved.get(CLOUDFILES_CONTAINER) == list(uris):
+        return
+    saved[CLOUDFILES_CONTAINER] = list(uris)
+    dirname = os.path.dirname(os.path.abspath(CLOUDFILES_CDN_STATE))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.cloudfiles_cdn')
+    f = os.fdopen(fd, 'wb')
+    try:
+        simplejson.dump(saved, f, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmppath, CLOUDFILES_CDN_STATE)
+
+def _checksum(data):
+    return hashlib.md5(data).hexdigest()
+
+def _checksum_file(fp):
+    """
+    Same as _checksum(), but reads the file in chunks. Returns a
+    (hexdigest, size) tuple and leaves fp at the start.
+    """
+    checksum = hashlib.md5()
+    size = 0
+    fp.seek(0)
+    chunk = fp.read(CHUNK_SIZE)
+    while chunk:
+        checksum.update(chunk)
+        size += len(chunk)
+        chunk = fp.read(CHUNK_SIZE)
+    fp.seek(0)
+    return (checksum.hexdigest(), size)
+
+def _timestamp(last_modified):
+    """
+    Returns the Unix timestamp of a listing's last_modified (IE:
+    2011-01-01T00:00:00.000000).
+    """
+    if not last_modified:
+        return 0
+    return calendar.timegm(time.strptime(last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+
+class _CachedAuth(object):
+    """
+    Hands a new cloudfiles Connection credentials that were already fetched,
+    so that clones don't authenticate again. If the token expires, the
+    Connection authenticates again and gets fresh ones.
+    """
+    def __init__(self, auth, credentials):
+        self.auth = auth
+        self.credentials = credentials
+
+    def authenticate(self):
+        credentials, self.credentials = self.credentials, None
+        if credentials is None:
+            credentials = self.auth.authenticate()
+        return credentials
 
 class Client(BaseClient):
+
+    # Maps object names to ETags for everything under CLOUDFILES_PREFIX.
+    # Built once when the client is opened and shared with clones.
+    _inventory = None
+
+    # The Authentication and the (storage_url, cdn_url, token) it returned.
+    _auth = None
+    _credentials = None
+
+    _conn = None
+    _container = None
+
+    def _connect(self, cdn=True):
+        """
+        Returns a new Connection, authenticating if this client (or the one
+        it was cloned from) hasn't yet. Without cdn, the Connection can't
+        make CDN requests, which saves a CDN lookup for every Container.
+        """
+        # cloudfiles is only needed to sync, so it isn't imported until then.
+        from cloudfiles.authentication import Authentication
+        from cloudfiles.connection import Connection
+
+        if self._credentials is None:
+            if not (CLOUDFILES_USERNAME and CLOUDFILES_KEY and CLOUDFILES_CONTAINER):
+                raise ImproperlyConfigured("CLOUDFILES_USERNAME, CLOUDFILES_KEY and CLOUDFILES_CONTAINER must be set.")
+            kwargs = {}
+            if CLOUDFILES_AUTH_URL:
+                kwargs['authurl'] = CLOUDFILES_AUTH_URL
+            self._auth = Authentication(CLOUDFILES_USERNAME, CLOUDFILES_KEY, **kwargs)
+            self._credentials = self._auth.authenticate()
+
+        (storage_url, cdn_url, token) = self._credentials
+        if not cdn:
+            cdn_url = None
+        return Connection(auth=_CachedAuth(self._auth, (storage_url, cdn_url, token)),
+                          servicenet=CLOUDFILES_SERVICENET)
+
     def open(self):
-        _conn = cloudfiles.get_connection(CLOUDFILES_USERNAME, CLOUDFILES_KEY)
-        self._container = _conn.create_container(CLOUDFILES_CONTAINER)
+        from cloudfiles.errors import NoSuchContainer
+        self._conn = self._connect()
+
+        try:
+            self._container = self._conn.get_container(CLOUDFILES_CONTAINER)
+        except NoSuchContainer:
+            if self.read_only:
+                # Dry run against a container that doesn't exist: it's all new.
+                self._container = None
+                self._inventory = {}
+                return
+            self._container = self._conn.create_container(CLOUDFILES_CONTAINER)
+
+        if self._conn.cdn_enabled and not self.read_only and not self._container.is_public():
+            self._container.make_public(ttl=self.expiration_days * 24 * 3600)
+        if self._container.cdn_uri:
+            uris = (self._container.cdn_uri, self._container.cdn_ssl_uri)
+            cdn_uris[CLOUDFILES_CONTAINER] = uris
+            if not self.read_only:
+                # For web processes without CLOUDFILES_CDN_URL.
+                _cdn_uris_lock.acquire()
+                try:
+                    _save_cdn_uris(uris)
+                finally:
+                    _cdn_uris_lock.release()
+
+        if CLOUDFILES_INVENTORY and self._inventory is None:
+            self._inventory = stats.timed('lookup', self._build_inventory)
+
+    def clone(self):
+        """
+        Workers get a connection of their own, with the credentials and
+        inventory of this client, and no CDN lookups.
+        """
+        from cloudfiles.container import Container
+        other = copy.copy(self)
+        other._conn = None
+        if self._container is not None:
+            other._conn = other._connect(cdn=False)
+            other._container = Container(other._conn, self._container.name)
+        return other
+
+    def close(self):
+        if self._conn is not None:
+            for http in (self._conn.connection, self._conn.cdn_connection):
+                if http is not None:
+                    http.close()
+        self._conn = None
+        self._container = None
+
+    def _list_objects(self):
+        """
+        Yields (name, info) for every object under CLOUDFILES_PREFIX, where
+        info is the object's listing, LISTING_LIMIT objects per request.
+        """
+        prefix = "%s/" % CLOUDFILES_PREFIX if CLOUDFILES_PREFIX else None
+        marker = None
+        while True:
+            objects = self._container.list_objects_info(prefix=prefix, limit=LISTING_LIMIT,
+                                                        marker=marker)
+            for info in objects:
+                yield (info['name'].encode('utf-8'), info)
+            if len(objects) < LISTING_LIMIT:
+                return
+            marker = objects[-1]['name'].encode('utf-8')
+
+    def _build_inventory(self):
+        """
+        Returns a dict of the names of every object under CLOUDFILES_PREFIX
+        to their ETags.
+        """
+        return dict((name, info['hash']) for name, info in self._list_objects())
+
+    def list_remote(self):
+        if self._container is None:
+            # Dry run against a container that doesn't exist.
+            return {}
+        offset = len(CLOUDFILES_PREFIX) + 1 if CLOUDFILES_PREFIX else 0
+        return dict((name[offset:], _timestamp(info['last_modified']))
+                    for name, info in self._list_objects())
+
+    def delete(self, remote_paths):
+        """
+        Deletes one object per request; python-cloudfiles can't batch them.
+        """
+        from cloudfiles.errors import ResponseError
+        for remote_path in remote_paths:
+            name = self._name(remote_path)
+            try:
+                retry.call(lambda: self._container.delete_object(name), self.is_retryable)
+            except ResponseError, e:
+                # Already gone.
+                if e.status != 404:
+                    raise
+            if self._inventory is not None:
+                self._inventory.pop(name, None)
+
+    def _cdn_uris(self):
+        """
+        Returns the container's (cdn_uri, cdn_ssl_uri): the ones the last
+        sync saved, or else asking the CDN, the first time in each process.
+        """
+        from cloudfiles.container import Container
+        _cdn_uris_lock.acquire()
+        try:
+            if CLOUDFILES_CONTAINER not in cdn_uris:
+                saved = _load_cdn_uris().get(CLOUDFILES_CONTAINER)
+                if saved:
+                    cdn_uris[CLOUDFILES_CONTAINER] = tuple(saved)
+            if CLOUDFILES_CONTAINER not in cdn_uris:
+                conn = self._connect()
+                try:
+                    container = Container(conn, CLOUDFILES_CONTAINER)
+                finally:
+                    conn.connection.close()
+                    if conn.cdn_connection is not None:
+                        conn.cdn_connection.close()
+                if not container.cdn_uri:
+                    raise ImproperlyConfigured("The %s container isn't on the CDN. Run syncmedia to publish it, or set CLOUDFILES_CDN_URL." % CLOUDFILES_CONTAINER)
+                cdn_uris[CLOUDFILES_CONTAINER] = (container.cdn_uri, container.cdn_ssl_uri)
+            return cdn_uris[CLOUDFILES_CONTAINER]
+        finally:
+            _cdn_uris_lock.release()
 
     def remote_media_url(self, with_ssl=False):
-        return ""
+        """
+        Returns the base remote media URL: CLOUDFILES_CDN_URL (or
+        CLOUDFILES_CDN_SSL_URL), or else the container's CDN URL. Set those
+        for serving, or the first call in each process reads
+        CLOUDFILES_CDN_STATE, or failing that authenticates and asks the CDN.
+
+        args:
+          with_ssl: (bool) If True, return an HTTPS url.
+        """
+        url = CLOUDFILES_CDN_SSL_URL if with_ssl else CLOUDFILES_CDN_URL
+        if not url:
+            (cdn_uri, cdn_ssl_uri) = self._cdn_uris()
+            url = cdn_ssl_uri if with_ssl else cdn_uri
+        url = url.rstrip('/')
+
+        if CLOUDFILES_PREFIX:
+            url = "%s/%s" % (url, CLOUDFILES_PREFIX)
+
+        return url
+
+    def remote_location(self):
+        # The CDN URL may not be known (or exist) until the first sync.
+        location = "%s@%s" % (CLOUDFILES_USERNAME, CLOUDFILES_CONTAINER)
+        if CLOUDFILES_PREFIX:
+            location = "%s/%s" % (location, CLOUDFILES_PREFIX)
+        return location
+
+    def content_encoding(self, content_type, size):
+        # check to see if file should be gzipped based on content_type
+        # also check to see if filesize is greater than 1kb
+        if compression.is_compressible(content_type) and size > 1024:
+            return 'gzip'
+        return None
+
+    def _headers(self):
+        """
+        Returns the initial set of headers for an upload. The CDN passes
+        them on to browsers.
+        """
+        now = datetime.datetime.utcnow()
+        then = now + datetime.timedelta(self.expiration_days)
+
+        return {
+            "Expires": then.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Cache-Control": 'max-age=%d' % (self.expiration_days * 24 * 3600),
+        }
+
+    def _prepare(self, filedata, content_type, store=True):
+        """
+        Returns (filedata, headers, etag) for uploading processed data:
+        gzipped if need be, with the MD5 of what will be uploaded.
+        """
+        headers = self._headers()
+        if self.content_encoding(content_type, len(filedata)) == 'gzip':
+            # Compressed output is stable, so its ETag can be compared.
+            filedata = compression.compress(filedata, 'gzip', store)
+            headers["Content-Encoding"] = "gzip"
+        return (filedata, headers, _checksum(filedata))
+
+    def _prepare_file(self, fileobj, content_type):
+        """
+        Same as _prepare() for a file object. Returns (upload, headers,
+        etag, size), where upload is a temporary file holding the gzipped
+        data if it was compressed. The caller must close it.
+        """
+        (etag, size) = _checksum_file(fileobj)
+        headers = self._headers()
+
+        upload = fileobj
+        if self.content_encoding(content_type, size) == 'gzip':
+            upload = compression.gzip_compress_file(fileobj, CHUNK_SIZE)
+            headers["Content-Encoding"] = "gzip"
+            (etag, size) = _checksum_file(upload)
+
+        return (upload, headers, etag, size)
+
+    def _is_current(self, name, etag, force):
+        """
+        Returns True if the object is already there with the same bytes.
+        Without an inventory, the object is looked up.
+        """
+        from cloudfiles.errors import NoSuchObject
+        if force:
+            return False
+        if self._inventory is not None:
+            return self._inventory.get(name) == etag
+        if self._container is None:
+            return False
+        try:
+            return self._container.get_object(name).etag == etag
+        except NoSuchObject:
+            return False
+
+    def _write(self, name, data, content_type, headers, etag):
+        """
+        Uploads data (a string or file) as name. The ETag is sent along, so
+        Cloud Files rejects the upload if it got mangled on the way.
+        """
+        from cloudfiles.storage_object import Object
+        obj = Object(self._container, object_record={
+            'name': name, 'content_type': content_type, 'bytes': None,
+            'last_modified': None, 'hash': None})
+        obj.headers.update(headers)
+        obj.etag = etag
+        obj.write(data)
+
+        if self._inventory is not None:
+            self._inventory[name] = etag
+
+    def is_retryable(self, exception):
+        from cloudfiles.errors import ResponseError
+        if isinstance(exception, ResponseError):
+            # Server errors, throttling, timeouts, and uploads that got
+            # mangled on the way (the ETag didn't match).
+            return exception.status >= 500 or exception.status in (408, 422, 429)
+        return super(Client, self).is_retryable(exception)
+
+    def _name(self, remote_path):
+        if CLOUDFILES_PREFIX:
+            return "%s/%s" % (CLOUDFILES_PREFIX, remote_path)
+        return remote_path
 
     def put(self, filedata, content_type, remote_path, force=False):
-        obj = self._container.create_object(remote_path)
-        obj.write(filedata)
+        name = self._name(remote_path)
+
+        (filedata, headers, etag) = stats.timed('compress', self._prepare, filedata, content_type)
 
+        if stats.timed('lookup', self._is_current, name, etag, force):
+            return None
+
+        stats.timed('upload', self._write, name, filedata, content_type, headers, etag)
+        stats.count('bytes_sent', len(filedata))
+        stats.count('requests')
         return True
+
+    def plan_put(self, filedata, content_type, remote_path, force=False):
+        (filedata, headers, etag) = \
+            stats.timed('compress', self._prepare, filedata, content_type, store=False)
+
+        if stats.timed('lookup', self._is_current, self._name(remote_path), etag, force):
+            return None
+        return (len(filedata), 1)
+
+    def put_file(self, fileobj, content_type, remote_path, force=False):
+        """
+        Streams fileobj to Cloud Files without holding it in memory. Gzipped
+        data is staged in a temporary file.
+        """
+        name = self._name(remote_path)
+
+        (upload, headers, etag, size) = \
+            stats.timed('compress', self._prepare_file, fileobj, content_type)
+
+        try:
+            if stats.timed('lookup', self._is_current, name, etag, force):
+                return None
+
+            stats.timed('upload', self._write, name, upload, content_type, headers, etag)
+            stats.count('bytes_sent', size)
+            stats.count('requests')
+            return True
+        finally:
+            if upload is not fileobj:
+                upload.close()
+
+    def plan_put_file(self, fileobj, content_type, remote_path, force=False):
+        (upload, headers, etag, size) = \
+            stats.timed('compress', self._prepare_file, fileobj, content_type)
+        if upload is not fileobj:
+            upload.close()
+
+        if stats.timed('lookup', self._is_current, self._name(remote_path), etag, force):
+            return None
+        return (size, 1)
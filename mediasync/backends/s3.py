@@ -1,13 +1,14 @@
 import base64
+import calendar
 import cStringIO
 import datetime
-import gzip
 import hashlib
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import threading
+import time
 from django.core.exceptions import ImproperlyConfigured
-from mediasync.msettings import TYPES_TO_COMPRESS, AWS_KEY, AWS_SECRET, AWS_BUCKET, AWS_PREFIX, AWS_BUCKET_CNAME
-from mediasync.backends import BaseClient
+from mediasync.msettings import AWS_KEY, AWS_SECRET, AWS_BUCKET, AWS_PREFIX, AWS_BUCKET_CNAME, AWS_INVENTORY, AWS_INVENTORY_SHARDS, AWS_MULTIPART_THRESHOLD, AWS_MULTIPART_CHUNK_SIZE, AWS_POOL_SIZE, AWS_HOST, AWS_PORT, AWS_SECURE
+from mediasync.backends import BaseClient, CHUNK_SIZE
+from mediasync import compression, pool, retry, stats
 
 def _checksum(data):
     checksum = hashlib.md5(data)
@@ -15,21 +16,218 @@ def _checksum(data):
     b64digest = base64.b64encode(checksum.digest())
     return (hexdigest, b64digest)
 
-def _compress(s):
-    zbuf = cStringIO.StringIO()
-    zfile = gzip.GzipFile(mode='wb', compresslevel=6, fileobj=zbuf)
-    zfile.write(s)
-    zfile.close()
-    return zbuf.getvalue()
+def _compress(s, store=True):
+    # Compressed once per unique content and cached. The output is stable
+    # for the same input, which is what lets the inventory compare ETags.
+    return compression.compress(s, 'gzip', store)
 
-class Client(BaseClient):
-    def open(self):
+def _checksum_file(fp):
+    """
+    Same as _checksum(), but reads the file in chunks. Returns a
+    (hexdigest, b64digest, size) tuple and leaves fp at the start.
+    """
+    checksum = hashlib.md5()
+    size = 0
+    fp.seek(0)
+    chunk = fp.read(CHUNK_SIZE)
+    while chunk:
+        checksum.update(chunk)
+        size += len(chunk)
+        chunk = fp.read(CHUNK_SIZE)
+    fp.seek(0)
+    return (checksum.hexdigest(), base64.b64encode(checksum.digest()), size)
+
+def _compress_file(fp):
+    """
+    Same as _compress(), but reads fp in chunks and writes the result to
+    a temporary file, which is returned rewound.
+    """
+    return compression.gzip_compress_file(fp, CHUNK_SIZE)
+
+# Keys per multi-object delete request; the most S3 allows.
+DELETE_BATCH = 1000
+
+def _timestamp(last_modified):
+    """
+    Returns the Unix timestamp of a listing's LastModified (IE:
+    2011-01-01T00:00:00.000Z).
+    """
+    if not last_modified:
+        return 0
+    return calendar.timegm(time.strptime(last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def _close(conn):
+    try:
+        conn.close()
+    except AttributeError:
+        # close() is broken in boto 1.9. The sockets are closed when the
+        # connection is garbage collected instead.
+        pass
+
+class ConnectionPool(object):
+    """
+    Keeps S3 connections open between uses. boto keeps each connection's
+    HTTP connection alive between requests, so handing the same connections
+    to every worker, clone and (with syncmedia --watch) every sync saves a
+    new connection and TLS handshake each time. A connection is only used by
+    one client at a time; up to size idle connections are kept.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        # Buckets known to exist, so they don't have to be looked up again.
+        self.buckets = set()
+
+    def get(self):
+        """
+        Returns an idle connection, or a new one if there aren't any.
+        """
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        return self._new_connection()
+
+    def put(self, conn):
+        """
+        Hands a connection back for reuse.
+        """
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        _close(conn)
+
+    def clear(self):
+        """
+        Closes every idle connection.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+            self.buckets.clear()
+        finally:
+            self._lock.release()
+        for conn in idle:
+            _close(conn)
+
+    def _new_connection(self):
+        # boto is only needed to sync, so it isn't imported until then.
+        from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+        kwargs = {'is_secure': AWS_SECURE, 'port': AWS_PORT}
+        if AWS_HOST:
+            # S3 stand-ins generally want the bucket name in the path.
+            kwargs['host'] = AWS_HOST
+            kwargs['calling_format'] = OrdinaryCallingFormat()
         try:
-            _conn = S3Connection(AWS_KEY, AWS_SECRET)
+            return S3Connection(AWS_KEY, AWS_SECRET, **kwargs)
         except AttributeError:
             raise ImproperlyConfigured("S3 keys not set and no boto config found.")
 
-        self._bucket = _conn.create_bucket(AWS_BUCKET)
+# Shared by every client in the process.
+connections = ConnectionPool(AWS_POOL_SIZE)
+
+class Client(BaseClient):
+
+    # Maps key names to ETags for everything under AWS_PREFIX. Built once when
+    # the client is opened and shared with clones.
+    _inventory = None
+
+    _bucket = None
+
+    def _connect(self):
+        """
+        Returns the bucket, on a connection from the pool. Hand it back with
+        _release() when done. Returns None (and keeps no connection) if the
+        bucket doesn't exist and this is a dry run.
+        """
+        _conn = connections.get()
+        if AWS_BUCKET in connections.buckets:
+            # No need to ask S3 again.
+            return _conn.get_bucket(AWS_BUCKET, validate=False)
+
+        try:
+            bucket = _conn.lookup(AWS_BUCKET)
+            if bucket is None:
+                if self.read_only:
+                    # Don't create the bucket just to look at it.
+                    connections.put(_conn)
+                    return None
+                bucket = _conn.create_bucket(AWS_BUCKET)
+        except:
+            # Nobody else will hand the connection back.
+            connections.put(_conn)
+            raise
+        connections.buckets.add(AWS_BUCKET)
+        return bucket
+
+    def _release(self, bucket):
+        if bucket is not None:
+            connections.put(bucket.connection)
+
+    def open(self):
+        self._bucket = self._connect()
+
+        if self._bucket is None:
+            # Dry run against a bucket that doesn't exist: it's all new.
+            self._inventory = {}
+        elif AWS_INVENTORY and self._inventory is None:
+            self._inventory = stats.timed('lookup', self._build_inventory)
+
+    def _list_keys(self, bucket, prefix, delimiter=''):
+        """
+        Yields (name, etag) tuples for the keys under prefix. bucket.list()
+        pages through the results 1000 keys per request. If a delimiter is
+        given, rolled up prefixes are yielded as (prefix, None).
+        """
+        from boto.s3.prefix import Prefix
+        for key in bucket.list(prefix=prefix, delimiter=delimiter):
+            if isinstance(key, Prefix):
+                yield (key.name, None)
+            else:
+                yield (key.name, (key.etag or '').strip('"'))
+
+    def _build_inventory(self):
+        """
+        Lists every key under AWS_PREFIX and returns a dict of key names to
+        ETags. With AWS_INVENTORY_SHARDS > 1, the top level "directories"
+        under the prefix are listed in parallel, each on its own connection.
+        """
+        prefix = "%s/" % AWS_PREFIX if AWS_PREFIX else ''
+        inventory = {}
+
+        if AWS_INVENTORY_SHARDS <= 1:
+            for name, etag in self._list_keys(self._bucket, prefix):
+                inventory[name] = etag
+            return inventory
+
+        shards = []
+        for name, etag in self._list_keys(self._bucket, prefix, delimiter='/'):
+            if etag is None:
+                shards.append(name)
+            else:
+                inventory[name] = etag
+
+        list_shard = lambda bucket, shard: list(self._list_keys(bucket, shard))
+        results = pool.imap_ordered(list_shard, shards, AWS_INVENTORY_SHARDS,
+                                    self._connect, self._release)
+        for shard, keys, exc_info in results:
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            inventory.update(keys)
+
+        return inventory
+
+    def close(self):
+        # The connection goes back to the pool for the next client.
+        self._release(self._bucket)
+        self._bucket = None
 
     def remote_media_url(self, with_ssl=False):
         """
@@ -54,43 +252,269 @@ class Client(BaseClient):
 
         return url
 
-    def put(self, filedata, content_type, remote_path, force=False):
+    def content_encoding(self, content_type, size):
+        # check to see if file should be gzipped based on content_type
+        # also check to see if filesize is greater than 1kb
+        if compression.is_compressible(content_type) and size > 1024:
+            return 'gzip'
+        return None
+
+    def _headers(self, content_type):
+        """
+        Returns the initial set of headers for an upload.
+        """
         now = datetime.datetime.utcnow()
         then = now + datetime.timedelta(self.expiration_days)
         expires = then.strftime("%a, %d %b %Y %H:%M:%S GMT")
 
-        if AWS_PREFIX:
-            remote_path = "%s/%s" % (AWS_PREFIX, remote_path)
-
-        (hexdigest, b64digest) = _checksum(filedata)
-        raw_b64digest = b64digest # store raw b64digest to add as file metadata
-
-        # create initial set of headers
-        headers = {
+        return {
             "x-amz-acl": "public-read",
             "Content-Type": content_type,
             "Expires": expires,
             "Cache-Control": 'max-age=%d' % (self.expiration_days * 24 * 3600),
         }
 
-        # check to see if file should be gzipped based on content_type
-        # also check to see if filesize is greater than 1kb
-        if content_type in TYPES_TO_COMPRESS and len(filedata) > 1024:
-            filedata = _compress(filedata)
-            headers["Content-Encoding"] = "gzip"
-            (hexdigest, b64digest) = _checksum(filedata) # update checksum with compressed data
-
-        key = self._bucket.get_key(remote_path)
+    def _get_key(self, remote_path, hexdigest, raw_b64digest, force):
+        """
+        Returns the Key to upload to, or None if the remote file is already
+        up to date. hexdigest is the MD5 of the bytes that would be uploaded,
+        raw_b64digest that of the uncompressed data.
+        """
+        if self._inventory is None:
+            key = self._bucket.get_key(remote_path)
+        else:
+            etag = self._inventory.get(remote_path)
+            if etag is None or force:
+                # Not in the bucket (or we don't care), no need to ask S3.
+                key = None
+            elif etag == hexdigest:
+                # Same bytes as what's already there.
+                return None
+            else:
+                # The ETag differs; look at the checksum metadata to find out
+                # why. Files gzipped by older versions of mediasync have
+                # unstable ETags even when the content hasn't changed.
+                key = self._bucket.get_key(remote_path)
 
         if key is None:
+            from boto.s3.key import Key
             key = Key(self._bucket)
             key.key = remote_path
 
         key_meta = key.get_metadata('mediasync-checksum') or ''
         s3_checksum = key_meta.replace(' ', '+')
         if force or s3_checksum != raw_b64digest:
-
             key.set_metadata('mediasync-checksum', raw_b64digest)
-            key.set_contents_from_string(filedata, headers=headers, md5=(hexdigest, b64digest))
+            return key
 
+        return None
+
+    def _prepare(self, filedata, content_type, store=True):
+        """
+        Returns (filedata, headers, hexdigest, b64digest, raw_b64digest) for
+        uploading processed data: gzipped if need be, with checksums of both
+        the uploaded and the raw data.
+        """
+        (hexdigest, b64digest) = _checksum(filedata)
+        raw_b64digest = b64digest # store raw b64digest to add as file metadata
+
+        # create initial set of headers
+        headers = self._headers(content_type)
+
+        content_encoding = self.content_encoding(content_type, len(filedata))
+        if content_encoding == 'gzip':
+            filedata = _compress(filedata, store)
+            headers["Content-Encoding"] = "gzip"
+            (hexdigest, b64digest) = _checksum(filedata) # update checksum with compressed data
+
+        return (filedata, headers, hexdigest, b64digest, raw_b64digest)
+
+    def _prepare_file(self, fileobj, content_type):
+        """
+        Same as _prepare() for a file object. Returns (upload, headers,
+        hexdigest, b64digest, raw_b64digest, size), where upload is a
+        temporary file holding the gzipped data if it was compressed. The
+        caller must close it.
+        """
+        (hexdigest, b64digest, size) = _checksum_file(fileobj)
+        raw_b64digest = b64digest
+
+        headers = self._headers(content_type)
+
+        upload = fileobj
+        if self.content_encoding(content_type, size) == 'gzip':
+            upload = _compress_file(fileobj)
+            headers["Content-Encoding"] = "gzip"
+            (hexdigest, b64digest, size) = _checksum_file(upload)
+
+        return (upload, headers, hexdigest, b64digest, raw_b64digest, size)
+
+    def _requests(self, size):
+        """
+        Returns the number of requests it takes to upload size bytes.
+        """
+        if size >= AWS_MULTIPART_THRESHOLD and \
+                hasattr(self._bucket, 'initiate_multipart_upload'):
+            # Initiate, one per part, complete.
+            parts = max((size + AWS_MULTIPART_CHUNK_SIZE - 1) / AWS_MULTIPART_CHUNK_SIZE, 1)
+            return parts + 2
+        return 1
+
+    def is_retryable(self, exception):
+        from boto.exception import BotoServerError, S3DataError
+        if isinstance(exception, BotoServerError):
+            # Server errors, throttling and timeouts.
+            return exception.status >= 500 or exception.status in (408, 429) or \
+                getattr(exception, 'error_code', None) in ('RequestTimeout', 'SlowDown')
+        if isinstance(exception, S3DataError):
+            # The upload got mangled on the way.
             return True
+        return super(Client, self).is_retryable(exception)
+
+    def put(self, filedata, content_type, remote_path, force=False):
+        if AWS_PREFIX:
+            remote_path = "%s/%s" % (AWS_PREFIX, remote_path)
+
+        (filedata, headers, hexdigest, b64digest, raw_b64digest) = \
+            stats.timed('compress', self._prepare, filedata, content_type)
+
+        key = stats.timed('lookup', self._get_key, remote_path, hexdigest, raw_b64digest, force)
+        if key is not None:
+
+            stats.timed('upload', key.set_contents_from_string, filedata,
+                        headers=headers, md5=(hexdigest, b64digest))
+            stats.count('bytes_sent', len(filedata))
+            stats.count('requests')
+
+            if self._inventory is not None:
+                self._inventory[remote_path] = hexdigest
+
+            return True
+
+    def plan_put(self, filedata, content_type, remote_path, force=False):
+        if AWS_PREFIX:
+            remote_path = "%s/%s" % (AWS_PREFIX, remote_path)
+
+        (filedata, headers, hexdigest, b64digest, raw_b64digest) = \
+            stats.timed('compress', self._prepare, filedata, content_type, store=False)
+
+        if stats.timed('lookup', self._get_key, remote_path, hexdigest, raw_b64digest, force) is None:
+            return None
+        return (len(filedata), 1)
+
+    def put_file(self, fileobj, content_type, remote_path, force=False):
+        """
+        Streams fileobj to S3 without holding it in memory. Gzipped data is
+        staged in a temporary file, and anything over AWS_MULTIPART_THRESHOLD
+        is sent as a multipart upload if the installed boto supports it.
+        """
+        if AWS_PREFIX:
+            remote_path = "%s/%s" % (AWS_PREFIX, remote_path)
+
+        (upload, headers, hexdigest, b64digest, raw_b64digest, size) = \
+            stats.timed('compress', self._prepare_file, fileobj, content_type)
+
+        try:
+            key = stats.timed('lookup', self._get_key, remote_path, hexdigest, raw_b64digest, force)
+            if key is None:
+                return None
+
+            requests = self._requests(size)
+            if requests > 1:
+                stats.timed('upload', self._put_multipart, key, upload, headers)
+            else:
+                # boto only works the size out itself when it computes the MD5.
+                key.size = size
+                stats.timed('upload', key.set_contents_from_file, upload,
+                            headers=headers, md5=(hexdigest, b64digest))
+            stats.count('bytes_sent', size)
+            stats.count('requests', requests)
+
+            if self._inventory is not None:
+                self._inventory[remote_path] = hexdigest
+
+            return True
+        finally:
+            if upload is not fileobj:
+                upload.close()
+
+    def plan_put_file(self, fileobj, content_type, remote_path, force=False):
+        if AWS_PREFIX:
+            remote_path = "%s/%s" % (AWS_PREFIX, remote_path)
+
+        (upload, headers, hexdigest, b64digest, raw_b64digest, size) = \
+            stats.timed('compress', self._prepare_file, fileobj, content_type)
+        try:
+            if stats.timed('lookup', self._get_key, remote_path, hexdigest, raw_b64digest, force) is None:
+                return None
+            return (size, self._requests(size))
+        finally:
+            if upload is not fileobj:
+                upload.close()
+
+    def _put_multipart(self, key, fp, headers):
+        """
+        Uploads fp in AWS_MULTIPART_CHUNK_SIZE parts, one part in memory at
+        a time. Requires boto 2.0 or later.
+        """
+        mp = self._bucket.initiate_multipart_upload(key.key, headers=headers,
+                                                    metadata=key.metadata)
+        try:
+            part_num = 0
+            fp.seek(0)
+            chunk = fp.read(AWS_MULTIPART_CHUNK_SIZE)
+            while chunk:
+                part_num += 1
+                mp.upload_part_from_file(cStringIO.StringIO(chunk), part_num)
+                chunk = fp.read(AWS_MULTIPART_CHUNK_SIZE)
+            mp.complete_upload()
+        except:
+            mp.cancel_upload()
+            raise
+
+    def list_remote(self):
+        if self._bucket is None:
+            # Dry run against a bucket that doesn't exist.
+            return {}
+        prefix = "%s/" % AWS_PREFIX if AWS_PREFIX else ''
+        return dict((key.name[len(prefix):], _timestamp(key.last_modified))
+                    for key in self._bucket.list(prefix=prefix))
+
+    def _delete_keys(self, bucket, names):
+        """
+        Deletes names in one multi-object delete request. Returns the names
+        S3 couldn't delete.
+        """
+        result = bucket.delete_keys(names, quiet=True)
+        return [error.key for error in result.errors]
+
+    def delete(self, remote_paths):
+        """
+        Deletes DELETE_BATCH keys per request with multi-object delete if the
+        installed boto supports it (2.4 and later). Keys that older versions
+        of boto can't batch, or that a batch failed to delete, are deleted
+        one request at a time, on up to AWS_POOL_SIZE connections at once.
+        """
+        names = [("%s/%s" % (AWS_PREFIX, path) if AWS_PREFIX else path) for path in remote_paths]
+
+        if hasattr(self._bucket, 'delete_keys'):
+            failed = []
+            for i in range(0, len(names), DELETE_BATCH):
+                batch = names[i:i + DELETE_BATCH]
+                failed.extend(retry.call(lambda: self._delete_keys(self._bucket, batch),
+                                         self.is_retryable))
+        else:
+            failed = names
+
+        if failed:
+            delete_key = lambda bucket, name: retry.call(lambda: bucket.delete_key(name),
+                                                         self.is_retryable)
+            results = pool.imap_ordered(delete_key, failed, min(AWS_POOL_SIZE, len(failed)),
+                                        self._connect, self._release)
+            for name, result, exc_info in results:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+        if self._inventory is not None:
+            for name in names:
+                self._inventory.pop(name, None)
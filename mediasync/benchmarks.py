@@ -0,0 +1,293 @@
+"""
+Offline benchmarks of the hot paths: walking the media tree, joining files,
+running processors, syncing to the dummy backend and to a fake S3 server on
+localhost, and rendering the template tags. Everything runs against a
+synthetic media tree in a temporary directory, so no AWS credentials are
+needed and the real media root and sync state are left alone.
+
+./manage.py benchmarkmediasync prints the results as JSON, so they can be
+compared between releases.
+"""
+import mimetypes
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import mediasync
+from mediasync import backends, bundles, compression, listdir_recursive, combine_files, static_files
+
+# The size and shape of the synthetic media tree.
+DEFAULT_TREE = {
+    'dirs': 3,     # subdirectories per directory
+    'depth': 2,    # levels of subdirectories
+    'files': 10,   # files of each kind per directory
+    'size': 4096,  # approximate size of each file, in bytes
+    'joined': 10,  # source files per joined file
+}
+
+CSS_RULE = ".rule-%d a:hover, .rule-%d > li {\n    margin: 0 %dpx;\n    color: #%06x;\n}\n\n"
+JS_FUNCTION = "function handler%d(event) {\n    // Handles event %d.\n    var value = %d;\n    return event.target.value + value;\n}\n\n"
+
+def _filler(template, size, rand):
+    chunks = []
+    total = 0
+    while total < size:
+        n = rand.randint(0, 1 << 24)
+        chunk = template % ((n,) * template.count('%'))
+        chunks.append(chunk)
+        total += len(chunk)
+    return ''.join(chunks)[:size]
+
+def make_tree(root, dirs=3, depth=2, files=10, size=4096, joined=10, seed=0):
+    """
+    Writes a synthetic media tree of CSS, JavaScript and binary files under
+    root, and returns a JOINED setting that bundles the first few CSS and
+    JavaScript files. The same arguments always give the same tree.
+    """
+    rand = random.Random(seed)
+    kinds = (
+        ('css', mediasync.CSS_PATH.strip('/') or 'css', lambda: _filler(CSS_RULE, size, rand)),
+        ('js', mediasync.JS_PATH.strip('/') or 'js', lambda: _filler(JS_FUNCTION, size, rand)),
+        ('png', 'img', lambda: ''.join(chr(rand.randint(0, 255)) for i in xrange(size))),
+    )
+    subdirs = level = ['']
+    for i in range(depth):
+        level = [os.path.join(parent, 'd%d' % n) for parent in level for n in range(dirs)]
+        subdirs = subdirs + level
+
+    joined_files = {}
+    for ext, topdir, content in kinds:
+        sources = []
+        for subdir in subdirs:
+            dirpath = os.path.join(root, topdir, subdir)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            for i in range(files):
+                filename = os.path.join(subdir, 'file%d.%s' % (i, ext))
+                f = open(os.path.join(root, topdir, filename), 'wb')
+                f.write(content())
+                f.close()
+                sources.append(filename.replace(os.sep, '/'))
+        if ext != 'png' and joined:
+            # Source files are relative to CSS_PATH or JS_PATH.
+            prefix = '' if (mediasync.CSS_PATH if ext == 'css' else mediasync.JS_PATH) else topdir + '/'
+            joined_files['bundle.%s' % ext] = [prefix + path for path in sources[:joined]]
+    return joined_files
+
+def timeit(func, repeat=3):
+    """
+    Calls func repeat times and returns a dict of the best and mean times, in
+    seconds, and func's return value from the last call.
+    """
+    times = []
+    result = None
+    for i in range(max(repeat, 1)):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return {
+        'seconds': min(times),
+        'mean': sum(times) / len(times),
+        'runs': len(times),
+    }, result
+
+def _patch(obj, **attrs):
+    """
+    Sets attributes on obj, returning their old values for _restore().
+    """
+    old = dict((name, getattr(obj, name)) for name in attrs)
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    return old
+
+def _restore(obj, old):
+    for name, value in old.items():
+        setattr(obj, name, value)
+
+def _quiet(func):
+    """
+    Calls func with sys.stdout thrown away, since sync() prints every upload.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def bench_listdir(root, joined, client, repeat):
+    dirs = [os.path.join(root, d) for d in sorted(os.listdir(root))]
+    stats, found = timeit(lambda: [f for d in dirs for f in listdir_recursive(d)], repeat)
+    stats['items'] = len(found)
+    return stats
+
+def bench_combine(root, joined, client, repeat):
+    stats, combined = timeit(lambda: [combine_files(joinfile, sourcefiles, client)
+                                      for joinfile, sourcefiles in sorted(joined.items())], repeat)
+    stats['items'] = sum(len(sourcefiles) for sourcefiles in joined.values())
+    stats['bytes'] = sum(len(filedata) for filedata, dirname in combined)
+    return stats
+
+def bench_process(root, joined, client, repeat):
+    files = []
+    for remote_path, filepath in static_files(root):
+        content_type = mimetypes.guess_type(remote_path)[0]
+        if remote_path.endswith(('.css', '.js')):
+            f = open(filepath, 'rb')
+            files.append((f.read(), content_type, remote_path))
+            f.close()
+    # Time the processors themselves, not the processor cache.
+    old = _patch(backends, processor_cache=None)
+    old_client = _patch(client, serve_remote=True)
+    try:
+        stats, processed = timeit(lambda: [client.process(*args) for args in files], repeat)
+    finally:
+        _restore(backends, old)
+        _restore(client, old_client)
+    stats['items'] = len(files)
+    stats['bytes'] = sum(len(args[0]) for args in files)
+    stats['processed_bytes'] = sum(len(filedata) for filedata in processed)
+    return stats
+
+def _bench_sync(client, repeat, workers):
+    """
+    Times a full sync with nothing to go on, and a sync of the unchanged
+    tree that the sync manifest lets skip everything. The sync state is kept
+    in a temporary directory.
+    """
+    state_dir = tempfile.mkdtemp(prefix='mediasync-state')
+    old = _patch(mediasync, MANIFEST=os.path.join(state_dir, 'manifest.json'),
+                 JOURNAL=os.path.join(state_dir, 'journal.json'),
+                 CHECKPOINT=os.path.join(state_dir, 'checkpoint.json'))
+
+    def cold():
+        for name in os.listdir(state_dir):
+            os.remove(os.path.join(state_dir, name))
+        _quiet(lambda: mediasync.sync(client, force=True, workers=workers))
+
+    try:
+        stats, result = timeit(cold, repeat)
+        warm, result = timeit(lambda: _quiet(lambda: mediasync.sync(client, workers=workers)), repeat)
+    finally:
+        _restore(mediasync, old)
+        shutil.rmtree(state_dir, ignore_errors=True)
+    stats['unchanged_seconds'] = warm['seconds']
+    stats['unchanged_mean'] = warm['mean']
+    return stats
+
+def bench_sync_dummy(root, joined, client, repeat, workers=1):
+    old = _patch(backends, processor_cache=None)
+    try:
+        return _bench_sync(client, repeat, workers)
+    finally:
+        _restore(backends, old)
+
+def bench_sync_s3(root, joined, client, repeat, workers=1):
+    try:
+        from mediasync.backends import s3
+    except ImportError:
+        return {'skipped': 'boto is not installed'}
+    from mediasync.fakes3 import FakeS3Server
+
+    server = FakeS3Server()
+    old_s3 = _patch(s3, AWS_HOST='127.0.0.1', AWS_PORT=server.port, AWS_SECURE=False,
+                    AWS_BUCKET='mediasync', AWS_KEY='fake', AWS_SECRET='fake', AWS_PREFIX='')
+    old_caches = (_patch(backends, processor_cache=None), _patch(compression, cache=None))
+    s3.connections.clear()
+    try:
+        s3_client = s3.Client()
+        s3_client.media_root = root
+        stats = _bench_sync(s3_client, repeat, workers)
+        stats['requests'] = len(server.requests)
+        stats['connections'] = server.connections
+        return stats
+    finally:
+        s3.connections.clear()
+        _restore(s3, old_s3)
+        _restore(backends, old_caches[0])
+        _restore(compression, old_caches[1])
+        server.stop()
+
+def bench_tags(root, joined, client, repeat, renders=1000):
+    from django.template import Context, Token, TOKEN_BLOCK
+    from mediasync.templatetags import media
+    old = _patch(backends, _shared_client=client)
+    old_media = _patch(media, JOINED=joined)
+    media.invalidate()
+    try:
+        tokens = ['css "%s"' % name for name in sorted(joined) if name.endswith('.css')]
+        tokens += ['js "%s"' % name for name in sorted(joined) if name.endswith('.js')]
+        compile_stats, nodes = timeit(lambda: [
+            (media.css_tag if token.startswith('css') else media.js_tag)(None, Token(TOKEN_BLOCK, token))
+            for token in tokens], repeat)
+        context = Context({})
+        stats, result = timeit(lambda: [node.render(context) for i in xrange(renders)
+                                        for node in nodes], repeat)
+    finally:
+        _restore(backends, old)
+        _restore(media, old_media)
+        media.invalidate()
+    stats['items'] = renders * len(nodes)
+    stats['compile_seconds'] = compile_stats['seconds']
+    return stats
+
+BENCHMARKS = (
+    ('listdir_recursive', bench_listdir),
+    ('combine_files', bench_combine),
+    ('process', bench_process),
+    ('sync_dummy', bench_sync_dummy),
+    ('sync_s3', bench_sync_s3),
+    ('tags', bench_tags),
+)
+
+def run(names=None, repeat=3, workers=1, **tree):
+    """
+    Builds a synthetic media tree and runs the benchmarks on it, returning a
+    dict that can be dumped as JSON.
+
+    args:
+      names: (list) Names of the benchmarks to run. Defaults to all of them.
+      repeat: (int) How many times to run each benchmark; the best and mean
+                    times are reported.
+      workers: (int) Number of sync workers for the sync benchmarks.
+      tree: The size and shape of the tree (see DEFAULT_TREE).
+    """
+    options = dict(DEFAULT_TREE)
+    options.update(tree)
+
+    root = tempfile.mkdtemp(prefix='mediasync-bench')
+    try:
+        joined = make_tree(root, **options)
+        client = backends.load_backend('mediasync.backends.dummy')
+        client.media_root = root
+        client.put_callback = lambda *args: None
+        old = _patch(mediasync, JOINED=joined, FINGERPRINT=False)
+        old_index = _patch(bundles, JOINED=joined, _index=None)
+        try:
+            results = {}
+            for name, benchmark in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                if name.startswith('sync'):
+                    results[name] = benchmark(root, joined, client, repeat, workers)
+                else:
+                    results[name] = benchmark(root, joined, client, repeat)
+        finally:
+            _restore(mediasync, old)
+            _restore(bundles, old_index)
+
+        files = list(static_files(root))
+        return {
+            'version': mediasync.__version__,
+            'python': sys.version.split()[0],
+            'tree': dict(options, count=len(files),
+                         bytes=sum(os.path.getsize(filepath) for remote_path, filepath in files)),
+            'repeat': repeat,
+            'workers': workers,
+            'results': results,
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
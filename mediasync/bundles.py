@@ -0,0 +1,96 @@
+"""
+An index of the JOINED setting in both directions: the source files each
+bundle (combo file) is built from, and the bundles each source file is part
+of. sync() uses it, along with what the sources looked like when a bundle
+was last synced, to only rebuild bundles whose sources changed.
+"""
+import os
+from mediasync.msettings import JOINED
+from mediasync import backends
+
+def source_path(dirname, sourcefile):
+    """
+    Returns the path of a bundle's source file, relative to the media root.
+    """
+    return '/'.join(p.strip('/') for p in (dirname, sourcefile) if p)
+
+class BundleIndex(object):
+    """
+    Maps bundles to their source files and back. Paths are relative to the
+    media root. Bundles that can't be joined (not CSS or JS) are left out.
+    """
+    def __init__(self, joined):
+        from mediasync import joined_dirname
+        # joinfile -> list of source paths, in the order they're joined.
+        self.sources = {}
+        # source path -> set of joinfiles.
+        self.bundles = {}
+        for joinfile, sourcefiles in joined.items():
+            dirname = joined_dirname(joinfile)
+            if dirname is None:
+                continue
+            paths = [source_path(dirname, sourcefile) for sourcefile in sourcefiles]
+            self.sources[joinfile] = paths
+            for path in paths:
+                self.bundles.setdefault(path, set()).add(joinfile)
+
+    def sources_for(self, joinfile):
+        return self.sources.get(joinfile, [])
+
+    def bundles_for(self, paths):
+        """
+        Returns the set of bundles built from any of the given source paths.
+        """
+        found = set()
+        for path in paths:
+            found.update(self.bundles.get(path.strip('/'), ()))
+        return found
+
+_index = None
+
+def get_index():
+    """
+    Returns the index of the JOINED setting, building it on first use.
+    """
+    global _index
+    if _index is None:
+        _index = BundleIndex(JOINED)
+    return _index
+
+def source_states(media_root, paths, previous=None):
+    """
+    Returns a list of [path, size, mtime, checksum] describing the given
+    source files, in the order they are joined. Size, mtime and checksum
+    are None for the ones that don't exist. Only sources whose size or
+    mtime differ from those in previous (a list of the same) are read to
+    work out their checksum.
+    """
+    known = dict((state[0], state) for state in previous or ())
+    states = []
+    for path in paths:
+        filepath = os.path.join(media_root, path)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            states.append([path, None, None, None])
+            continue
+        state = known.get(path)
+        if state and state[1] == st.st_size and state[2] == st.st_mtime:
+            states.append(state)
+        else:
+            states.append([path, st.st_size, st.st_mtime, backends.file_checksum(filepath)])
+    return states
+
+def sources_unchanged(states, previous):
+    """
+    Returns True if the same sources, in the same order, have the same
+    content as in previous. Sources that were only touched count as
+    unchanged.
+    """
+    if not previous or len(states) != len(previous):
+        return False
+    for state, old in zip(states, previous):
+        if state[0] != old[0] or state[3] != old[3]:
+            # Reordered, added, removed or changed.
+            return False
+    return True
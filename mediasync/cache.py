@@ -0,0 +1,154 @@
+"""
+A simple on-disk cache used to avoid redoing expensive work (like
+compressing or minifying files) between syncs.
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+class DiskCache(object):
+    """
+    Stores strings in files under a directory, one file per key. Keys should
+    be safe to use as file names (IE: hexdigests). Writes are atomic, so the
+    cache is safe to share between threads and processes.
+
+    If max_size (in bytes) is given, the least recently used entries are
+    evicted once the cache grows past it. Hits bump an entry's mtime, which
+    is what "recently used" is based on.
+    """
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        # Running total of the cache size, worked out on the first write.
+        self._size = None
+        self._lock = threading.Lock()
+        # Set once a write fails, so that nothing else is tried.
+        self.read_only = False
+
+    def _path(self, key):
+        # Spread entries out so no single directory gets huge.
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            value = f.read()
+        finally:
+            f.close()
+
+        if self.max_size:
+            try:
+                os.utime(path, None)
+            except OSError:
+                # Evicted by someone else in the meantime, no big deal.
+                pass
+        return value
+
+    def set(self, key, value):
+        """
+        Stores value under key. The cache is only there to save time, so if
+        it can't be written to (IE: it is under a read-only media root while
+        serving requests), the value is dropped and the cache becomes read
+        only, rather than failing whatever was being cached.
+        """
+        if self.read_only:
+            return
+        try:
+            self._write(key, value)
+        except (IOError, OSError):
+            self.read_only = True
+            return
+
+        if self.max_size:
+            self._lock.acquire()
+            try:
+                if self._size is None:
+                    self._size = self.size()
+                else:
+                    self._size += len(value)
+                if self._size > self.max_size:
+                    self.evict()
+            finally:
+                self._lock.release()
+
+    def _write(self, key, value):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Somebody else got there first.
+                if not os.path.isdir(dirname):
+                    raise
+
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(value)
+            finally:
+                f.close()
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def _entries(self):
+        """
+        Returns a list of (mtime, size, path) tuples for every entry.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.root):
+            for filename in files:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        """
+        Returns the total size of the cache in bytes.
+        """
+        return sum(size for mtime, size, path in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is down to
+        three quarters of max_size, so that we don't evict on every write.
+        """
+        entries = self._entries()
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        target = self.max_size * 3 / 4
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        self._size = 0
@@ -0,0 +1,140 @@
+"""
+Produces compressed variants of text assets. Compression is done once per
+unique file content: results are cached on disk by content hash, so
+re-syncing (or re-serving) an unchanged file costs a hash and a file read.
+
+gzip output is made as small as we can: zopfli is used if it is installed,
+otherwise zlib at GZIP_LEVEL. Brotli variants are produced if the brotli
+package is installed.
+"""
+import cStringIO
+import gzip
+import hashlib
+import tempfile
+from mediasync.msettings import TYPES_TO_COMPRESS, GZIP_LEVEL, COMPRESSION_CACHE, COMPRESSION_CACHE_SIZE, BROTLI_LEVEL
+from mediasync.cache import DiskCache
+
+try:
+    import zopfli.gzip
+    ZOPFLI_INSTALLED = True
+except ImportError:
+    ZOPFLI_INSTALLED = False
+
+try:
+    import brotli
+    BROTLI_INSTALLED = True
+except ImportError:
+    BROTLI_INSTALLED = False
+
+def gzip_compress(data):
+    if ZOPFLI_INSTALLED:
+        return zopfli.gzip.compress(data)
+    zbuf = cStringIO.StringIO()
+    # A fixed mtime means the same input always gives the same output.
+    zfile = gzip.GzipFile(mode='wb', compresslevel=GZIP_LEVEL, fileobj=zbuf, mtime=0)
+    zfile.write(data)
+    zfile.close()
+    return zbuf.getvalue()
+
+def gzip_compress_file(fp, chunk_size=64 * 1024):
+    """
+    Same as gzip_compress(), but reads fp in chunks and writes the result to
+    a temporary file, which is returned rewound. zopfli isn't used, since it
+    needs the whole file in memory.
+    """
+    tmp = tempfile.TemporaryFile()
+    zfile = gzip.GzipFile(mode='wb', compresslevel=GZIP_LEVEL, fileobj=tmp, mtime=0)
+    fp.seek(0)
+    chunk = fp.read(chunk_size)
+    while chunk:
+        zfile.write(chunk)
+        chunk = fp.read(chunk_size)
+    zfile.close()
+    tmp.seek(0)
+    return tmp
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=BROTLI_LEVEL)
+
+# Content-Encoding -> compressor, most preferred first.
+ENCODERS = []
+if BROTLI_INSTALLED:
+    ENCODERS.append(('br', brotli_compress))
+ENCODERS.append(('gzip', gzip_compress))
+
+cache = DiskCache(COMPRESSION_CACHE, COMPRESSION_CACHE_SIZE) if COMPRESSION_CACHE else None
+
+def _cache_key(data, encoding):
+    # Include the settings that change the output.
+    if encoding == 'gzip':
+        level = 'zopfli' if ZOPFLI_INSTALLED else GZIP_LEVEL
+    else:
+        level = BROTLI_LEVEL
+    return "%s.%s%s" % (hashlib.md5(data).hexdigest(), encoding, level)
+
+def compress(data, encoding='gzip', store=True):
+    """
+    Returns data compressed with the given Content-Encoding, using the cache
+    if possible. If store is False, a result that wasn't cached already
+    isn't added to the cache.
+    """
+    compressor = dict(ENCODERS)[encoding]
+    if cache is None:
+        return compressor(data)
+
+    key = _cache_key(data, encoding)
+    compressed = cache.get(key)
+    if compressed is None:
+        compressed = compressor(data)
+        if store:
+            cache.set(key, compressed)
+    return compressed
+
+def is_compressible(content_type):
+    return content_type in TYPES_TO_COMPRESS
+
+def variants(data, content_type):
+    """
+    Returns a dict of Content-Encoding -> compressed data for every
+    encoding available, or an empty dict if the content type isn't worth
+    compressing.
+    """
+    if not is_compressible(content_type):
+        return {}
+    return dict((encoding, compress(data, encoding)) for encoding, c in ENCODERS)
+
+def parse_accept_encoding(header):
+    """
+    Returns a dict of coding -> qvalue for every coding an Accept-Encoding
+    header lists, including those it refuses with q=0.
+    """
+    qvalues = {}
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            name, sep, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    return qvalues
+
+def best_encoding(accept_encoding, content_type):
+    """
+    Returns the best Content-Encoding we can produce for a client sending
+    the given Accept-Encoding header, or None to send the data as-is.
+    """
+    if not is_compressible(content_type):
+        return None
+    qvalues = parse_accept_encoding(accept_encoding)
+    for encoding, compressor in ENCODERS:
+        # A coding named explicitly (IE: gzip;q=0) overrides '*'.
+        if qvalues.get(encoding, qvalues.get('*', 0)) > 0:
+            return encoding
+    return None
@@ -0,0 +1,112 @@
+"""
+A minimal S3 server on localhost for the benchmarks and the tests, so
+neither need AWS.
+"""
+import BaseHTTPServer
+import hashlib
+import SocketServer
+import threading
+import time
+import urlparse
+
+class FakeS3Server(object):
+    """
+    A minimal S3 stand-in: path style buckets and keys, kept in memory,
+    over keep-alive HTTP. Counts connections and requests.
+    """
+    def __init__(self):
+        self.buckets = {}
+        # (bucket, key) -> when it was last written to.
+        self.modified = {}
+        self.created = []
+        self.connections = 0
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send responses in one go, so that small writes don't wait on
+            # delayed ACKs.
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                fake.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body='', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def target(self):
+                fake.requests.append(self.command)
+                path = urlparse.urlparse(self.path)[2]
+                bucket, sep, key = path.lstrip('/').partition('/')
+                return bucket, key
+
+            def do_PUT(self):
+                bucket, key = self.target()
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not key:
+                    fake.created.append(bucket)
+                    fake.buckets.setdefault(bucket, {})
+                    return self.respond(200)
+                meta = dict((h, v) for h, v in self.headers.items()
+                            if h.startswith('x-amz-meta-'))
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                fake.buckets[bucket][key] = (body, etag, meta)
+                fake.modified[(bucket, key)] = time.time()
+                self.respond(200, headers={'ETag': etag})
+
+            def do_DELETE(self):
+                bucket, key = self.target()
+                fake.buckets.get(bucket, {}).pop(key, None)
+                self.respond(204)
+
+            def do_GET(self):
+                bucket, key = self.target()
+                if bucket not in fake.buckets:
+                    return self.respond(404, '<Error><Code>NoSuchBucket</Code></Error>')
+                if key:
+                    return self.do_HEAD()
+                prefix = urlparse.parse_qs(urlparse.urlparse(self.path)[4]).get('prefix', [''])[0]
+                contents = ''.join(
+                    '<Contents><Key>%s</Key><ETag>%s</ETag><Size>%d</Size>'
+                    '<LastModified>%s</LastModified></Contents>'
+                    % (name, etag, len(body), time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                                            time.gmtime(fake.modified[(bucket, name)])))
+                    for name, (body, etag, meta) in sorted(fake.buckets[bucket].items())
+                    if name.startswith(prefix))
+                self.respond(200, '<?xml version="1.0" encoding="UTF-8"?>'
+                             '<ListBucketResult><Name>%s</Name><IsTruncated>false</IsTruncated>'
+                             '%s</ListBucketResult>' % (bucket, contents))
+
+            def do_HEAD(self):
+                bucket, key = self.target()
+                if key not in fake.buckets.get(bucket, {}):
+                    return self.respond(404)
+                body, etag, meta = fake.buckets[bucket][key]
+                headers = dict(meta)
+                headers['ETag'] = etag
+                self.respond(200, body, headers)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
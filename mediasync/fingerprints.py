@@ -0,0 +1,104 @@
+"""
+Fingerprinting gives every synced asset a second, content-hashed name
+(IE: css/site.3f2a9c1b7d4e.css). sync() writes a manifest mapping each
+logical path to its fingerprinted one, and the template tags look paths up
+in it so that pages always point at the exact version that was synced.
+"""
+import os
+import tempfile
+import threading
+from django.utils import simplejson
+from mediasync.msettings import FINGERPRINT_MANIFEST, FINGERPRINT_LENGTH
+
+_lock = threading.Lock()
+# Logical path -> fingerprinted path, loaded on first use.
+_manifest = None
+# Bumped whenever the manifest in use changes, so anything derived from it
+# (like pre-rendered template tags) knows to recompute.
+generation = 0
+
+def fingerprint_path(path, checksum):
+    """
+    Returns the fingerprinted version of path for content with the given
+    MD5 hexdigest.
+    """
+    root, ext = os.path.splitext(path)
+    return "%s.%s%s" % (root, checksum[:FINGERPRINT_LENGTH], ext)
+
+def logical_path(path):
+    """
+    Returns the path a fingerprinted path was made from, or None if path
+    doesn't look fingerprinted.
+    """
+    root, ext = os.path.splitext(path)
+    root, sep, checksum = root.rpartition('.')
+    if not sep or len(checksum) != FINGERPRINT_LENGTH or checksum.strip('0123456789abcdef'):
+        return None
+    return root + ext
+
+def load(path=None):
+    """
+    Reads a fingerprint manifest from disk. Returns an empty dict if there
+    isn't one.
+    """
+    try:
+        f = open(path or FINGERPRINT_MANIFEST, 'rb')
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def save(mapping, path=None):
+    """
+    Atomically writes a fingerprint manifest to disk and makes it the one
+    used by this process.
+    """
+    global _manifest, generation
+    path = path or FINGERPRINT_MANIFEST
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.fingerprints')
+    f = os.fdopen(fd, 'wb')
+    try:
+        simplejson.dump(mapping, f, sort_keys=True, indent=1)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+
+    _manifest = dict(mapping)
+    generation += 1
+
+def get_manifest():
+    """
+    Returns the fingerprint manifest for this process, loading it from
+    disk the first time.
+    """
+    global _manifest, generation
+    if _manifest is None:
+        _lock.acquire()
+        try:
+            if _manifest is None:
+                _manifest = load()
+                generation += 1
+        finally:
+            _lock.release()
+    return _manifest
+
+def resolve(path):
+    """
+    Returns the fingerprinted path for the given logical path (relative to
+    the media root), or None if it isn't in the manifest.
+    """
+    return get_manifest().get(path.strip('/'))
+
+def reset():
+    """
+    Forgets the loaded manifest so that it is read again on next use.
+    """
+    global _manifest, generation
+    _manifest = None
+    generation += 1
@@ -0,0 +1,136 @@
+"""
+The change journal is a snapshot of the media tree as of the last successful
+sync: the size, mtime and inode of every static file, and the JOINED setting.
+An incremental sync compares a fresh snapshot with it and only reads and
+processes the files that changed, instead of every file in the tree.
+"""
+import os
+import subprocess
+import tempfile
+from django.utils import simplejson
+
+JOURNAL_VERSION = 1
+
+def file_state(st):
+    """
+    Returns what the journal records about a file, given its os.stat() result.
+    """
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+def scan(files):
+    """
+    Returns a snapshot (a dict of remote path -> file state) of the given
+    (remote_path, filepath) pairs.
+    """
+    snapshot = {}
+    for remote_path, filepath in files:
+        try:
+            snapshot[remote_path] = file_state(os.stat(filepath))
+        except OSError:
+            # Removed while we were looking.
+            pass
+    return snapshot
+
+def git_changes(media_root, since):
+    """
+    Returns the paths, relative to media_root, of every file that git says
+    changed between the since revision and the working tree. Deleted and
+    renamed files are included under their old names.
+    """
+    from mediasync import SyncException
+    try:
+        proc = subprocess.Popen(['git', 'diff', '--name-only', '--relative',
+                                 '--no-renames', since, '--', '.'],
+                                cwd=media_root, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    except OSError, e:
+        raise SyncException("Could not run git: %s" % e)
+    if proc.returncode != 0:
+        raise SyncException("git diff %s failed: %s" % (since, err.strip()))
+    return [line for line in out.splitlines() if line]
+
+def joined_state(joined):
+    """
+    Returns the JOINED setting the way it's stored in the journal.
+    """
+    return dict((joinfile, list(sourcefiles)) for joinfile, sourcefiles in joined.items())
+
+class Journal(object):
+    """
+    The snapshot taken at the end of the last sync. Like the sync manifest,
+    it is only trusted if it was written for the same sync target.
+    """
+    def __init__(self, path, target=None):
+        self.path = path
+        self.target = target
+        self.files = {}
+        self.joined = None
+
+    def load(self):
+        """
+        Reads the journal from disk. A missing, unreadable or foreign journal
+        leaves this one empty, so every file looks changed.
+        """
+        self.files = {}
+        self.joined = None
+        try:
+            f = open(self.path, 'rb')
+            try:
+                data = simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return self
+
+        if data.get('version') == JOURNAL_VERSION and data.get('target') == self.target:
+            self.files = data.get('files', {})
+            self.joined = data.get('joined')
+        return self
+
+    def save(self):
+        """
+        Atomically writes the journal to disk.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        data = {
+            'version': JOURNAL_VERSION,
+            'target': self.target,
+            'files': self.files,
+            'joined': self.joined,
+        }
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.journal')
+        f = os.fdopen(fd, 'wb')
+        try:
+            simplejson.dump(data, f, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmppath, self.path)
+
+    def changed(self, snapshot):
+        """
+        Returns the set of paths in snapshot that are new or differ from the
+        journal.
+        """
+        return set(path for path, state in snapshot.items()
+                   if self.files.get(path) != state)
+
+    def removed(self, snapshot):
+        """
+        Returns the set of paths in the journal that aren't in snapshot.
+        """
+        return set(self.files) - set(snapshot)
+
+    def update(self, files):
+        """
+        Returns a snapshot made by re-examining just the given
+        (remote_path, filepath) pairs and assuming nothing else changed.
+        """
+        snapshot = dict(self.files)
+        for remote_path, filepath in files:
+            snapshot.pop(remote_path, None)
+        snapshot.update(scan(files))
+        return snapshot
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from optparse import make_option
+from mediasync import benchmarks
+
+class Command(BaseCommand):
+
+    help = "Time mediasync's hot paths on a synthetic media tree and print the results as JSON"
+    args = '[options]'
+
+    requires_model_validation = False
+
+    option_list = BaseCommand.option_list + (
+        make_option("-b", "--benchmark", dest="names", action="append", metavar="NAME",
+                    help="benchmark to run (may be given more than once; defaults to all of them)"),
+        make_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="run each benchmark this many times"),
+        make_option("-w", "--workers", dest="workers", type="int", default=1,
+                    help="number of sync workers for the sync benchmarks"),
+        make_option("--dirs", dest="dirs", type="int",
+                    help="subdirectories per directory in the media tree"),
+        make_option("--depth", dest="depth", type="int",
+                    help="levels of subdirectories in the media tree"),
+        make_option("--files", dest="files", type="int",
+                    help="files of each kind per directory"),
+        make_option("--size", dest="size", type="int",
+                    help="size of each file in bytes"),
+        make_option("--joined", dest="joined", type="int",
+                    help="source files per joined file"),
+        make_option("-o", "--output", dest="output", metavar="FILE",
+                    help="write the results to FILE instead of printing them"),
+    )
+
+    def handle(self, *args, **options):
+
+        names = options.get('names')
+        repeat = options.get('repeat')
+        workers = options.get('workers')
+
+        known = [name for name, benchmark in benchmarks.BENCHMARKS]
+        for name in names or ():
+            if name not in known:
+                raise CommandError('%s is not a benchmark; choose from %s' % (name, ', '.join(known)))
+        if repeat < 1:
+            raise CommandError('--repeat must be at least 1')
+        if workers < 1:
+            raise CommandError('--workers must be at least 1')
+
+        tree = {}
+        for option in benchmarks.DEFAULT_TREE:
+            value = options.get(option)
+            if value is not None:
+                if value < 0:
+                    raise CommandError('--%s can not be negative' % option)
+                tree[option] = value
+
+        results = simplejson.dumps(benchmarks.run(names, repeat, workers, **tree),
+                                   indent=1, sort_keys=True)
+        if options.get('output'):
+            f = open(options['output'], 'w')
+            try:
+                f.write(results + '\n')
+            finally:
+                f.close()
+        else:
+            print results
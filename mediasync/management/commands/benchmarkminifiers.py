@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from optparse import make_option
+from mediasync import minifiers, static_files
+from mediasync.msettings import MEDIA_ROOT
+
+class Command(BaseCommand):
+
+    help = "Compare the CSS and JavaScript minifier engines on local media"
+    args = '[options]'
+
+    requires_model_validation = False
+
+    option_list = BaseCommand.option_list + (
+        make_option("-e", "--engine", dest="engines", action="append", metavar="ENGINE",
+                    help="engine to try (may be given more than once; defaults to every installed engine)"),
+        make_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="minify the files this many times with each engine and keep the best time"),
+        make_option("--json", dest="json", action="store_true",
+                    help="print the results as JSON"),
+    )
+
+    def handle(self, *args, **options):
+
+        engines = options.get('engines')
+        repeat = options.get('repeat')
+
+        if repeat < 1:
+            raise CommandError('--repeat must be at least 1')
+        for name in engines or ():
+            if name not in minifiers.ENGINES:
+                raise CommandError('%s is not a minifier engine; choose from %s' % (
+                    name, ', '.join(sorted(minifiers.ENGINES))))
+
+        files = []
+        for remote_path, filepath in static_files(MEDIA_ROOT):
+            kind = remote_path.rsplit('.', 1)[-1].lower()
+            if kind in minifiers.KINDS:
+                f = open(filepath, 'rb')
+                try:
+                    files.append((kind, f.read()))
+                finally:
+                    f.close()
+        if not files:
+            raise CommandError('No CSS or JavaScript files in %s' % MEDIA_ROOT)
+
+        results = minifiers.benchmark(files, engines, repeat)
+
+        if options.get('json'):
+            print simplejson.dumps(results, indent=1)
+            return
+
+        for result in results:
+            print "%-8s %-3s %4d files %10d -> %10d bytes (%5.1f%%) %8.2f MB/s" % (
+                result['engine'], result['kind'], result['files'],
+                result['size'], result['minified_size'],
+                100.0 * result['minified_size'] / (result['size'] or 1),
+                (result['throughput'] or 0) / (1024 * 1024))
@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
 import mediasync
+from mediasync import backends, compression, prune
+from mediasync.stats import SyncStats
 
 class Command(BaseCommand):
     
@@ -11,13 +13,133 @@ class Command(BaseCommand):
     
     option_list = BaseCommand.option_list + (
         make_option("-F", "--force", dest="force", help="force files to sync", action="store_true"),
+        make_option("-w", "--workers", dest="workers", type="int",
+                    help="number of files to upload at once (defaults to MEDIASYNC['SYNC_WORKERS'])"),
+        make_option("-p", "--process-workers", dest="process_workers", type="int",
+                    help="number of processes to run processors in (defaults to MEDIASYNC['SYNC_PROCESS_WORKERS'])"),
+        make_option("-i", "--incremental", dest="incremental", action="store_true",
+                    help="only look at files that changed since the last sync"),
+        make_option("--since", dest="since", metavar="REVISION",
+                    help="only look at files git says changed since REVISION (implies --incremental)"),
+        make_option("--watch", dest="watch", action="store_true",
+                    help="keep running and sync files as they change"),
+        make_option("--poll", dest="poll", type="float", metavar="SECONDS",
+                    help="with --watch, poll for changes every SECONDS instead of using inotify"),
+        make_option("--verify", dest="verify", action="store_true",
+                    help="check files against remote storage instead of the local manifest"),
+        make_option("--resume", dest="resume", action="store_true",
+                    help="skip the files a failed sync already uploaded"),
+        make_option("--stats", dest="stats", action="store_true",
+                    help="print counters and per-phase timings once the sync is done"),
+        make_option("--stats-json", dest="stats_json", metavar="FILE",
+                    help="write counters and per-phase timings to FILE as JSON ('-' for standard output)"),
+        make_option("--prune", dest="prune", action="store_true",
+                    help="delete remote files that are no longer synced, once MEDIASYNC['PRUNE_GRACE'] has passed"),
+        make_option("--clear-cache", dest="clear_cache", action="store_true",
+                    help="empty the processor and compression caches and exit"),
+        make_option("-n", "--dry-run", "--plan", dest="dry_run", action="store_true",
+                    help="show what would be uploaded without uploading anything"),
+        make_option("--json", dest="json", action="store_true",
+                    help="print the --dry-run plan as JSON"),
+        make_option("--bandwidth", dest="bandwidth", type="float",
+                    help="upload speed in Mbit/s to estimate --dry-run transfer time with"),
+        make_option("--latency", dest="latency", type="float",
+                    help="time per request in milliseconds to estimate --dry-run transfer time with"),
     )
     
     def handle(self, *args, **options):
         
+        if options.get('clear_cache'):
+            for cache in (backends.processor_cache, compression.cache):
+                if cache is not None:
+                    cache.clear()
+            return
+        
         force = options.get('force') or False
+        workers = options.get('workers')
+        process_workers = options.get('process_workers')
+        verify = options.get('verify') or False
+        dry_run = options.get('dry_run') or False
+        incremental = options.get('incremental') or False
+        since = options.get('since')
+        resume = options.get('resume') or False
+        bandwidth = options.get('bandwidth')
+        latency = options.get('latency')
+        
+        if workers is not None and workers < 1:
+            raise CommandError('--workers must be at least 1')
+        if process_workers is not None and process_workers < 1:
+            raise CommandError('--process-workers must be at least 1')
+        if bandwidth is not None and bandwidth <= 0:
+            raise CommandError('--bandwidth must be more than 0')
+        if latency is not None and latency < 0:
+            raise CommandError('--latency can not be negative')
+        
+        if bandwidth is not None:
+            # Mbit/s to bytes per second.
+            bandwidth = bandwidth * 1000 * 1000 / 8
+        if latency is not None:
+            latency = latency / 1000
+        
+        if options.get('watch'):
+            from mediasync import signals
+            from mediasync.watch import watch
+            def write_stats(sender, stats, **kwargs):
+                self.write_stats(stats, options)
+            # Report on every sync while watching.
+            signals.post_sync.connect(write_stats)
+            try:
+                watch(interval=options.get('poll'), workers=workers,
+                      process_workers=process_workers)
+            except KeyboardInterrupt:
+                pass
+            except mediasync.SyncException, se:
+                raise CommandError(str(se))
+            return
         
+        sync_stats = SyncStats()
         try:
-            mediasync.sync(force=force)
-        except ValueError, ve:
-            raise CommandError('%s\nUsage is mediasync %s' % (ve.message, self.args))
\ No newline at end of file
+            try:
+                plan = mediasync.sync(force=force, workers=workers, verify=verify,
+                                      process_workers=process_workers,
+                                      dry_run=dry_run, incremental=incremental,
+                                      since=since, resume=resume,
+                                      sync_stats=sync_stats)
+                if dry_run:
+                    if options.get('json'):
+                        print plan.to_json(bandwidth, latency)
+                    else:
+                        print plan.report(bandwidth, latency)
+                if options.get('prune'):
+                    self.prune(dry_run)
+            except mediasync.SyncException, se:
+                raise CommandError(str(se))
+            except ValueError, ve:
+                raise CommandError('%s\nUsage is mediasync %s' % (ve.message, self.args))
+        finally:
+            # Also wanted when the sync failed.
+            self.write_stats(sync_stats, options)
+    
+    def prune(self, dry_run):
+        try:
+            (deleted, waiting) = prune.prune(dry_run=dry_run)
+        except NotImplementedError:
+            raise CommandError("The backend can't prune remote files")
+        label = 'would delete' if dry_run else 'deleted'
+        for remote_path in deleted:
+            print "[%s] %s" % (label, remote_path)
+        if waiting:
+            print "%d orphaned files are within the grace period" % len(waiting)
+    
+    def write_stats(self, sync_stats, options):
+        if options.get('stats'):
+            print sync_stats.report()
+        path = options.get('stats_json')
+        if path == '-':
+            print sync_stats.to_json()
+        elif path:
+            f = open(path, 'w')
+            try:
+                f.write(sync_stats.to_json() + '\n')
+            finally:
+                f.close()
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""
+The sync manifest is a local record of what was pushed to the backend during
+the last successful sync. sync() uses it to skip files that haven't changed
+without asking the backend about them.
+"""
+import os
+import tempfile
+import threading
+from django.utils import simplejson
+
+MANIFEST_VERSION = 2
+
+class Manifest(object):
+    """
+    Maps remote paths to a dict describing what was last synced there:
+
+      checksum: MD5 hexdigest of the processed file data.
+      size: Size of the source file in bytes (None for joined files).
+      mtime: Modification time of the source file (None for joined files).
+      content_encoding: Content-Encoding the backend stored the file with.
+      sources: For joined files, a list of [path, size, mtime, checksum]
+               for the files it was built from, in the order they were
+               joined (see mediasync.bundles).
+      assets: A dict of path -> [size, mtime, checksum] for the files the
+              processed data depends on (IE: the images a stylesheet
+              refers to; see mediasync.assets).
+
+    Entries are only trusted if the manifest was written for the same sync
+    target (see manifest_target()), so switching buckets, backends or
+    processors doesn't cause files to be skipped.
+    """
+    def __init__(self, path, target=None):
+        self.path = path
+        self.target = target
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the manifest from disk. A missing, unreadable or foreign
+        manifest leaves this one empty.
+        """
+        self.files = {}
+        try:
+            f = open(self.path, 'rb')
+            try:
+                data = simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return self
+
+        if data.get('version') == MANIFEST_VERSION and data.get('target') == self.target:
+            self.files = data.get('files', {})
+        return self
+
+    def save(self):
+        """
+        Atomically writes the manifest to disk.
+        """
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self._lock.acquire()
+        try:
+            data = {
+                'version': MANIFEST_VERSION,
+                'target': self.target,
+                'files': self.files,
+            }
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='.manifest')
+            f = os.fdopen(fd, 'wb')
+            try:
+                simplejson.dump(data, f, sort_keys=True)
+            finally:
+                f.close()
+            os.rename(tmppath, self.path)
+        finally:
+            self._lock.release()
+
+    def get(self, remote_path):
+        return self.files.get(remote_path)
+
+    def set(self, remote_path, checksum, size=None, mtime=None, content_encoding=None,
+            sources=None, assets=None):
+        self._lock.acquire()
+        try:
+            self.files[remote_path] = {
+                'checksum': checksum,
+                'size': size,
+                'mtime': mtime,
+                'content_encoding': content_encoding,
+                'sources': sources,
+                'assets': assets,
+            }
+        finally:
+            self._lock.release()
+
+    def is_unchanged(self, remote_path, size, mtime):
+        """
+        Returns True if the source file's size and mtime match what was
+        recorded for remote_path, meaning it doesn't even need to be read.
+        """
+        entry = self.files.get(remote_path)
+        if entry is None or size is None:
+            return False
+        return entry['size'] == size and entry['mtime'] == mtime
+
+    def is_current(self, remote_path, checksum, content_encoding=None):
+        """
+        Returns True if the processed data for remote_path has the same
+        checksum and encoding as what was last synced.
+        """
+        entry = self.files.get(remote_path)
+        if entry is None:
+            return False
+        return entry['checksum'] == checksum and \
+            entry['content_encoding'] == content_encoding
+
+def sync_target(client):
+    """
+    Returns a string identifying where the given client syncs to.
+    """
+    return "%s %s" % (client.__class__.__module__, client.remote_location())
+
+def manifest_target(client):
+    """
+    Returns sync_target() along with the client's processor chain. The sync
+    manifest and change journal record what processed files were synced, so
+    changing the processors (or the version of a minifier engine) means
+    every file has to be processed again.
+    """
+    return "%s %s" % (sync_target(client), client.processor_chain)
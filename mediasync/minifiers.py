@@ -0,0 +1,281 @@
+"""
+CSS and JavaScript minifier engines, used by the css_minifier and js_minifier
+processors. The engine for each kind of file is picked with the CSS_MINIFIER
+and JS_MINIFIER settings:
+
+  slimmer: the pure Python slimmer package.
+  rcssmin, rjsmin: much faster, using their C extensions if they were built.
+  command: an external program (MINIFIER_COMMANDS), started once per thread
+           and fed one file after another.
+
+By default the fastest installed engine is used. ./manage.py benchmarkminifiers
+compares the engines on the files in the media root.
+"""
+import atexit
+import os
+import subprocess
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from mediasync.msettings import CSS_MINIFIER, JS_MINIFIER, MINIFIER_COMMANDS
+
+KINDS = ('css', 'js')
+
+class Engine(object):
+    """
+    Minifies CSS, JavaScript or both.
+    """
+    name = None
+
+    def available(self, kind):
+        """
+        Returns True if the engine is installed and can minify this kind of
+        file.
+        """
+        return False
+
+    def version(self, kind):
+        """
+        Returns a string that changes whenever the engine's output might.
+        """
+        return ''
+
+    def minify(self, kind, filedata):
+        raise NotImplementedError
+
+class SlimmerEngine(Engine):
+    name = 'slimmer'
+
+    def _module(self):
+        try:
+            import slimmer
+        except ImportError:
+            return None
+        return slimmer
+
+    def available(self, kind):
+        return kind in KINDS and self._module() is not None
+
+    def version(self, kind):
+        return getattr(self._module(), '__version__', '')
+
+    def minify(self, kind, filedata):
+        slimmer = self._module()
+        if kind == 'css':
+            return slimmer.css_slimmer(filedata)
+        return slimmer.js_slimmer(filedata)
+
+class ModuleEngine(Engine):
+    """
+    A module with a function that takes a string and returns it minified
+    (IE: rcssmin.cssmin).
+    """
+    def __init__(self, name, kind, function):
+        self.name = name
+        self.kind = kind
+        self.function = function
+
+    def _module(self):
+        try:
+            return import_module(self.name)
+        except ImportError:
+            return None
+
+    def available(self, kind):
+        return kind == self.kind and self._module() is not None
+
+    def version(self, kind):
+        return getattr(self._module(), '__version__', '')
+
+    def minify(self, kind, filedata):
+        return getattr(self._module(), self.function)(filedata)
+
+class CommandWorker(object):
+    """
+    A running minifier program. For each file, it is sent a line with the
+    number of bytes that follow, then the file. It must answer with a line of
+    "ok <length>" followed by the minified file, or "error <length>" followed
+    by a message, and then wait for the next file.
+    """
+    def __init__(self, args):
+        self.args = args
+        # Workers aren't shared with forked processor workers.
+        self.pid = os.getpid()
+        try:
+            self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, close_fds=True)
+        except OSError, e:
+            from mediasync import SyncException
+            raise SyncException("Could not run %s: %s" % (args[0], e))
+
+    def minify(self, filedata):
+        """
+        Returns an (ok, data) tuple of whether the file was minified, and
+        either the minified file or the error message.
+        """
+        from mediasync import SyncException
+        try:
+            self.proc.stdin.write("%d\n" % len(filedata))
+            self.proc.stdin.write(filedata)
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+        except IOError, e:
+            raise SyncException("%s failed: %s" % (self.args[0], e))
+        if len(header) != 2 or header[0] not in ('ok', 'error'):
+            raise SyncException("%s gave an invalid response" % self.args[0])
+        body = self.proc.stdout.read(int(header[1]))
+        if len(body) != int(header[1]):
+            raise SyncException("%s exited unexpectedly" % self.args[0])
+        return (header[0] == 'ok', body)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+
+class CommandEngine(Engine):
+    """
+    Hands files to the programs in MINIFIER_COMMANDS, a dict of kind ('css'
+    or 'js') -> argument list. Each thread gets a worker of its own.
+    """
+    name = 'command'
+
+    def __init__(self):
+        self._local = threading.local()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def available(self, kind):
+        return bool(MINIFIER_COMMANDS.get(kind))
+
+    def version(self, kind):
+        return ' '.join(MINIFIER_COMMANDS.get(kind, ()))
+
+    def _worker(self, kind):
+        workers = getattr(self._local, 'workers', None)
+        if workers is None:
+            workers = self._local.workers = {}
+        worker = workers.get(kind)
+        if worker is None or worker.pid != os.getpid():
+            worker = workers[kind] = CommandWorker(list(MINIFIER_COMMANDS[kind]))
+            self._lock.acquire()
+            try:
+                self._workers.append(worker)
+            finally:
+                self._lock.release()
+        return worker
+
+    def minify(self, kind, filedata):
+        try:
+            worker = self._worker(kind)
+            (ok, data) = worker.minify(filedata)
+        except:
+            # Start over with a fresh worker next time.
+            worker = getattr(self._local, 'workers', {}).pop(kind, None)
+            if worker is not None and worker.proc.poll() is None:
+                worker.proc.kill()
+            raise
+        if not ok:
+            from mediasync import SyncException
+            raise SyncException("%s failed: %s" % (worker.args[0], data))
+        return data
+
+    def close(self):
+        """
+        Stops every worker this process started.
+        """
+        self._lock.acquire()
+        try:
+            workers = [worker for worker in self._workers if worker.pid == os.getpid()]
+            self._workers = []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            worker.close()
+        self._local = threading.local()
+
+ENGINES = {
+    'slimmer': SlimmerEngine(),
+    'rcssmin': ModuleEngine('rcssmin', 'css', 'cssmin'),
+    'rjsmin': ModuleEngine('rjsmin', 'js', 'jsmin'),
+    'command': CommandEngine(),
+}
+atexit.register(ENGINES['command'].close)
+
+# Tried in order when no engine is configured, fastest first.
+DEFAULT_ENGINES = {
+    'css': ('rcssmin', 'slimmer'),
+    'js': ('rjsmin', 'slimmer'),
+}
+
+def get_engine(kind):
+    """
+    Returns the engine configured for a kind of file, or the fastest one
+    installed if there isn't one. Returns None if nothing can minify it.
+    """
+    name = {'css': CSS_MINIFIER, 'js': JS_MINIFIER}[kind]
+    if name is None:
+        for name in DEFAULT_ENGINES[kind]:
+            if ENGINES[name].available(kind):
+                return ENGINES[name]
+        return None
+    engine = ENGINES.get(name)
+    if engine is None:
+        raise ImproperlyConfigured("%s is not a mediasync minifier engine" % name)
+    if not engine.available(kind):
+        raise ImproperlyConfigured("The %s minifier engine can't minify %s; "
+                                   "is it installed?" % (name, kind))
+    return engine
+
+def engine_version(kind):
+    """
+    Returns a string identifying the configured engine and its version, for
+    the processor cache.
+    """
+    engine = get_engine(kind)
+    if engine is None:
+        return ''
+    return "%s %s" % (engine.name, engine.version(kind))
+
+def benchmark(files, engines=None, repeat=1):
+    """
+    Minifies files with each engine and returns a list of results, one dict
+    per engine and kind, with the number of files and bytes in and out, the
+    best time of repeat runs, and the throughput in bytes per second.
+
+    args:
+      files: A list of (kind, filedata) tuples.
+      engines: (list) Names of the engines to try. Defaults to every one
+                      that's installed.
+      repeat: (int) How many times to minify the files with each engine.
+    """
+    results = []
+    for name in sorted(engines or ENGINES):
+        engine = ENGINES[name]
+        for kind in KINDS:
+            data = [filedata for k, filedata in files if k == kind]
+            if not data or not engine.available(kind):
+                continue
+            best = None
+            for i in range(max(repeat, 1)):
+                start = time.time()
+                size_out = sum(len(engine.minify(kind, filedata)) for filedata in data)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            size_in = sum(len(filedata) for filedata in data)
+            results.append({
+                'engine': name,
+                'version': engine.version(kind),
+                'kind': kind,
+                'files': len(data),
+                'size': size_in,
+                'minified_size': size_out,
+                'seconds': best,
+                'throughput': size_in / best if best else None,
+            })
+    ENGINES['command'].close()
+    return results
@@ -1,6 +1,8 @@
 """
 Mediasync configuration.
 """
+import os
+
 try:
     from django.conf import settings
     __settings_dict = getattr(settings, 'MEDIASYNC', {})
@@ -36,14 +38,82 @@ JS_PATH = __settings_dict.get("JS_PATH", "")
 JOINED = __settings_dict.get("JOINED", {})
 SERVE_REMOTE = __settings_dict.get("SERVE_REMOTE", False)
 EMULATE_COMBO = __settings_dict.get("EMULATE_COMBO", False)
+# Where combo files generated by the local serving view are cached: 'memory'
+# (per process), 'django' (Django's cache framework) or None.
+COMBO_CACHE = __settings_dict.get("COMBO_CACHE", 'memory')
 DOCTYPE = __settings_dict.get("DOCTYPE", "xhtml")
 URL_PROCESSOR = __settings_dict.get("URL_PROCESSOR", lambda x: x)
 CACHE_BUSTER = __settings_dict.get("CACHE_BUSTER", None)
+# Render template tags once and reuse the markup. Turn this off if your
+# CACHE_BUSTER or URL_PROCESSOR returns different values from call to call.
+TAG_RENDER_CACHE = __settings_dict.get("TAG_RENDER_CACHE", True)
 USE_SSL = __settings_dict.get("USE_SSL", None)
 EXPIRATION_DAYS = __settings_dict.get("EXPIRATION_DAYS", 365)
 MEDIA_ROOT = __settings_dict.get('MEDIA_ROOT', getattr(settings, 'MEDIA_ROOT', ''))
 MEDIA_URL = __settings_dict.get('MEDIA_URL', getattr(settings, 'MEDIA_URL', ''))
 PROCESSORS = __settings_dict.get("PROCESSORS", DEFAULT_PROCESSORS)
+SYNC_WORKERS = __settings_dict.get("SYNC_WORKERS", 1)
+SYNC_PROCESS_WORKERS = __settings_dict.get("SYNC_PROCESS_WORKERS", 1)
+# Failed uploads are retried up to SYNC_RETRIES times, waiting a random time
+# of up to SYNC_RETRY_BACKOFF seconds, doubling with every attempt (but no
+# more than SYNC_RETRY_MAX_BACKOFF), in between.
+SYNC_RETRIES = __settings_dict.get("SYNC_RETRIES", 4)
+SYNC_RETRY_BACKOFF = __settings_dict.get("SYNC_RETRY_BACKOFF", 0.5)
+SYNC_RETRY_MAX_BACKOFF = __settings_dict.get("SYNC_RETRY_MAX_BACKOFF", 30)
+# Number of files that may still fail after retrying before sync() gives up.
+# sync() always raises if any file failed, but only once it has tried the rest.
+SYNC_FAILURE_BUDGET = __settings_dict.get("SYNC_FAILURE_BUDGET", 0)
+# Local bookkeeping (the sync manifest and friends) lives here. sync() never
+# uploads this directory, or the processor and compression caches, even when
+# they are under the media root.
+STATE_DIR = __settings_dict.get("STATE_DIR", os.path.join(MEDIA_ROOT, '.mediasync'))
+MANIFEST = __settings_dict.get("MANIFEST", os.path.join(STATE_DIR, 'manifest.json'))
+# Uploads completed by a sync that's in progress (or that failed), so that
+# syncmedia --resume can carry on where it stopped. Saved every
+# CHECKPOINT_INTERVAL seconds.
+CHECKPOINT = __settings_dict.get("CHECKPOINT", os.path.join(STATE_DIR, 'checkpoint.json'))
+CHECKPOINT_INTERVAL = __settings_dict.get("CHECKPOINT_INTERVAL", 5)
+# Snapshot of the media tree at the last sync, used by incremental syncs.
+JOURNAL = __settings_dict.get("JOURNAL", os.path.join(STATE_DIR, 'journal.json'))
+# syncmedia --watch polls the tree this often (in seconds) when inotify isn't
+# available, and waits WATCH_DELAY seconds for a burst of changes to settle.
+WATCH_INTERVAL = __settings_dict.get("WATCH_INTERVAL", 1.0)
+WATCH_DELAY = __settings_dict.get("WATCH_DELAY", 0.25)
+# Files larger than this many bytes are streamed to the backend instead of
+# being read into memory. Processors are not applied to them.
+STREAM_THRESHOLD = __settings_dict.get("STREAM_THRESHOLD", 8 * 1024 * 1024)
+# Also sync every file under a content-hashed name, and have the template tags
+# point at those names. The manifest must be deployed along with the site.
+FINGERPRINT = __settings_dict.get("FINGERPRINT", False)
+FINGERPRINT_MANIFEST = __settings_dict.get("FINGERPRINT_MANIFEST", os.path.join(STATE_DIR, 'fingerprints.json'))
+FINGERPRINT_LENGTH = __settings_dict.get("FINGERPRINT_LENGTH", 12)
+# The css_urls processor inlines files of up to this many bytes that
+# stylesheets refer to as data URIs. 0 turns inlining off.
+CSS_INLINE_THRESHOLD = __settings_dict.get("CSS_INLINE_THRESHOLD", 0)
+# syncmedia --prune deletes remote files that are no longer synced, but only
+# once they have gone unsynced for PRUNE_GRACE seconds, and it keeps the
+# PRUNE_KEEP_FINGERPRINTS newest fingerprinted versions of each file, so
+# that pages in caches still find the files they link to. When each file
+# was first found orphaned is kept in PRUNE_STATE.
+PRUNE_GRACE = __settings_dict.get("PRUNE_GRACE", 24 * 3600)
+PRUNE_KEEP_FINGERPRINTS = __settings_dict.get("PRUNE_KEEP_FINGERPRINTS", 2)
+PRUNE_STATE = __settings_dict.get("PRUNE_STATE", os.path.join(STATE_DIR, 'orphans.json'))
+GZIP_LEVEL = __settings_dict.get("GZIP_LEVEL", 9)
+BROTLI_LEVEL = __settings_dict.get("BROTLI_LEVEL", 11)
+COMPRESSION_CACHE = __settings_dict.get("COMPRESSION_CACHE", os.path.join(STATE_DIR, 'compressed'))
+COMPRESSION_CACHE_SIZE = __settings_dict.get("COMPRESSION_CACHE_SIZE", 256 * 1024 * 1024)
+# Processed (IE: minified) files are cached here, keyed by their content and
+# the processors that ran on them. Least recently used entries are evicted
+# once the cache grows past PROCESSOR_CACHE_SIZE bytes.
+PROCESSOR_CACHE = __settings_dict.get("PROCESSOR_CACHE", os.path.join(STATE_DIR, 'processed'))
+PROCESSOR_CACHE_SIZE = __settings_dict.get("PROCESSOR_CACHE_SIZE", 64 * 1024 * 1024)
+# The engines used by the default processors to minify CSS and JavaScript:
+# 'slimmer', 'rcssmin' (CSS), 'rjsmin' (JavaScript) or 'command'. None picks
+# the fastest one installed.
+CSS_MINIFIER = __settings_dict.get("CSS_MINIFIER", None)
+JS_MINIFIER = __settings_dict.get("JS_MINIFIER", None)
+# The programs run by the 'command' engine: 'css' or 'js' -> argument list.
+MINIFIER_COMMANDS = __settings_dict.get("MINIFIER_COMMANDS", {})
 
 """
 S3 Backend Settings
@@ -53,10 +123,42 @@ AWS_SECRET = __settings_dict.get("AWS_SECRET", None)
 AWS_BUCKET = __settings_dict.get('AWS_BUCKET', None)
 AWS_PREFIX = __settings_dict.get('AWS_PREFIX', '').strip('/')
 AWS_BUCKET_CNAME = __settings_dict.get('AWS_BUCKET_CNAME', False)
+AWS_INVENTORY = __settings_dict.get('AWS_INVENTORY', True)
+AWS_INVENTORY_SHARDS = __settings_dict.get('AWS_INVENTORY_SHARDS', 1)
+AWS_MULTIPART_THRESHOLD = __settings_dict.get('AWS_MULTIPART_THRESHOLD', 64 * 1024 * 1024)
+AWS_MULTIPART_CHUNK_SIZE = __settings_dict.get('AWS_MULTIPART_CHUNK_SIZE', 16 * 1024 * 1024)
+# Number of idle S3 connections kept open for reuse.
+AWS_POOL_SIZE = __settings_dict.get('AWS_POOL_SIZE', 10)
+# Where to reach S3. Set AWS_HOST to use an S3-compatible service.
+AWS_HOST = __settings_dict.get('AWS_HOST', None)
+AWS_PORT = __settings_dict.get('AWS_PORT', None)
+AWS_SECURE = __settings_dict.get('AWS_SECURE', True)
 
 """
 Cloud Files Settings
 """
 CLOUDFILES_CONTAINER = __settings_dict.get('CLOUDFILES_CONTAINER', None)
 CLOUDFILES_USERNAME = __settings_dict.get("CLOUDFILES_USERNAME", None)
-CLOUDFILES_KEY = __settings_dict.get("CLOUDFILES_KEY", None)
\ No newline at end of file
+CLOUDFILES_KEY = __settings_dict.get("CLOUDFILES_KEY", None)
+CLOUDFILES_PREFIX = __settings_dict.get('CLOUDFILES_PREFIX', '').strip('/')
+# Where to authenticate. None is the US auth service.
+CLOUDFILES_AUTH_URL = __settings_dict.get('CLOUDFILES_AUTH_URL', None)
+# Talk to Cloud Files over Rackspace's internal network.
+CLOUDFILES_SERVICENET = __settings_dict.get('CLOUDFILES_SERVICENET', False)
+CLOUDFILES_INVENTORY = __settings_dict.get('CLOUDFILES_INVENTORY', True)
+# The container's CDN URLs. Set them for serving; otherwise they are read
+# from CLOUDFILES_CDN_STATE, which sync writes, or as a last resort looked up
+# from the CDN (once per process).
+CLOUDFILES_CDN_URL = __settings_dict.get('CLOUDFILES_CDN_URL', None)
+CLOUDFILES_CDN_SSL_URL = __settings_dict.get('CLOUDFILES_CDN_SSL_URL', None)
+CLOUDFILES_CDN_STATE = __settings_dict.get('CLOUDFILES_CDN_STATE', os.path.join(STATE_DIR, 'cloudfiles_cdn.json'))
+
+"""
+Filesystem Backend Settings
+"""
+# Where releases are written. Point the web server at FILESYSTEM_ROOT/current.
+FILESYSTEM_ROOT = __settings_dict.get('FILESYSTEM_ROOT', None)
+# The URL FILESYSTEM_ROOT/current is served from.
+FILESYSTEM_URL = __settings_dict.get('FILESYSTEM_URL', None)
+# Number of releases kept, including the current one, for rolling back.
+FILESYSTEM_KEEP_RELEASES = __settings_dict.get('FILESYSTEM_KEEP_RELEASES', 3)
@@ -0,0 +1,98 @@
+"""
+A record of what sync() would upload, made by a dry run. Used by
+syncmedia --dry-run to show how much a deploy will send, and roughly how
+long it will take, before anything is written.
+"""
+from django.utils import simplejson
+
+# Assumed when estimating how long the uploads will take.
+DEFAULT_BANDWIDTH = 10 * 1000 * 1000 / 8 # bytes per second (10 Mbit/s)
+DEFAULT_LATENCY = 0.1 # seconds per request
+
+class SyncPlan(object):
+    """
+    The uploads a sync would make, in the order it would make them.
+    """
+    def __init__(self, workers=1):
+        self.workers = max(int(workers or 1), 1)
+        # One dict per remote path that would be written to.
+        self.uploads = []
+        # Number of files that wouldn't need uploading at all.
+        self.unchanged = 0
+
+    def add(self, remote_path, content_type, size, transfer_size, requests):
+        """
+        Records an upload.
+
+        args:
+          remote_path: (str) Where the file would be stored.
+          content_type: (str) The file's mimetype.
+          size: (int) Size of the processed file, before compression.
+          transfer_size: (int) Number of bytes that would actually be sent.
+          requests: (int) Number of requests it would take.
+        """
+        self.uploads.append({
+            'remote_path': remote_path,
+            'content_type': content_type,
+            'size': size,
+            'transfer_size': transfer_size,
+            'requests': requests,
+        })
+
+    def _total(self, field):
+        return sum(upload[field] for upload in self.uploads)
+
+    @property
+    def size(self):
+        return self._total('size')
+
+    @property
+    def transfer_size(self):
+        return self._total('transfer_size')
+
+    @property
+    def requests(self):
+        return self._total('requests')
+
+    def estimate(self, bandwidth=None, latency=None):
+        """
+        Returns a rough guess of how many seconds the uploads would take.
+        The bandwidth (bytes per second) is shared between the workers, but
+        the per-request latency is overlapped by them.
+        """
+        bandwidth = bandwidth or DEFAULT_BANDWIDTH
+        if latency is None:
+            latency = DEFAULT_LATENCY
+        return (float(self.transfer_size) / bandwidth +
+                self.requests * latency / self.workers)
+
+    def as_dict(self, bandwidth=None, latency=None):
+        return {
+            'uploads': self.uploads,
+            'unchanged': self.unchanged,
+            'size': self.size,
+            'transfer_size': self.transfer_size,
+            'requests': self.requests,
+            'workers': self.workers,
+            'estimated_seconds': round(self.estimate(bandwidth, latency), 1),
+        }
+
+    def to_json(self, bandwidth=None, latency=None):
+        return simplejson.dumps(self.as_dict(bandwidth, latency), indent=1)
+
+    def report(self, bandwidth=None, latency=None):
+        """
+        Returns a human readable summary of the plan.
+        """
+        lines = ["[%s] %s (%s -> %s bytes)" % (upload['content_type'],
+                                               upload['remote_path'],
+                                               upload['size'],
+                                               upload['transfer_size'])
+                 for upload in self.uploads]
+        lines.append("%d files to upload, %d unchanged" % (len(self.uploads),
+                                                           self.unchanged))
+        lines.append("%d bytes, %d bytes after compression, in %d requests" %
+                     (self.size, self.transfer_size, self.requests))
+        lines.append("about %.1f seconds with %d workers" %
+                     (self.estimate(bandwidth, latency), self.workers))
+        return '\n'.join(lines)
@@ -0,0 +1,163 @@
+"""
+A small, bounded thread pool used by sync() to overlap reading, processing
+and uploading of media files. Results are handed back in submission order so
+that output stays the same no matter how many workers are used.
+
+ProcessorPool spreads the CPU-bound part, running processors, over several
+processes.
+"""
+import multiprocessing
+import sys
+import threading
+import Queue
+from mediasync import stats
+
+# Sentinel telling a worker thread that there is no more work.
+_STOP = object()
+
+def imap_ordered(func, items, workers=1, make_state=None, close_state=None):
+    """
+    Calls func(state, item) for every item and yields (item, result, exc_info)
+    tuples in the same order as items. exc_info is None on success, otherwise
+    it is the sys.exc_info() tuple of the exception raised by func.
+
+    args:
+      func: (callable) Does the work for a single item.
+      items: (iterable) The work to do. Consumed lazily.
+      workers: (int) Maximum number of threads. With 1 worker everything runs
+                     in the calling thread.
+      make_state: (callable) Called once per worker thread; its return value
+                             is passed to func as 'state'. Used to give each
+                             worker its own backend connection.
+      close_state: (callable) Called with a worker's state once it is done.
+
+    Once an item fails no new items are started, but items already in flight
+    are allowed to finish and are yielded as usual.
+    """
+    workers = max(int(workers or 1), 1)
+
+    if workers == 1:
+        state = make_state() if make_state else None
+        try:
+            for item in items:
+                try:
+                    yield (item, func(state, item), None)
+                except Exception:
+                    yield (item, None, sys.exc_info())
+                    return
+        finally:
+            if close_state:
+                close_state(state)
+        return
+
+    # Bounded so that a huge media tree isn't queued up all at once.
+    tasks = Queue.Queue(workers * 2)
+    results = Queue.Queue()
+    failed = threading.Event()
+
+    def feed():
+        count = 0
+        try:
+            for item in items:
+                if failed.isSet():
+                    break
+                tasks.put((count, item))
+                count += 1
+        finally:
+            for i in range(workers):
+                tasks.put(_STOP)
+            results.put((_STOP, count))
+
+    def work():
+        state = None
+        try:
+            try:
+                state = make_state() if make_state else None
+            except Exception:
+                # Couldn't even set up, fail whatever we pick up.
+                setup_exc = sys.exc_info()
+            else:
+                setup_exc = None
+            while True:
+                task = tasks.get()
+                if task is _STOP:
+                    break
+                index, item = task
+                if setup_exc is not None:
+                    failed.set()
+                    results.put((index, (item, None, setup_exc)))
+                    continue
+                try:
+                    results.put((index, (item, func(state, item), None)))
+                except Exception:
+                    failed.set()
+                    results.put((index, (item, None, sys.exc_info())))
+        finally:
+            if close_state and state is not None:
+                close_state(state)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for i in range(workers))
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+
+    pending = {}
+    next_index = 0
+    total = None
+    try:
+        while total is None or next_index < total:
+            index, value = results.get()
+            if index is _STOP:
+                total = value
+            else:
+                pending[index] = value
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+    finally:
+        failed.set()
+        for thread in threads:
+            thread.join()
+
+# The client whose processors are run by ProcessorPool's worker processes.
+# Set before the pool is created so the (forked) workers inherit it, which
+# means processors never need to be pickled.
+_process_client = None
+
+def _process_in_worker(args):
+    filedata, content_type, remote_path = args
+    return _process_client.process(filedata, content_type, remote_path)
+
+class ProcessorPool(object):
+    """
+    Runs a client's processors in a pool of worker processes. process() may
+    be called from several threads at once and blocks until the result is
+    ready. Worker processes are forked copies of the client, so the output is
+    exactly what client.process() would return.
+    """
+    def __init__(self, client, processes):
+        global _process_client
+        self.client = client
+        _process_client = client
+        self._pool = multiprocessing.Pool(processes)
+
+    def process(self, filedata, content_type, remote_path):
+        if not self.client.processors:
+            return filedata
+
+        # Cache hits are cheaper to look up here than to send to a worker.
+        cached = self.client.cached_process(filedata, content_type, remote_path)
+        if cached is not None:
+            stats.count('processor_cache_hits')
+            return cached
+        stats.count('processor_cache_misses')
+
+        return self._pool.apply(_process_in_worker,
+                                ((filedata, content_type, remote_path),))
+
+    def close(self):
+        global _process_client
+        self._pool.close()
+        self._pool.join()
+        _process_client = None
@@ -1,15 +1,43 @@
-try:
-    import slimmer
-    SLIMMER_INSTALLED = True
-except ImportError:
-    SLIMMER_INSTALLED = False
+from mediasync.msettings import FINGERPRINT, FINGERPRINT_LENGTH, CSS_INLINE_THRESHOLD
+from mediasync import assets, minifiers
+
+def _is_css(content_type, remote_path):
+    return content_type == 'text/css' or remote_path.lower().endswith('.css')
 
 def css_minifier(filedata, content_type, remote_path, is_processors_active):
-    is_css = content_type == 'text/css' or remote_path.lower().endswith('.css')
-    if SLIMMER_INSTALLED and is_processors_active and is_css:
-        return slimmer.css_slimmer(filedata)
+    if is_processors_active and _is_css(content_type, remote_path):
+        engine = minifiers.get_engine('css')
+        if engine is not None:
+            return engine.minify('css', filedata)
+# Used by the processor cache; changes whenever the output might. Only
+# worked out when it's needed, as it means importing the engine.
+css_minifier.version = lambda: minifiers.engine_version('css')
 
 def js_minifier(filedata, content_type, remote_path, is_processors_active):
     is_js = content_type == 'text/javascript' or remote_path.lower().endswith('.js')
-    if SLIMMER_INSTALLED and is_processors_active and is_js:
-        return slimmer.css_slimmer(filedata)
\ No newline at end of file
+    if is_processors_active and is_js:
+        engine = minifiers.get_engine('js')
+        if engine is not None:
+            return engine.minify('js', filedata)
+js_minifier.version = lambda: minifiers.engine_version('js')
+
+def css_urls(filedata, content_type, remote_path, is_processors_active, media_root):
+    """
+    Points url() references in stylesheets at the synced files: their
+    fingerprinted names with FINGERPRINT, or else with their checksum as a
+    query string. Files of up to CSS_INLINE_THRESHOLD bytes are inlined as
+    data URIs instead.
+    """
+    if is_processors_active and _is_css(content_type, remote_path):
+        return assets.rewrite(filedata, remote_path, media_root, FINGERPRINT,
+                              CSS_INLINE_THRESHOLD)
+css_urls.version = '1:%s:%s:%s' % (FINGERPRINT, FINGERPRINT_LENGTH, CSS_INLINE_THRESHOLD)
+# Called with the client's media_root as well.
+css_urls.uses_media_root = True
+
+def _css_url_dependencies(filedata, content_type, remote_path, is_processors_active, media_root):
+    if is_processors_active and _is_css(content_type, remote_path):
+        return assets.references(filedata, remote_path)
+    return []
+# The files css_urls output depends on, besides filedata.
+css_urls.dependencies = _css_url_dependencies
@@ -0,0 +1,108 @@
+"""
+Deletes files from remote storage that sync() no longer uploads: files that
+were deleted or renamed locally, and older fingerprinted versions of the
+files that are still there. syncmedia --prune runs it after syncing.
+
+Pages already in browser and proxy caches link to the files they were
+rendered with, so orphans aren't deleted right away. The
+PRUNE_KEEP_FINGERPRINTS newest fingerprinted versions of each file are
+never orphans, and anything else is only deleted once it has been orphaned
+for PRUNE_GRACE seconds. When each file was first found orphaned is kept in
+PRUNE_STATE (a Manifest of remote path -> timestamp).
+"""
+import time
+import mediasync
+from mediasync.msettings import PRUNE_GRACE, PRUNE_KEEP_FINGERPRINTS, PRUNE_STATE
+from mediasync import backends, fingerprints
+from mediasync.manifest import Manifest, sync_target
+
+def find_orphans(local, remote, current=None, keep=None):
+    """
+    Returns the sorted remote paths that should go.
+
+    args:
+      local: (set) Remote paths of the files sync() uploads.
+      remote: (dict) Remote path -> last modified timestamp, for every file
+                     in remote storage.
+      current: (set) Fingerprinted paths the fingerprint manifest points at.
+      keep: (int) Fingerprinted versions to keep of each file, including the
+                  current one. Defaults to PRUNE_KEEP_FINGERPRINTS.
+    """
+    if keep is None:
+        keep = PRUNE_KEEP_FINGERPRINTS
+    current = current or set()
+
+    # Files whose current version is in remote storage, and counts as one
+    # of the versions kept.
+    has_current = set(fingerprints.logical_path(path) for path in current if path in remote)
+
+    orphans = []
+    # Logical path -> [(last modified, fingerprinted path)]
+    versions = {}
+    for remote_path, modified in remote.items():
+        if remote_path in local or remote_path in current:
+            continue
+        logical = fingerprints.logical_path(remote_path)
+        if logical in local:
+            versions.setdefault(logical, []).append((modified, remote_path))
+        else:
+            orphans.append(remote_path)
+
+    for logical, older in versions.items():
+        # Newest first.
+        older.sort(reverse=True)
+        kept = keep - 1 if logical in has_current else keep
+        orphans.extend(path for modified, path in older[max(kept, 0):])
+
+    return sorted(orphans)
+
+def prune(client=None, grace=None, keep=None, dry_run=False):
+    """
+    Deletes orphaned files from remote storage. Returns a (deleted, waiting)
+    tuple of the sorted remote paths that were deleted, and of the orphans
+    still within the grace period.
+
+    args:
+      client: (BaseClient) The backend client. Defaults to the client for
+                           the configured BACKEND.
+      grace: (int) Seconds a file must have been orphaned before it is
+                   deleted. Defaults to PRUNE_GRACE.
+      keep: (int) Fingerprinted versions to keep of each file. Defaults to
+                  PRUNE_KEEP_FINGERPRINTS.
+      dry_run: (bool) If True, work out what would be deleted without
+                      deleting anything, or recording any orphans.
+    """
+    if client is None:
+        client = backends.client()
+    if grace is None:
+        grace = PRUNE_GRACE
+
+    local = set(item.remote_path for item in mediasync.sync_items(client))
+    current = set(fingerprints.load().values())
+
+    client.read_only = dry_run
+    client.open()
+    try:
+        remote = client.list_remote()
+        orphans = find_orphans(local, remote, current, keep)
+
+        now = time.time()
+        state = Manifest(PRUNE_STATE, sync_target(client)).load()
+        # Files that are no longer orphaned are forgotten.
+        state.files = dict((path, state.files.get(path, now)) for path in orphans)
+        deleted = [path for path in orphans if now - state.files[path] >= grace]
+        waiting = [path for path in orphans if now - state.files[path] < grace]
+
+        if not dry_run and deleted:
+            client.delete(deleted)
+    finally:
+        client.close()
+        client.read_only = False
+
+    if not dry_run:
+        if deleted:
+            client.commit()
+        for path in deleted:
+            del state.files[path]
+        state.save()
+    return (deleted, waiting)
@@ -0,0 +1,35 @@
+"""
+Retries requests to remote storage that fail for reasons that are likely to
+go away (IE: a 503 or a dropped connection), backing off exponentially with
+random jitter so that parallel workers don't all retry at the same moment.
+"""
+import random
+import time
+from mediasync.msettings import SYNC_RETRIES, SYNC_RETRY_BACKOFF, SYNC_RETRY_MAX_BACKOFF
+
+def backoff(attempt):
+    """
+    Returns how many seconds to wait before retry number attempt (starting
+    at 0): a random amount up to SYNC_RETRY_BACKOFF * 2 ** attempt, capped
+    at SYNC_RETRY_MAX_BACKOFF.
+    """
+    return random.uniform(0, min(SYNC_RETRY_BACKOFF * 2 ** attempt,
+                                 SYNC_RETRY_MAX_BACKOFF))
+
+def call(func, is_retryable, retries=None):
+    """
+    Returns func(), calling it again up to retries times (defaults to
+    SYNC_RETRIES) if it raises an exception that is_retryable(exception)
+    says is worth retrying.
+    """
+    if retries is None:
+        retries = SYNC_RETRIES
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception, e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+            time.sleep(backoff(attempt))
+            attempt += 1
@@ -0,0 +1,15 @@
+"""
+Signals sent by sync(), for shipping sync metrics elsewhere. The sender is
+the backend client.
+
+  pre_sync: a sync is starting. stats is the SyncStats it will fill in.
+  file_synced: a file was written to remote storage. Sent with its
+               remote_path, content_type and size (before compression).
+  post_sync: a sync is over, whether or not it succeeded. Sent with its
+             stats, and success, which is False if it raised.
+"""
+from django.dispatch import Signal
+
+pre_sync = Signal(providing_args=['stats'])
+file_synced = Signal(providing_args=['remote_path', 'content_type', 'size'])
+post_sync = Signal(providing_args=['stats', 'success'])
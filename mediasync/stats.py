@@ -0,0 +1,150 @@
+"""
+Counters and per-phase timings collected while syncing, so a slow deploy can
+be pinned on walking the tree, reading, processing, compressing, remote
+lookups or uploading. sync() collects into a SyncStats, which syncmedia
+--stats prints, and which is sent with the post_sync signal.
+
+Code that runs during a sync (sync() itself, BaseClient.process and the
+backends) reports through the module level count() and timed() functions,
+which do nothing when no sync is being collected.
+"""
+import threading
+import time
+from django.utils import simplejson
+
+# The phases timed, in the order they're reported.
+PHASES = (
+    'walk',       # finding the files to sync
+    'stat',       # looking at sizes, mtimes and joined files' sources
+    'read',       # reading and joining files
+    'process',    # running processors (IE: minifying)
+    'checksum',   # hashing processed files
+    'put',        # handing files to the backend, including the next three
+    'compress',   # gzipping (S3, Cloud Files)
+    'lookup',     # finding out if remote storage is up to date (S3, Cloud Files)
+    'upload',     # sending files (S3, Cloud Files)
+    'stage',      # hardlinking the live release into a new one (filesystem)
+)
+
+class SyncStats(object):
+    """
+    What a sync did and where the time went. Phase timings are summed over
+    every worker, so with several workers they can add up to more than the
+    sync took.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        # name -> number
+        self.counters = {}
+        # phase -> [seconds, calls]
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self._lock.release()
+
+    def add_time(self, phase, seconds):
+        self._lock.acquire()
+        try:
+            timing = self.timings.setdefault(phase, [0.0, 0])
+            timing[0] += seconds
+            timing[1] += 1
+        finally:
+            self._lock.release()
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def compression_ratio(self):
+        """
+        Bytes sent over bytes uploaded, or None if the backend doesn't
+        report what it sends.
+        """
+        sent = self.counters.get('bytes_sent')
+        uploaded = self.counters.get('bytes_uploaded')
+        if sent is None or not uploaded:
+            return None
+        return float(sent) / uploaded
+
+    def as_dict(self):
+        ratio = self.compression_ratio
+        return {
+            'seconds': round(self.elapsed, 3),
+            'counters': dict(self.counters),
+            'compression_ratio': round(ratio, 3) if ratio is not None else None,
+            'phases': dict((phase, {'seconds': round(seconds, 3), 'calls': calls})
+                           for phase, (seconds, calls) in self.timings.items()),
+        }
+
+    def to_json(self):
+        return simplejson.dumps(self.as_dict(), indent=1, sort_keys=True)
+
+    def report(self):
+        """
+        Returns a human readable summary.
+        """
+        c = self.counters.get
+        lines = [
+            "%d files in %.2f seconds: %d uploaded, %d unchanged, %d failed" % (
+                c('files_seen', 0), self.elapsed, c('files_uploaded', 0),
+                c('files_unchanged', 0), c('files_failed', 0)),
+            "%d bytes read, %d after processing, %d uploaded" % (
+                c('bytes_read', 0), c('bytes_processed', 0), c('bytes_uploaded', 0)),
+        ]
+        if self.compression_ratio is not None:
+            lines.append("%d bytes sent (%.1f%% of uploaded) in %d requests" % (
+                c('bytes_sent'), 100 * self.compression_ratio, c('requests', 0)))
+        if 'processor_cache_hits' in self.counters or 'processor_cache_misses' in self.counters:
+            lines.append("processor cache: %d hits, %d misses" % (
+                c('processor_cache_hits', 0), c('processor_cache_misses', 0)))
+        for phase in PHASES + tuple(sorted(set(self.timings) - set(PHASES))):
+            if phase in self.timings:
+                seconds, calls = self.timings[phase]
+                lines.append("  %-10s %8.3fs %8d calls" % (phase, seconds, calls))
+        return '\n'.join(lines)
+
+# The SyncStats being collected into, if any.
+_current = None
+
+def collect(stats):
+    """
+    Makes count() and timed() report to stats (or to nothing, if None).
+    """
+    global _current
+    _current = stats
+
+def count(name, n=1):
+    if _current is not None:
+        _current.count(name, n)
+
+def timed(phase, func, *args, **kwargs):
+    """
+    Returns func(*args, **kwargs), adding the time it took to phase.
+    """
+    stats = _current
+    if stats is None:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        stats.add_time(phase, time.time() - start)
+
+def timed_iter(phase, iterable):
+    """
+    Yields the items of iterable, adding the time it takes to produce each
+    one to phase.
+    """
+    it = iter(iterable)
+    while True:
+        yield timed(phase, it.next)
@@ -2,24 +2,90 @@ import warnings
 from django import template
 from django.conf import settings
 from django.template.defaultfilters import stringfilter
-from mediasync.msettings import CSS_PATH, JS_PATH, DOCTYPE, JOINED, SERVE_REMOTE, EMULATE_COMBO, URL_PROCESSOR, CACHE_BUSTER, USE_SSL
-from mediasync import backends
-
-# Instance of the backend you configured in settings.py.
-client = backends.client()
-MEDIA_URL = client.media_url()
-SECURE_MEDIA_URL = client.media_url(with_ssl=True)
+from mediasync.msettings import CSS_PATH, JS_PATH, DOCTYPE, JOINED, SERVE_REMOTE, EMULATE_COMBO, URL_PROCESSOR, CACHE_BUSTER, USE_SSL, FINGERPRINT, TAG_RENDER_CACHE
+from mediasync import backends, fingerprints
 
 register = template.Library()
 
+# with_ssl -> base media URL, worked out on first use.
+_media_urls = {}
+
+# Bumped by invalidate(). Nodes re-render their markup when this (or the
+# fingerprint manifest) changes.
+_generation = 0
+
+def invalidate():
+    """
+    Makes every mediasync tag re-render its markup. Call this after changing
+    mediasync settings at runtime.
+    """
+    global _generation
+    _media_urls.clear()
+    _generation += 1
+
+def base_media_url(with_ssl=False):
+    """
+    Returns the base media URL from the shared backend client. The backend
+    isn't loaded until a tag is first used, and the URLs are only asked for
+    once.
+    """
+    url = _media_urls.get(with_ssl)
+    if url is None:
+        url = backends.get_client().media_url(with_ssl=with_ssl)
+        _media_urls[with_ssl] = url
+    return url
+
+def render_generation():
+    return (_generation, fingerprints.generation)
+
 class BaseTagNode(template.Node):
     """
     Base class for all mediasync nodes.
+
+    The output of a tag only depends on its arguments, settings and whether
+    the page is secure, so nodes render both the secure and insecure
+    variants when the template is compiled, and just pick one at render
+    time. Subclasses implement render_markup() instead of render().
     """
     def __init__(self, path):
         super(BaseTagNode, self).__init__()
         # This is the filename or path+filename supplied by the template call.
         self.path = path
+        # is_secure -> (generation, markup)
+        self._rendered = {}
+
+    def precompute(self):
+        """
+        Renders and caches the markup for both the secure and insecure
+        variants of the tag.
+        """
+        if TAG_RENDER_CACHE:
+            for is_secure in (False, True):
+                markup = self._render_variant(is_secure)
+                # Rendering may load the fingerprint manifest, so only look
+                # at the generation afterwards.
+                self._rendered[is_secure] = (render_generation(), markup)
+
+    def _render_variant(self, is_secure):
+        return self.render_markup(base_media_url(with_ssl=is_secure))
+
+    def render(self, context):
+        is_secure = USE_SSL if USE_SSL is not None else self.is_secure(context)
+        if not TAG_RENDER_CACHE:
+            return self._render_variant(is_secure)
+
+        cached = self._rendered.get(is_secure)
+        if cached is None or cached[0] != render_generation():
+            markup = self._render_variant(is_secure)
+            cached = (render_generation(), markup)
+            self._rendered[is_secure] = cached
+        return cached[1]
+
+    def render_markup(self, media_url):
+        """
+        Returns the output of the tag for the given base media URL.
+        """
+        raise NotImplementedError('render_markup not defined in ' + self.__class__.__name__)
 
     def is_secure(self, context):
         """
@@ -43,7 +109,7 @@ class BaseTagNode(template.Node):
         return an unencrypted URL.
         """
         is_secure = USE_SSL if USE_SSL is not None else self.is_secure(context)
-        return SECURE_MEDIA_URL if is_secure else MEDIA_URL
+        return base_media_url(with_ssl=is_secure)
 
     def mkpath(self, url, path, filename=None):
         """
@@ -55,6 +121,14 @@ class BaseTagNode(template.Node):
                       to the file.
           filename: (str) The file name to serve.
         """
+        if FINGERPRINT and SERVE_REMOTE:
+            # Point at the content-hashed copy of the file if sync() made
+            # one. It never changes, so it doesn't need a cache buster.
+            asset = '/'.join(p.strip('/') for p in (path, filename) if p)
+            fingerprinted = fingerprints.resolve(asset)
+            if fingerprinted is not None:
+                return URL_PROCESSOR("%s/%s" % (url.rstrip('/'), fingerprinted))
+
         if path:
             url = "%s/%s" % (url.rstrip('/'), path.strip('/'))
 
@@ -105,7 +179,9 @@ def media_url_tag(parser, token):
         {% media_url "images/bunny.gif" %}
         {% media_url %}/themes/{{ theme_variable }}/style.css
     """
-    return MediaUrlTagNode(get_path_from_tokens(token))
+    node = MediaUrlTagNode(get_path_from_tokens(token))
+    node.precompute()
+    return node
 register.tag('media_url', media_url_tag)
 
 class MediaUrlTagNode(BaseTagNode):
@@ -113,9 +189,7 @@ class MediaUrlTagNode(BaseTagNode):
     Node for the {% media_url %} tag. See the media_url_tag method above for
     documentation and examples.
     """
-    def render(self, context):
-        media_url = self.get_media_url(context)
-
+    def render_markup(self, media_url):
         if not self.path:
             # No path provided, just return the base media URL.
             return media_url
@@ -151,7 +225,9 @@ def css_tag(parser, token):
         # Default values.
         media_type = "screen, projection"
 
-    return CssTagNode(path, media_type=media_type)
+    node = CssTagNode(path, media_type=media_type)
+    node.precompute()
+    return node
 register.tag('css', css_tag)
 
 def css_print_tag(parser, token):
@@ -170,7 +246,9 @@ def css_print_tag(parser, token):
     # Hard wired media type, since this is for media type of 'print'.
     media_type = "print"
 
-    return CssTagNode(path, media_type=media_type)
+    node = CssTagNode(path, media_type=media_type)
+    node.precompute()
+    return node
 register.tag('css_print', css_print_tag)
 
 class CssTagNode(BaseTagNode):
@@ -182,9 +260,7 @@ class CssTagNode(BaseTagNode):
         super(CssTagNode, self).__init__(*args)
         self.media_type = kwargs.get('media_type', "screen, projection")
 
-    def render(self, context):
-        media_url = self.get_media_url(context)
-
+    def render_markup(self, media_url):
         if SERVE_REMOTE and self.path in JOINED:
             # Serving from S3/Cloud Files.
             return self.linktag(media_url, CSS_PATH, self.path, self.media_type)
@@ -223,7 +299,9 @@ def js_tag(parser, token):
         {% js "somefile.js" %}
         
     """
-    return JsTagNode(get_path_from_tokens(token))
+    node = JsTagNode(get_path_from_tokens(token))
+    node.precompute()
+    return node
 register.tag('js', js_tag)
 
 class JsTagNode(BaseTagNode):
@@ -231,9 +309,7 @@ class JsTagNode(BaseTagNode):
     Node for the {% js %} tag. See the js_tag method above for
     documentation and examples.
     """
-    def render(self, context):
-        media_url = self.get_media_url(context)
-
+    def render_markup(self, media_url):
         if SERVE_REMOTE and self.path in JOINED:
             # Serving from S3/Cloud Files.
             return self.scripttag(media_url, JS_PATH, self.path)
@@ -0,0 +1,158 @@
+"""
+A minimal Cloud Files (Swift) server for the tests, so they don't need a
+Rackspace account.
+"""
+import BaseHTTPServer
+import cgi
+import hashlib
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+from django.utils import simplejson
+
+class FakeSwiftServer(object):
+    """
+    A minimal Cloud Files stand-in: authentication at /auth and storage
+    under /v1/AUTH_test, kept in memory, over keep-alive HTTP. CDN
+    management is served under the same path on cdn_port, as Cloud Files
+    does on a host of its own. Objects are stored as (body, headers). Counts
+    connections, logins and requests.
+    """
+    def __init__(self, cdn=True):
+        self.containers = {}
+        # (container, name) -> when it was last written to.
+        self.modified = {}
+        # Published container name -> TTL.
+        self.public = {}
+        self.logins = 0
+        self.connections = 0
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send responses in one go, so that small writes don't wait on
+            # delayed ACKs.
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                fake.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body='', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def handle_request(self):
+                (path, query) = urlparse.urlparse(self.path)[2:5:2]
+                parts = [urllib.unquote(part) for part in path.lstrip('/').split('/', 3)]
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+                if parts[0] == 'auth':
+                    fake.logins += 1
+                    headers = {
+                        'X-Storage-Url': 'http://127.0.0.1:%d/v1/AUTH_test' % fake.port,
+                        'X-Auth-Token': 'token',
+                    }
+                    if cdn:
+                        headers['X-CDN-Management-Url'] = 'http://127.0.0.1:%d/v1/AUTH_test' % fake.cdn_port
+                    return self.respond(204, headers=headers)
+
+                if self.headers.get('X-Auth-Token') != 'token':
+                    return self.respond(401)
+                is_cdn = self.server is fake.cdn_server
+                fake.requests.append((self.command, 'cdn' if is_cdn else 'storage',
+                                      '/'.join(parts[2:])))
+                container = parts[2] if len(parts) > 2 else ''
+                name = parts[3] if len(parts) > 3 else ''
+                if is_cdn:
+                    return self.cdn(container)
+                if not name:
+                    return self.container(container, cgi.parse_qs(query))
+                return self.object(container, name, body)
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = handle_request
+
+            def cdn(self, container):
+                if self.command in ('PUT', 'POST'):
+                    fake.public[container] = int(self.headers.get('X-TTL'))
+                elif container not in fake.public:
+                    return self.respond(404)
+                return self.respond(204, headers={
+                    'X-CDN-URI': 'http://cdn.example.com/%s' % container,
+                    'X-CDN-SSL-URI': 'https://ssl.cdn.example.com/%s' % container,
+                    'X-TTL': str(fake.public[container]),
+                })
+
+            def container(self, container, query):
+                if self.command == 'PUT':
+                    fake.containers.setdefault(container, {})
+                    return self.respond(201)
+                if container not in fake.containers:
+                    return self.respond(404)
+                if self.command == 'HEAD':
+                    return self.respond(204, headers={
+                        'X-Container-Object-Count': str(len(fake.containers[container]))})
+                prefix = query.get('prefix', [''])[0]
+                marker = query.get('marker', [''])[0]
+                limit = int(query.get('limit', [10000])[0])
+                listing = [{'name': name, 'hash': headers['ETag'], 'bytes': len(body),
+                            'content_type': headers['Content-Type'],
+                            'last_modified': time.strftime('%Y-%m-%dT%H:%M:%S.000000',
+                                time.gmtime(fake.modified[(container, name)]))}
+                           for name, (body, headers) in sorted(fake.containers[container].items())
+                           if name.startswith(prefix) and name > marker][:limit]
+                self.respond(200, simplejson.dumps(listing),
+                             {'Content-Type': 'application/json; charset=utf-8'})
+
+            def object(self, container, name, body):
+                if container not in fake.containers:
+                    return self.respond(404)
+                objects = fake.containers[container]
+                if self.command == 'PUT':
+                    etag = hashlib.md5(body).hexdigest()
+                    if self.headers.get('ETag', etag) != etag:
+                        return self.respond(422)
+                    headers = dict((h.title(), v) for h, v in self.headers.items()
+                                   if h not in ('content-length', 'x-auth-token', 'host',
+                                                'accept-encoding', 'user-agent', 'etag'))
+                    headers['ETag'] = etag
+                    objects[name] = (body, headers)
+                    fake.modified[(container, name)] = time.time()
+                    return self.respond(201, headers={'ETag': etag})
+                if name not in objects:
+                    return self.respond(404)
+                if self.command == 'DELETE':
+                    del objects[name]
+                    return self.respond(204)
+                body, headers = objects[name]
+                self.respond(200, body, headers)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.cdn_server = Server(('127.0.0.1', 0), Handler)
+        self.cdn_port = self.cdn_server.server_address[1]
+        self.auth_url = 'http://127.0.0.1:%d/auth' % self.port
+        for server in (self.server, self.cdn_server):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        for server in (self.server, self.cdn_server):
+            server.shutdown()
+            server.server_close()
@@ -1,4 +1,7 @@
+import atexit
 import os
+import shutil
+import tempfile
 TEST_ROOT = os.path.abspath(os.path.dirname(__file__))
 
 DATABASE_ENGINE = 'sqlite3'
@@ -7,8 +10,14 @@ DATABASE_NAME = 'mediasynctest.db'
 MEDIA_ROOT = os.path.join(TEST_ROOT, 'media')
 MEDIA_URL = '/media/'
 
+# The manifest, journal and caches written by the tests; removed when
+# the test run is over.
+state_dir = tempfile.mkdtemp(prefix='mediasynctest')
+atexit.register(shutil.rmtree, state_dir, True)
+
 MEDIASYNC = {
     'BACKEND': 'mediasync.backends.dummy',
+    'STATE_DIR': state_dir,
 }
 
 INSTALLED_APPS = ('mediasync.tests',)
\ No newline at end of file
@@ -1,10 +1,24 @@
+import hashlib
 import os
+import re
+import socket
 import sys
+import tempfile
 import unittest
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from mediasync import backends
+from mediasync import benchmarks
 from mediasync import msettings
+from mediasync import compression
+from mediasync.cache import DiskCache
+from mediasync import fingerprints
+from mediasync import minifiers
+from mediasync import pool
+from mediasync import retry
+from mediasync import signals
+from mediasync.stats import SyncStats
+from mediasync.fakes3 import FakeS3Server
 import mediasync
 
 class BaseTestCase(unittest.TestCase):
@@ -17,6 +31,9 @@ class DummyBackendTestCase(unittest.TestCase):
     def setUp(self):
         msettings.BACKEND = 'mediasync.backends.dummy'
         self.client = backends.client()
+        for path in (msettings.MANIFEST, msettings.CHECKPOINT):
+            if os.path.exists(path):
+                os.remove(path)
 
     def testPush(self):
 
@@ -29,6 +46,555 @@ class DummyBackendTestCase(unittest.TestCase):
     def testJoinedPush(self):
         pass
 
+    def testParallelPush(self):
+        serial = []
+        self.client.put_callback = lambda *args: serial.append(args[2])
+        mediasync.sync(self.client, force=True, workers=1)
+
+        parallel = []
+        self.client.put_callback = lambda *args: parallel.append(args[2])
+        mediasync.sync(self.client, force=True, workers=4)
+
+        self.assertTrue(serial)
+        self.assertEqual(sorted(serial), sorted(parallel))
+
+    def testParallelPushFailure(self):
+
+        def callback(filedata, content_type, remote_path, force):
+            if remote_path.endswith('2.css'):
+                raise IOError('upload failed')
+
+        self.client.put_callback = callback
+        self.assertRaises(IOError, mediasync.sync, self.client, workers=4)
+
+    def testStats(self):
+        self.client.put_callback = lambda *args: None
+        received = []
+        def receiver(signal, sender, **kwargs):
+            received.append((signal, kwargs))
+        for signal in (signals.pre_sync, signals.file_synced, signals.post_sync):
+            signal.connect(receiver)
+        try:
+            sync_stats = SyncStats()
+            mediasync.sync(self.client, sync_stats=sync_stats)
+        finally:
+            for signal in (signals.pre_sync, signals.file_synced, signals.post_sync):
+                signal.disconnect(receiver)
+
+        counters = sync_stats.counters
+        self.assertEqual(counters['files_seen'], 4)
+        self.assertEqual(counters['files_uploaded'], 4)
+        self.assertTrue(counters['bytes_read'] >= counters['bytes_uploaded'] > 0)
+        for phase in ('walk', 'stat', 'read', 'process', 'checksum', 'put'):
+            self.assertTrue(phase in sync_stats.timings, phase)
+        self.assertEqual(sync_stats.timings['put'][1], 4)
+        self.assertTrue(sync_stats.finished is not None)
+        self.assertTrue('4 files' in sync_stats.report())
+        self.assertTrue('"files_uploaded": 4' in sync_stats.to_json())
+
+        self.assertEqual([signal for signal, kwargs in received],
+                         [signals.pre_sync] + [signals.file_synced] * 4 + [signals.post_sync])
+        self.assertTrue(received[0][1]['stats'] is sync_stats)
+        self.assertEqual(received[-1][1]['success'], True)
+        self.assertTrue(received[1][1]['remote_path'].startswith('css/'))
+
+        # Nothing to do the second time around.
+        sync_stats = SyncStats()
+        mediasync.sync(self.client, sync_stats=sync_stats)
+        self.assertEqual(sync_stats.counters['files_unchanged'], 4)
+        self.assertFalse('files_uploaded' in sync_stats.counters)
+
+    def testRetry(self):
+        attempts = []
+
+        def callback(filedata, content_type, remote_path, force):
+            attempts.append(remote_path)
+            if attempts.count(remote_path) < 3:
+                raise socket.error('connection reset')
+
+        self.client.put_callback = callback
+        old_backoff = retry.SYNC_RETRY_BACKOFF
+        retry.SYNC_RETRY_BACKOFF = 0
+        try:
+            mediasync.sync(self.client)
+        finally:
+            retry.SYNC_RETRY_BACKOFF = old_backoff
+        self.assertEqual(len(attempts), 12)
+
+        # Only errors that might go away are retried.
+        def fail():
+            attempts.append('fail')
+            raise IOError('disk full')
+
+        del attempts[:]
+        self.assertRaises(IOError, retry.call, fail, self.client.is_retryable)
+        self.assertEqual(attempts, ['fail'])
+        self.assertFalse(self.client.is_retryable(ValueError()))
+
+    def testResume(self):
+        failing = ['css/2.css']
+
+        def callback(filedata, content_type, remote_path, force):
+            if remote_path in failing:
+                raise IOError('upload failed')
+            pushed.append(remote_path)
+
+        pushed = []
+        self.client.put_callback = callback
+        old_budget = mediasync.SYNC_FAILURE_BUDGET
+        mediasync.SYNC_FAILURE_BUDGET = 1
+        try:
+            # Within the budget, the other files still make it.
+            self.assertRaises(mediasync.SyncException, mediasync.sync, self.client)
+            self.assertEqual(len(pushed), 3)
+            self.assertFalse(os.path.exists(msettings.MANIFEST))
+            self.assertTrue(os.path.exists(msettings.CHECKPOINT))
+
+            # Resuming only uploads what failed.
+            del failing[:]
+            del pushed[:]
+            mediasync.sync(self.client, resume=True)
+            self.assertEqual(pushed, ['css/2.css'])
+            self.assertTrue(os.path.exists(msettings.MANIFEST))
+            self.assertFalse(os.path.exists(msettings.CHECKPOINT))
+
+            # Going over the budget stops the sync.
+            failing[:] = ['css/1.css', 'css/2.css']
+            self.assertRaises(IOError, mediasync.sync, self.client, force=True)
+        finally:
+            mediasync.SYNC_FAILURE_BUDGET = old_budget
+
+    def testManifestSkipsUnchanged(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.sync(self.client)
+        self.assertTrue(pushed)
+        self.assertTrue(os.path.exists(msettings.MANIFEST))
+
+        # Nothing changed, so nothing should even reach the backend.
+        del pushed[:]
+        mediasync.sync(self.client)
+        self.assertEqual(pushed, [])
+
+        # Touching a file without changing it is still a no-op.
+        path = os.path.join(self.client.media_root, 'css', '1.css')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        try:
+            mediasync.sync(self.client)
+        finally:
+            os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertEqual(pushed, [])
+
+        # --verify hands every file to the backend again.
+        mediasync.sync(self.client, verify=True)
+        self.assertEqual(len(pushed), 4)
+
+    def testManifestIgnoresOtherTarget(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.sync(self.client)
+        del pushed[:]
+        self.client.remote_media_url_callback = lambda: "dummy://elsewhere"
+        mediasync.sync(self.client)
+        self.assertEqual(len(pushed), 4)
+
+    def testManifestIgnoresOtherProcessors(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.sync(self.client)
+        del pushed[:]
+        # IE: a new minifier engine version.
+        self.client.processor_chain = 'mediasync.tests.upper:2'
+        self.client.processors = [lambda fd, ct, rp, r: fd.upper()]
+        mediasync.sync(self.client)
+        self.assertEqual(len(pushed), 4)
+
+    def testStateNotSynced(self):
+        import shutil
+        media_root = tempfile.mkdtemp(prefix='mediasynctest')
+        os.makedirs(os.path.join(media_root, 'css'))
+        f = open(os.path.join(media_root, 'css', '1.css'), 'w')
+        f.write('a { }')
+        f.close()
+
+        # The default layout, with everything under MEDIA_ROOT/.mediasync,
+        # and a cache that isn't hidden.
+        state_dir = os.path.join(media_root, '.mediasync')
+        settings = {
+            'STATE_DIR': state_dir,
+            'MANIFEST': os.path.join(state_dir, 'manifest.json'),
+            'CHECKPOINT': os.path.join(state_dir, 'checkpoint.json'),
+            'JOURNAL': os.path.join(state_dir, 'journal.json'),
+            'PROCESSOR_CACHE': os.path.join(state_dir, 'processed'),
+            'COMPRESSION_CACHE': os.path.join(media_root, 'cache', 'compressed'),
+        }
+        old = dict((name, getattr(mediasync, name)) for name in settings)
+        old_caches = (backends.processor_cache, compression.cache)
+        for name, value in settings.items():
+            setattr(mediasync, name, value)
+        backends.processor_cache = DiskCache(settings['PROCESSOR_CACHE'])
+        compression.cache = DiskCache(settings['COMPRESSION_CACHE'])
+
+        upper = lambda filedata, content_type, remote_path, is_remote: filedata.upper()
+        self.client.media_root = media_root
+        self.client.processors = [upper]
+        self.client.processor_chain = 'mediasync.tests.upper:1'
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        try:
+            mediasync.sync(self.client)
+            compression.cache.set('%032d' % 0, 'x')
+            self.assertTrue(os.listdir(settings['PROCESSOR_CACHE']))
+            for force in (False, True):
+                mediasync.sync(self.client, force=force)
+            self.assertEqual(pushed, ['css/1.css', 'css/1.css'])
+            self.assertEqual([item.remote_path for item in mediasync.sync_items(self.client)],
+                             ['css/1.css'])
+        finally:
+            for name, value in old.items():
+                setattr(mediasync, name, value)
+            (backends.processor_cache, compression.cache) = old_caches
+            shutil.rmtree(media_root)
+
+    def testStreamLargeFiles(self):
+        streamed = []
+        self.client.put_callback = lambda *args: None
+        self.client.put_file = lambda f, ct, rp, force: streamed.append((rp, f.read()))
+        old_threshold = mediasync.STREAM_THRESHOLD
+        mediasync.STREAM_THRESHOLD = 0
+        try:
+            mediasync.sync(self.client)
+        finally:
+            mediasync.STREAM_THRESHOLD = old_threshold
+        self.assertEqual(len(streamed), 4)
+        f = open(os.path.join(self.client.media_root, 'css', '1.css'), 'rb')
+        self.assertTrue(('css/1.css', f.read()) in streamed)
+        f.close()
+
+    def testDryRun(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        plan = mediasync.sync(self.client, dry_run=True)
+        self.assertEqual(pushed, [])
+        self.assertFalse(os.path.exists(msettings.MANIFEST))
+        self.assertEqual(len(plan.uploads), 4)
+        self.assertEqual(plan.requests, 4)
+        self.assertEqual(plan.unchanged, 0)
+        self.assertTrue(plan.size > 0)
+        self.assertTrue(plan.estimate() > 0)
+        self.assertEqual(plan.as_dict()['uploads'][0], plan.uploads[0])
+
+        # Once synced, there's nothing left to do.
+        mediasync.sync(self.client)
+        plan = mediasync.sync(self.client, dry_run=True)
+        self.assertEqual(plan.uploads, [])
+        self.assertEqual(plan.unchanged, 4)
+        self.assertEqual(len(pushed), 4)
+
+    def testIncrementalSync(self):
+        if os.path.exists(msettings.JOURNAL):
+            os.remove(msettings.JOURNAL)
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.sync(self.client)
+        self.assertTrue(os.path.exists(msettings.JOURNAL))
+
+        looked_at = []
+        old_stat = mediasync.SyncItem.stat
+        def stat(item):
+            looked_at.append(item.remote_path)
+            return old_stat(item)
+        mediasync.SyncItem.stat = stat
+
+        path = os.path.join(self.client.media_root, 'css', '1.css')
+        f = open(path, 'rb')
+        original = f.read()
+        f.close()
+        try:
+            # Nothing changed, so no file is even looked at.
+            mediasync.sync(self.client, incremental=True)
+            self.assertEqual(looked_at, [])
+
+            f = open(path, 'ab')
+            f.write('\np { color: red; }\n')
+            f.close()
+            del pushed[:]
+            mediasync.sync(self.client, incremental=True)
+            self.assertEqual(looked_at, ['css/1.css'])
+            self.assertEqual(pushed, ['css/1.css'])
+        finally:
+            mediasync.SyncItem.stat = old_stat
+            f = open(path, 'wb')
+            f.write(original)
+            f.close()
+
+    def testSyncPaths(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.sync(self.client)
+
+        path = os.path.join(self.client.media_root, 'js', '2.js')
+        f = open(path, 'rb')
+        original = f.read()
+        f.close()
+        opened = []
+        self.client.open = lambda: opened.append(True)
+        try:
+            f = open(path, 'ab')
+            f.write('\nvar changed = 1;\n')
+            f.close()
+            del pushed[:]
+            mediasync.sync(self.client, paths=['js/2.js', 'css/1.css', 'css/gone.css'],
+                           opened=True)
+            # css/1.css didn't really change.
+            self.assertEqual(pushed, ['js/2.js'])
+            self.assertEqual(opened, [])
+        finally:
+            del self.client.open
+            f = open(path, 'wb')
+            f.write(original)
+            f.close()
+
+    def testJoinedSkipsUnchangedSources(self):
+        from mediasync import bundles
+        old = (mediasync.JOINED, bundles.JOINED, mediasync.CSS_PATH, mediasync.combine_files)
+        joined = {'joined.css': ['1.css', '2.css']}
+        mediasync.JOINED = bundles.JOINED = joined
+        mediasync.CSS_PATH = 'css'
+        bundles._index = None
+
+        combined = []
+        def combine_files(*args):
+            combined.append(args[0])
+            return old[3](*args)
+        mediasync.combine_files = combine_files
+
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        path = os.path.join(self.client.media_root, 'css', '1.css')
+        st = os.stat(path)
+        f = open(path, 'rb')
+        original = f.read()
+        f.close()
+        try:
+            self.assertEqual(bundles.get_index().bundles_for(['css/2.css']), set(['joined.css']))
+            mediasync.sync(self.client)
+            self.assertTrue('css/joined.css' in pushed)
+            self.assertEqual(combined, ['joined.css'])
+
+            # Nothing changed, so the sources aren't even read.
+            del combined[:]
+            mediasync.sync(self.client)
+            self.assertEqual(combined, [])
+
+            # Touching a source only means hashing it again.
+            os.utime(path, (st.st_atime, st.st_mtime + 10))
+            mediasync.sync(self.client)
+            self.assertEqual(combined, [])
+
+            f = open(path, 'ab')
+            f.write('\np { color: red; }\n')
+            f.close()
+            del pushed[:]
+            mediasync.sync(self.client)
+            self.assertEqual(combined, ['joined.css'])
+            self.assertEqual(pushed, ['css/joined.css', 'css/1.css'])
+        finally:
+            f = open(path, 'wb')
+            f.write(original)
+            f.close()
+            os.utime(path, (st.st_atime, st.st_mtime))
+            (mediasync.JOINED, bundles.JOINED, mediasync.CSS_PATH, mediasync.combine_files) = old
+            bundles._index = None
+
+    def testJoinedReordered(self):
+        from mediasync import bundles
+        old = (mediasync.JOINED, bundles.JOINED, mediasync.CSS_PATH)
+        mediasync.CSS_PATH = 'css'
+        if os.path.exists(msettings.JOURNAL):
+            os.remove(msettings.JOURNAL)
+
+        def join(*sourcefiles):
+            mediasync.JOINED = bundles.JOINED = {'joined.css': list(sourcefiles)}
+            bundles._index = None
+
+        pushed = {}
+        self.client.put_callback = lambda *args: pushed.__setitem__(args[2], args[0])
+        # 1.css styles body, 2.css styles p.
+        first = lambda: pushed['css/joined.css'].lstrip().startswith('body')
+        try:
+            join('1.css', '2.css')
+            mediasync.sync(self.client)
+            self.assertTrue(first())
+
+            # The cascade order changes even though no source did.
+            for incremental in (False, True):
+                pushed.clear()
+                join(*reversed(mediasync.JOINED['joined.css']))
+                mediasync.sync(self.client, incremental=incremental)
+                self.assertEqual(pushed.keys(), ['css/joined.css'])
+                self.assertEqual(first(), incremental)
+        finally:
+            (mediasync.JOINED, bundles.JOINED, mediasync.CSS_PATH) = old
+            bundles._index = None
+
+    def testGitChanges(self):
+        import shutil
+        import subprocess
+        from mediasync import journal
+        repo = tempfile.mkdtemp(prefix='mediasynctest')
+        try:
+            def git(*args):
+                subprocess.Popen(('git',) + args, cwd=repo,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+            try:
+                git('init', '-q')
+            except OSError:
+                return # no git here
+            os.makedirs(os.path.join(repo, 'media', 'css'))
+            for name in ('1.css', '2.css'):
+                f = open(os.path.join(repo, 'media', 'css', name), 'w')
+                f.write('body {}')
+                f.close()
+            git('add', '.')
+            git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                'commit', '-q', '-m', 'media')
+
+            f = open(os.path.join(repo, 'media', 'css', '2.css'), 'w')
+            f.write('p {}')
+            f.close()
+            media_root = os.path.join(repo, 'media')
+            self.assertEqual(journal.git_changes(media_root, 'HEAD'), ['css/2.css'])
+            self.assertRaises(mediasync.SyncException, journal.git_changes,
+                              media_root, 'no-such-revision')
+        finally:
+            shutil.rmtree(repo)
+
+    def testFingerprint(self):
+        pushed = []
+        self.client.put_callback = lambda *args: pushed.append(args[2])
+        mediasync.FINGERPRINT = True
+        try:
+            mediasync.sync(self.client)
+            self.assertEqual(len(pushed), 8)
+            self.assertTrue('css/1.css' in pushed)
+
+            fingerprinted = fingerprints.load()
+            self.assertEqual(sorted(fingerprinted.keys()),
+                             ['css/1.css', 'css/2.css', 'js/1.js', 'js/2.js'])
+            self.assertTrue(fingerprinted['css/1.css'] in pushed)
+            self.assertTrue(re.match(r'^css/1\.[0-9a-f]{12}\.css$', fingerprinted['css/1.css']))
+            self.assertEqual(fingerprints.resolve('/css/1.css'), fingerprinted['css/1.css'])
+
+            # Unchanged files still end up in the fingerprint manifest.
+            del pushed[:]
+            fingerprints.reset()
+            mediasync.sync(self.client)
+            self.assertEqual(pushed, [])
+            self.assertEqual(fingerprints.load(), fingerprinted)
+        finally:
+            mediasync.FINGERPRINT = False
+
+    def testProcessWorkers(self):
+        self.client.processors = [lambda fd, ct, rp, r: fd.upper() + rp]
+        self.client.processor_chain = None
+
+        serial = {}
+        self.client.put_callback = lambda *args: serial.__setitem__(args[2], args[0])
+        mediasync.sync(self.client, force=True)
+
+        parallel = {}
+        self.client.put_callback = lambda *args: parallel.__setitem__(args[2], args[0])
+        mediasync.sync(self.client, force=True, workers=3, process_workers=2)
+
+        self.assertEqual(len(serial), 4)
+        self.assertEqual(serial, parallel)
+        self.assertTrue(serial['css/1.css'].endswith('css/1.css'))
+
+class WatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        self.media_root = tempfile.mkdtemp(prefix='mediasynctest')
+        os.makedirs(os.path.join(self.media_root, 'css'))
+        self.cleanup = lambda: shutil.rmtree(self.media_root)
+        self.write('css/1.css', 'body {}')
+
+    def tearDown(self):
+        self.cleanup()
+
+    def write(self, path, data):
+        f = open(os.path.join(self.media_root, path), 'w')
+        f.write(data)
+        f.close()
+
+    def testPolling(self):
+        from mediasync import watch
+        watcher = watch.PollingWatcher(self.media_root, interval=0.01)
+        self.assertEqual(watch.collect(watcher, delay=0.01, timeout=0.05), set())
+
+        self.write('css/1.css', 'body { color: red; }')
+        self.write('css/2.css', 'p {}')
+        os.remove(os.path.join(self.media_root, 'css', '1.css'))
+        self.write('css/.hidden.css', 'p {}')
+        self.assertEqual(watch.collect(watcher, delay=0.01, timeout=0.05),
+                         set(['css/1.css', 'css/2.css']))
+
+    def testInotifyIgnoresState(self):
+        from mediasync import watch
+        old = mediasync.STATE_DIR
+        mediasync.STATE_DIR = os.path.join(self.media_root, '.mediasync')
+        os.makedirs(mediasync.STATE_DIR)
+        try:
+            if watch.PYINOTIFY_INSTALLED:
+                watcher = watch.InotifyWatcher(self.media_root)
+                try:
+                    self.write('.mediasync/manifest.json', '{}')
+                    self.write('css/.hidden.css', 'p {}')
+                    self.assertEqual(watch.collect(watcher, delay=0.01, timeout=0.05), set())
+                    self.write('css/2.css', 'p {}')
+                    self.assertEqual(watch.collect(watcher, delay=0.01, timeout=0.05),
+                                     set(['css/2.css']))
+                finally:
+                    watcher.close()
+            else:
+                # Hand the watcher the events inotify would.
+                media_root = self.media_root
+                class Event(object):
+                    dir = False
+                    def __init__(self, path):
+                        self.pathname = os.path.join(media_root, path)
+                watcher = watch.InotifyWatcher.__new__(watch.InotifyWatcher)
+                watcher.media_root = self.media_root
+                watcher._changed = set()
+                for path in ('.mediasync/manifest.json', '.mediasync/processed/ab/cd',
+                             'css/.hidden.css', 'top.css', 'css/2.css'):
+                    watcher._event(Event(path))
+                self.assertEqual(watcher._changed, set(['css/2.css']))
+        finally:
+            mediasync.STATE_DIR = old
+
+class PoolTestCase(unittest.TestCase):
+
+    def testOrdering(self):
+        import time
+        def func(state, item):
+            time.sleep((10 - item) * 0.001)
+            return item * 2
+        results = list(pool.imap_ordered(func, range(10), workers=4))
+        self.assertEqual([r[1] for r in results], [i * 2 for i in range(10)])
+        self.assertTrue(all(r[2] is None for r in results))
+
+    def testStateIsPerWorker(self):
+        states = []
+        def make_state():
+            state = object()
+            states.append(state)
+            return state
+        list(pool.imap_ordered(lambda state, item: item, range(20), 3, make_state))
+        self.assertTrue(1 <= len(states) <= 3)
+
 class S3BackendTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -49,6 +615,958 @@ class S3BackendTestCase(unittest.TestCase):
         msettings.AWS_BUCKET = None
         self.assertRaises(AssertionError, backends.client)
 
+def gunzip(data):
+    import gzip
+    from cStringIO import StringIO
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+class CompressionTestCase(unittest.TestCase):
+
+    def testCachedVariants(self):
+        data = 'body { color: red; }\n' * 100
+        gz = compression.compress(data, 'gzip')
+        self.assertEqual(gunzip(gz), data)
+        self.assertEqual(compression.variants(data, 'text/css')['gzip'], gz)
+        self.assertEqual(compression.variants(data, 'image/png'), {})
+
+        # The second time around comes straight from the cache.
+        encoders = compression.ENCODERS
+        compression.ENCODERS = [(e, None) for e, c in encoders]
+        try:
+            self.assertEqual(compression.compress(data, 'gzip'), gz)
+        finally:
+            compression.ENCODERS = encoders
+
+    def testBestEncoding(self):
+        self.assertEqual(compression.best_encoding('gzip, deflate', 'text/css'), 'gzip')
+        self.assertEqual(compression.best_encoding('gzip;q=0, deflate', 'text/css'), None)
+        self.assertEqual(compression.best_encoding('*', 'text/css'), compression.ENCODERS[0][0])
+        # Codings named explicitly win over the wildcard, either way round.
+        self.assertEqual(compression.best_encoding('gzip;q=0, br;q=0, *', 'text/css'), None)
+        self.assertEqual(compression.best_encoding('*, gzip;q=0, br;q=0', 'text/css'), None)
+        self.assertEqual(compression.best_encoding('*;q=0, gzip', 'text/css'), 'gzip')
+        self.assertEqual(compression.best_encoding('gzip', 'image/png'), None)
+        self.assertEqual(compression.best_encoding('', 'text/css'), None)
+
+    def testServeCompressed(self):
+        from django.http import HttpRequest
+        from mediasync import views
+        request = HttpRequest()
+        request.META['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        client = backends.client()
+        response = views.static_serve(request, 'css/1.css', client)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        f = open(os.path.join(client.media_root, 'css', '1.css'), 'rb')
+        self.assertEqual(gunzip(response.content), f.read())
+        f.close()
+
+class ProcessorCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        def counting_processor(filedata, content_type, remote_path, is_remote):
+            self.calls.append(remote_path)
+            return filedata.upper()
+        counting_processor.version = '1'
+        self.processor = counting_processor
+        self.client = backends.client()
+        self.client.processors = [counting_processor]
+        self.client.processor_chain = backends.processor_identity(counting_processor)
+        backends.processor_cache.clear()
+
+    def testCacheHit(self):
+        self.assertEqual(self.client.process('a { }', 'text/css', 'x.css'), 'A { }')
+        self.assertEqual(self.client.process('a { }', 'text/css', 'y/z.css'), 'A { }')
+        self.assertEqual(self.calls, ['x.css'])
+
+        # Different content, type or processor version means another run.
+        self.client.process('b { }', 'text/css', 'x.css')
+        self.client.process('a { }', 'text/plain', 'x.txt')
+        self.processor.version = '2'
+        self.client.processor_chain = backends.processor_identity(self.processor)
+        self.client.process('a { }', 'text/css', 'x.css')
+        self.assertEqual(len(self.calls), 4)
+
+    def testLazyEngineVersion(self):
+        from mediasync import processors
+        old = minifiers.CSS_MINIFIER
+        minifiers.CSS_MINIFIER = 'not-an-engine'
+        try:
+            # Making a client doesn't look at the engines; using it does.
+            client = backends.client()
+            client.processors = [processors.css_minifier]
+            self.assertRaises(ImproperlyConfigured, getattr, client, 'processor_chain')
+        finally:
+            minifiers.CSS_MINIFIER = old
+        self.assertEqual(client.processor_chain, 'mediasync.processors.css_minifier:%s'
+                         % minifiers.engine_version('css'))
+
+    def testUncacheable(self):
+        self.assertEqual(backends.processor_identity(lambda *args: None), None)
+        self.processor.cacheable = False
+        self.assertEqual(backends.processor_identity(self.processor), None)
+
+    def testEviction(self):
+        cache = DiskCache(os.path.join(msettings.STATE_DIR, 'evictiontest'), max_size=1000)
+        cache.clear()
+        for i in range(10):
+            cache.set('%032d' % i, 'x' * 200)
+        self.assertTrue(cache.size() <= 1000)
+        self.assertEqual(cache.get('%032d' % 9), 'x' * 200)
+        self.assertEqual(cache.get('%032d' % 0), None)
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+    def testUnwritableCache(self):
+        from django.http import HttpRequest
+        from mediasync import views
+        # A file where the cache directory should be; creating it fails
+        # even for root.
+        blocker = tempfile.NamedTemporaryFile(prefix='mediasynctest')
+        old_cache = backends.processor_cache
+        backends.processor_cache = DiskCache(os.path.join(blocker.name, 'processed'))
+        self.client.serve_remote = True
+        try:
+            response = views.file_serve(HttpRequest(), 'css/1.css', self.client)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(backends.processor_cache.read_only)
+        finally:
+            backends.processor_cache = old_cache
+            blocker.close()
+
+class StaticServeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync import views
+        self.views = views
+        self.client = backends.client()
+        f = open(os.path.join(self.client.media_root, 'js', '1.js'), 'rb')
+        self.content = f.read()
+        f.close()
+
+    def request(self, **meta):
+        from django.http import HttpRequest
+        request = HttpRequest()
+        request.META.update(meta)
+        return self.views.static_serve(request, 'js/1.js', self.client)
+
+    def testConditional(self):
+        response = self.request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.content)
+        etag = response['ETag']
+
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+        self.assertEqual(self.request(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        # A gzipped response's ETag still validates.
+        gzipped = self.request(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotEqual(gzipped['ETag'], etag)
+        self.assertEqual(self.request(HTTP_IF_NONE_MATCH=gzipped['ETag']).status_code, 304)
+
+    def testRange(self):
+        response = self.request(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.content[2:6])
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/%d' % len(self.content))
+
+        response = self.request(HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.content, self.content[-3:])
+
+        response = self.request(HTTP_RANGE='bytes=%d-' % (len(self.content) + 10))
+        self.assertEqual(response.status_code, 416)
+
+        # A stale If-Range gets the whole thing.
+        response = self.request(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def testNoTraversal(self):
+        from django.http import Http404, HttpRequest
+        self.assertRaises(Http404, self.views.static_serve, HttpRequest(),
+                          '../tests.py', self.client)
+
+    def testNotModifiedVaries(self):
+        etag = self.request()['ETag']
+        response = self.request(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def testUnsatisfiableRangeClosesFile(self):
+        opened = []
+        def tracking_open(*args):
+            f = open(*args)
+            opened.append(f)
+            return f
+        old_threshold = self.views.STREAM_THRESHOLD
+        self.views.STREAM_THRESHOLD = 0
+        self.views.open = tracking_open
+        try:
+            response = self.request(HTTP_RANGE='bytes=%d-' % (len(self.content) + 10))
+        finally:
+            del self.views.open
+            self.views.STREAM_THRESHOLD = old_threshold
+        self.assertEqual(response.status_code, 416)
+        self.assertTrue(opened and opened[0].closed)
+
+    def testDependencies(self):
+        import shutil
+        from django.http import HttpRequest
+        from mediasync import processors
+        media_root = tempfile.mkdtemp(prefix='mediasynctest')
+        try:
+            os.makedirs(os.path.join(media_root, 'css'))
+            def write(path, data):
+                f = open(os.path.join(media_root, path), 'wb')
+                f.write(data)
+                f.close()
+            write('css/site.css', 'a { background: url(icon.png); }')
+            write('css/icon.png', 'x')
+            client = backends.client()
+            client.media_root = media_root
+            client.serve_remote = True
+            client.processors = [processors.css_urls]
+            client.processor_chain = None
+
+            first = self.views.file_serve(HttpRequest(), 'css/site.css', client)
+            # A changed image means a changed stylesheet.
+            write('css/icon.png', 'yy')
+            request = HttpRequest()
+            request.META['HTTP_IF_NONE_MATCH'] = first['ETag']
+            second = self.views.file_serve(request, 'css/site.css', client)
+            self.assertEqual(second.status_code, 200)
+            self.assertNotEqual(second['ETag'], first['ETag'])
+            self.assertNotEqual(second.content, first.content)
+        finally:
+            shutil.rmtree(media_root)
+
+    def testFingerprinted(self):
+        from django.http import HttpRequest
+        response = self.views.static_serve(HttpRequest(), 'js/1.0123456789ab.js', self.client)
+        self.assertEqual(response.content, self.content)
+
+class ComboServeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync import views
+        self.views = views
+        self.old_joined = views.JOINED
+        views.JOINED = {'joined.css': ['css/1.css', 'css/2.css']}
+        views._combo_cache.clear()
+
+        self.calls = []
+        def processor(filedata, content_type, remote_path, is_remote):
+            self.calls.append(remote_path)
+            return filedata
+        self.client = backends.client()
+        self.client.processors = [processor]
+        self.client.processor_chain = None
+
+    def tearDown(self):
+        self.views.JOINED = self.old_joined
+
+    def testCached(self):
+        from django.http import HttpRequest
+        first = self.views.combo_serve(HttpRequest(), 'joined.css', self.client)
+        second = self.views.combo_serve(HttpRequest(), 'joined.css', self.client)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(self.calls, ['joined.css'])
+
+        path = os.path.join(self.client.media_root, 'css', '2.css')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        try:
+            self.views.combo_serve(HttpRequest(), 'joined.css', self.client)
+        finally:
+            os.utime(path, (st.st_atime, st.st_mtime))
+        self.assertEqual(len(self.calls), 2)
+
+class TemplateTagTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync.templatetags import media
+        self.media = media
+        self.old = (media.FINGERPRINT, media.SERVE_REMOTE)
+        media.FINGERPRINT = True
+        media.SERVE_REMOTE = True
+        fingerprints._manifest = {'css/1.css': 'css/1.0123456789ab.css'}
+
+    def tearDown(self):
+        self.media.FINGERPRINT, self.media.SERVE_REMOTE = self.old
+        fingerprints.reset()
+
+    def testFingerprintedPath(self):
+        node = self.media.BaseTagNode('')
+        self.assertEqual(node.mkpath('http://cdn/', 'css', '1.css'),
+                         'http://cdn/css/1.0123456789ab.css')
+        self.assertEqual(node.mkpath('http://cdn', '/css/1.css'),
+                         'http://cdn/css/1.0123456789ab.css')
+        # Unknown files are left alone.
+        self.assertEqual(node.mkpath('http://cdn', 'css', '3.css'),
+                         'http://cdn/css/3.css')
+
+    def testRenderCache(self):
+        from django.template import Context, Token, TOKEN_BLOCK
+        self.media.FINGERPRINT = False
+        node = self.media.css_tag(None, Token(TOKEN_BLOCK, 'css "1.css" "print"'))
+        markup = node.render(Context({}))
+        self.assertTrue('href="%s/1.css"' % self.media.base_media_url() in markup)
+        self.assertTrue('media="print"' in markup)
+
+        def mkpath(*args):
+            raise AssertionError('tag was rendered again')
+        node.mkpath = mkpath
+        self.assertEqual(node.render(Context({})), markup)
+
+        # Invalidating makes the node render again.
+        del node.mkpath
+        client = backends.get_client()
+        old_url = client.local_media_url
+        client.local_media_url = 'http://elsewhere'
+        try:
+            self.media.invalidate()
+            self.assertTrue('http://elsewhere/1.css' in node.render(Context({})))
+        finally:
+            client.local_media_url = old_url
+            self.media.invalidate()
+
+        node = self.media.js_tag(None, Token(TOKEN_BLOCK, 'js "1.js"'))
+        self.assertTrue('/1.js"></script>' in node.render(Context({})))
+
+    def testLazyClient(self):
+        backends.reset_client()
+        self.media.invalidate()
+        self.assertEqual(backends._shared_client, None)
+
+        url = self.media.base_media_url()
+        client = backends.get_client()
+        self.assertEqual(url, client.media_url())
+        # Everyone shares the one client.
+        self.assertTrue(backends.get_client() is client)
+
+    def testUrlsDontMakeClient(self):
+        from mediasync import urls
+        backends.reset_client()
+        reload(urls)
+        self.assertEqual(backends._shared_client, None)
+        self.assertEqual(urls.local_media_url, msettings.MEDIA_URL.strip('/'))
+
+class FakeS3Key(object):
+    def __init__(self, name, etag):
+        self.name = name
+        self.etag = '"%s"' % etag
+
+class FakeS3Bucket(object):
+    """
+    Just enough of a boto Bucket to build an inventory from.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.lookups = []
+
+    def list(self, prefix='', delimiter=''):
+        from boto.s3.prefix import Prefix
+        seen = set()
+        for name in sorted(self.keys):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                shard = prefix + rest.split(delimiter)[0] + delimiter
+                if shard not in seen:
+                    seen.add(shard)
+                    p = Prefix()
+                    p.name = shard
+                    yield p
+            else:
+                yield FakeS3Key(name, self.keys[name])
+
+    def get_key(self, name):
+        self.lookups.append(name)
+        return None
+
+class S3InventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync.backends import s3
+        from mediasync.backends.s3 import _checksum
+        self.s3 = s3
+        self.bucket = FakeS3Bucket({
+            'css/1.css': _checksum('body{}')[0],
+            'js/1.js': 'stale',
+            'robots.txt': 'abc',
+        })
+        self.client = s3.Client()
+        self.client._bucket = self.bucket
+        self.client._connect = lambda: self.bucket
+        # The fake bucket has no connection to hand back to the pool.
+        self.client._release = lambda bucket: None
+
+    def testInventory(self):
+        inventory = self.client._build_inventory()
+        self.assertEqual(sorted(inventory.keys()), ['css/1.css', 'js/1.js', 'robots.txt'])
+        self.assertEqual(inventory['robots.txt'], 'abc')
+
+    def testShardedInventory(self):
+        old_shards = self.s3.AWS_INVENTORY_SHARDS
+        self.s3.AWS_INVENTORY_SHARDS = 4
+        try:
+            inventory = self.client._build_inventory()
+        finally:
+            self.s3.AWS_INVENTORY_SHARDS = old_shards
+        self.assertEqual(inventory, self.bucket.keys)
+
+    def testStreamingHelpers(self):
+        from cStringIO import StringIO
+        data = 'body { color: red; }\n' * 5000
+        self.assertEqual(self.s3._checksum_file(StringIO(data)),
+                         self.s3._checksum(data) + (len(data),))
+        self.assertEqual(gunzip(self.s3._compress_file(StringIO(data)).read()), data)
+
+    def testUnchangedSkipsLookup(self):
+        self.client._inventory = self.client._build_inventory()
+        self.assertEqual(self.client.put('body{}', 'text/css', 'css/1.css'), None)
+        self.assertEqual(self.bucket.lookups, [])
+
+    def testPlanPut(self):
+        self.client._inventory = self.client._build_inventory()
+        self.assertEqual(self.client.plan_put('body{}', 'text/css', 'css/1.css'), None)
+        data = 'body { color: red; }\n' * 100
+        transfer_size, requests = self.client.plan_put(data, 'text/css', 'css/2.css')
+        self.assertEqual(requests, 1)
+        self.assertEqual(transfer_size, len(self.s3._compress(data)))
+        self.assertEqual(self.bucket.lookups, [])
+
+class S3ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync.backends import s3
+        self.s3 = s3
+        self.server = FakeS3Server()
+        self.settings = ('AWS_HOST', 'AWS_PORT', 'AWS_SECURE', 'AWS_BUCKET',
+                         'AWS_KEY', 'AWS_SECRET', 'AWS_PREFIX')
+        self.old = [getattr(s3, name) for name in self.settings]
+        s3.AWS_HOST = '127.0.0.1'
+        s3.AWS_PORT = self.server.port
+        s3.AWS_SECURE = False
+        s3.AWS_BUCKET = 'mediasync'
+        s3.AWS_KEY = s3.AWS_SECRET = 'fake'
+        s3.AWS_PREFIX = ''
+        s3.connections.clear()
+
+    def tearDown(self):
+        self.s3.connections.clear()
+        self.server.stop()
+        for name, value in zip(self.settings, self.old):
+            setattr(self.s3, name, value)
+
+    def testPooledSync(self):
+        client = self.s3.Client()
+        mediasync.sync(client, force=True, workers=2)
+        objects = self.server.buckets['mediasync']
+        self.assertEqual(sorted(objects), ['css/1.css', 'css/2.css', 'js/1.js', 'js/2.js'])
+        self.assertEqual(self.server.created, ['mediasync'])
+        # One connection for the client, one for each worker.
+        self.assertEqual(self.server.connections, 3)
+
+        # Connections are reused the second time around, and neither the
+        # bucket nor the inventory are looked up again.
+        del self.server.requests[:]
+        mediasync.sync(client, force=True, workers=2)
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.server.created, ['mediasync'])
+        self.assertEqual(self.server.requests, ['PUT'] * 4)
+
+    def testStats(self):
+        sync_stats = SyncStats()
+        mediasync.sync(self.s3.Client(), force=True, sync_stats=sync_stats)
+        self.assertEqual(sync_stats.counters['requests'], 4)
+        self.assertEqual(sync_stats.counters['bytes_sent'],
+                         sum(len(body) for body, etag, meta in self.server.buckets['mediasync'].values()))
+        self.assertTrue(sync_stats.compression_ratio > 0)
+        for phase in ('compress', 'lookup', 'upload'):
+            self.assertTrue(phase in sync_stats.timings, phase)
+
+    def testListAndDelete(self):
+        for prefix in ('', 'static'):
+            self.s3.AWS_PREFIX = prefix
+            self.server.buckets.get('mediasync', {}).clear()
+            name = lambda path: '/'.join(p for p in (prefix, path) if p)
+            client = self.s3.Client()
+            mediasync.sync(client, force=True)
+            client.open()
+            try:
+                listed = client.list_remote()
+                self.assertEqual(sorted(listed), ['css/1.css', 'css/2.css', 'js/1.js', 'js/2.js'])
+                self.assertTrue(client.put('a { }', 'text/css', 'css/3.css'))
+                client.delete(['css/2.css', 'css/3.css', 'js/1.js'])
+                self.assertEqual(sorted(self.server.buckets['mediasync']),
+                                 [name('css/1.css'), name('js/2.js')])
+                self.assertEqual(sorted(client._inventory), [name('css/1.css'), name('js/2.js')])
+                # Deleted files aren't mistaken for ones that are still there.
+                self.assertTrue(client.put('a { }', 'text/css', 'css/3.css'))
+                self.assertTrue(name('css/3.css') in self.server.buckets['mediasync'])
+            finally:
+                client.close()
+
+    def testConnectFailureReleasesConnection(self):
+        class BrokenConnection(object):
+            def lookup(self, name):
+                raise socket.error('connection reset')
+            def close(self):
+                pass
+        conn = BrokenConnection()
+        self.s3.connections.put(conn)
+        self.assertRaises(socket.error, self.s3.Client()._connect)
+        self.assertTrue(self.s3.connections.get() is conn)
+
+    def testDryRunDoesNotCreateBucket(self):
+        plan = mediasync.sync(self.s3.Client(), force=True, dry_run=True)
+        self.assertEqual(len(plan.uploads), 4)
+        self.assertEqual(self.server.created, [])
+        self.assertEqual(self.server.requests, ['GET'])
+
+class FilesystemBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync.backends import filesystem
+        self.fs = filesystem
+        self.root = tempfile.mkdtemp(prefix='mediasync-fs')
+        self.old = (filesystem.FILESYSTEM_ROOT, filesystem.FILESYSTEM_URL,
+                    filesystem.FILESYSTEM_KEEP_RELEASES)
+        filesystem.FILESYSTEM_ROOT = self.root
+        filesystem.FILESYSTEM_URL = 'http://static.example.com/'
+        filesystem.FILESYSTEM_KEEP_RELEASES = 2
+        self.client = filesystem.Client()
+        for path in (msettings.MANIFEST, msettings.CHECKPOINT):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+        (self.fs.FILESYSTEM_ROOT, self.fs.FILESYSTEM_URL,
+         self.fs.FILESYSTEM_KEEP_RELEASES) = self.old
+
+    def current(self, path=''):
+        return os.path.join(self.root, 'current', path)
+
+    def release(self, data):
+        for remote_path, filedata in data:
+            self.client.put(filedata, 'text/css', remote_path)
+        self.client.commit()
+        return os.path.realpath(self.current())
+
+    def testSync(self):
+        mediasync.sync(self.client, workers=2)
+        self.assertEqual(sorted(os.listdir(self.current('css'))), ['1.css', '2.css'])
+        self.assertEqual(sorted(os.listdir(self.current('js'))), ['1.js', '2.js'])
+        self.assertEqual(self.client.remote_media_url(), 'http://static.example.com')
+        self.assertEqual(self.client.remote_media_url(with_ssl=True), 'https://static.example.com')
+
+        # Nothing changed, so no new release.
+        os.remove(msettings.MANIFEST)
+        mediasync.sync(self.client)
+        self.assertEqual(len(os.listdir(os.path.join(self.root, 'releases'))), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.root, '.stage')))
+
+    def testCompressionCacheNotPublished(self):
+        import shutil
+        media_root = tempfile.mkdtemp(prefix='mediasynctest')
+        os.makedirs(os.path.join(media_root, 'css'))
+        f = open(os.path.join(media_root, 'css', 'big.css'), 'w')
+        f.write('body { color: red; }\n' * 100)
+        f.close()
+        # COMPRESSION_CACHE's default place, under MEDIA_ROOT/.mediasync.
+        old = (mediasync.STATE_DIR, mediasync.COMPRESSION_CACHE, compression.cache)
+        mediasync.STATE_DIR = os.path.join(media_root, '.mediasync')
+        mediasync.COMPRESSION_CACHE = os.path.join(mediasync.STATE_DIR, 'compressed')
+        compression.cache = DiskCache(mediasync.COMPRESSION_CACHE)
+        self.client.media_root = media_root
+        try:
+            for force in (False, True):
+                mediasync.sync(self.client, force=force)
+            self.assertTrue(os.listdir(mediasync.COMPRESSION_CACHE))
+            self.assertEqual(sorted(os.listdir(self.current())), ['css'])
+            self.assertEqual([name for name in os.listdir(self.current('css'))
+                              if not name.startswith('big.css')], [])
+        finally:
+            (mediasync.STATE_DIR, mediasync.COMPRESSION_CACHE, compression.cache) = old
+            shutil.rmtree(media_root)
+
+    def testReleases(self):
+        big = 'body { color: red; }\n' * 100
+        first = self.release([('css/big.css', big), ('css/small.css', 'a{}')])
+        self.assertEqual(gunzip(open(self.current('css/big.css.gz')).read()), big)
+        self.assertFalse(os.path.exists(self.current('css/small.css.gz')))
+        self.assertEqual(os.stat(self.current('css/big.css')).st_mode & 0777, 0644)
+
+        # Unchanged files are hardlinked, changed ones are replaced without
+        # touching the release before.
+        self.assertEqual(self.client.put(big, 'text/css', 'css/big.css'), None)
+        self.assertEqual(self.client.plan_put(big, 'text/css', 'css/big.css'), None)
+        second = self.release([('css/small.css', 'b{}')])
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.stat(os.path.join(first, 'css/big.css')).st_ino,
+                         os.stat(os.path.join(second, 'css/big.css')).st_ino)
+        self.assertEqual(open(os.path.join(first, 'css/small.css')).read(), 'a{}')
+        self.assertEqual(open(self.current('css/small.css')).read(), 'b{}')
+
+        # The same content under another name is linked.
+        self.client.put(big, 'text/css', 'css/big.123abc.css')
+        self.client.put(big + ' ', 'text/css', 'css/big.css')
+        self.client.put(big + ' ', 'text/css', 'css/big.456def.css')
+        third = self.release([])
+        self.assertEqual(os.stat(os.path.join(third, 'css/big.css.gz')).st_ino,
+                         os.stat(os.path.join(third, 'css/big.456def.css.gz')).st_ino)
+        self.assertEqual(open(os.path.join(third, 'css/big.123abc.css')).read(), big)
+
+        # Only the last FILESYSTEM_KEEP_RELEASES are kept.
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'releases'))),
+                         sorted([os.path.basename(second), os.path.basename(third)]))
+
+    def testPutFile(self):
+        from cStringIO import StringIO
+        data = 'body { color: red; }\n' * 100
+        self.client.put_file(StringIO(data), 'text/css', 'css/big.css')
+        self.assertEqual(self.client.put_file(StringIO(data), 'text/css', 'css/big.css'), None)
+        self.assertEqual(self.client.plan_put_file(StringIO(data), 'text/css', 'css/big.css'), None)
+        self.client.commit()
+        self.assertEqual(open(self.current('css/big.css')).read(), data)
+        self.assertEqual(gunzip(open(self.current('css/big.css.gz')).read()), data)
+
+class PruneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        from mediasync import prune
+        from mediasync.backends import filesystem
+        self.prune = prune
+        self.fs = filesystem
+        self.root = tempfile.mkdtemp(prefix='mediasync-prune')
+        self.old = (filesystem.FILESYSTEM_ROOT, prune.PRUNE_STATE)
+        filesystem.FILESYSTEM_ROOT = self.root
+        prune.PRUNE_STATE = os.path.join(self.root, 'orphans.json')
+        self.client = filesystem.Client()
+        for path in (msettings.MANIFEST, msettings.CHECKPOINT):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+        (self.fs.FILESYSTEM_ROOT, self.prune.PRUNE_STATE) = self.old
+
+    def testFindOrphans(self):
+        a, b, c, d = ['css/1.%s.css' % (digit * msettings.FINGERPRINT_LENGTH)
+                      for digit in 'abcd']
+        remote = {'css/1.css': 1, a: 1, b: 2, c: 3, d: 4, 'css/gone.css': 5}
+        local = set(['css/1.css'])
+        self.assertEqual(self.prune.find_orphans(local, remote, set([d]), keep=2), [a, b, 'css/gone.css'])
+        self.assertEqual(self.prune.find_orphans(local, remote, set([a]), keep=2), [b, c, 'css/gone.css'])
+        self.assertEqual(self.prune.find_orphans(local, remote, keep=0), [a, b, c, d, 'css/gone.css'])
+
+    def testGracePeriod(self):
+        mediasync.sync(self.client)
+        self.client.put('a{}', 'text/css', 'css/gone.css')
+        self.client.commit()
+
+        (deleted, waiting) = self.prune.prune(self.client, grace=3600)
+        self.assertEqual((deleted, waiting), ([], ['css/gone.css']))
+        (deleted, waiting) = self.prune.prune(self.client, grace=0, dry_run=True)
+        self.assertEqual((deleted, waiting), (['css/gone.css'], []))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'current', 'css/gone.css')))
+
+        (deleted, waiting) = self.prune.prune(self.client, grace=0)
+        self.assertEqual((deleted, waiting), (['css/gone.css'], []))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'current', 'css/gone.css')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'current', 'css/1.css')))
+
+class CSSUrlsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        from mediasync import assets, processors
+        self.assets = assets
+        self.processors = processors
+        self.media_root = tempfile.mkdtemp(prefix='mediasynctest')
+        self.cleanup = lambda: shutil.rmtree(self.media_root)
+        os.makedirs(os.path.join(self.media_root, 'css'))
+        os.makedirs(os.path.join(self.media_root, 'img'))
+        self.write('img/icon.png', 'x' * 10)
+        self.write('img/big.png', 'x' * 1000)
+        self.write('css/site.css', 'a { background: url(../img/icon.png); }\n'
+                                   'b { background: url("../img/big.png#top"); }\n'
+                                   'i { background: url(\'/img/big.png\'); }\n'
+                                   'p { background: url(data:image/png;base64,AAAA); }\n'
+                                   'q { background: url(../img/missing.png); }\n')
+        self.old = processors.FINGERPRINT
+        for path in (msettings.MANIFEST, msettings.JOURNAL):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        self.cleanup()
+        self.assets._indexes.pop(os.path.abspath(self.media_root), None)
+        self.processors.FINGERPRINT = self.old
+
+    def write(self, path, data):
+        f = open(os.path.join(self.media_root, path), 'wb')
+        f.write(data)
+        f.close()
+
+    def checksum(self, path):
+        return backends.file_checksum(os.path.join(self.media_root, path))
+
+    def testResolve(self):
+        self.assertEqual(self.assets.resolve('../img/a.png?v=1#x', 'css/site.css'),
+                         ('img/a.png', '?v=1#x'))
+        self.assertEqual(self.assets.resolve('b%20c.png', 'css/site.css'), ('css/b c.png', ''))
+        for url in ('/img/a.png', '//cdn/a.png', 'http://cdn/a.png', 'data:image/png,',
+                    '#id', '../../a.png'):
+            self.assertEqual(self.assets.resolve(url, 'css/site.css'), None)
+
+    def testRewrite(self):
+        css = open(os.path.join(self.media_root, 'css/site.css')).read()
+        self.assertEqual(self.assets.references(css, 'css/site.css'),
+                         ['img/big.png', 'img/icon.png', 'img/missing.png'])
+
+        rewritten = self.assets.rewrite(css, 'css/site.css', self.media_root)
+        self.assertTrue('url(../img/icon.png?%s)' % self.checksum('img/icon.png')[:12] in rewritten)
+        self.assertTrue('url("../img/big.png?%s#top")' % self.checksum('img/big.png')[:12] in rewritten)
+
+        rewritten = self.assets.rewrite(css, 'css/site.css', self.media_root,
+                                        fingerprint=True, inline_threshold=100)
+        self.assertTrue('url(data:image/png;base64,eHh4eHh4eHh4eA==)' in rewritten)
+        self.assertTrue('url("../img/big.%s.png#top")' % self.checksum('img/big.png')[:12] in rewritten)
+        # Everything else is left alone.
+        for line in css.splitlines()[2:]:
+            self.assertTrue(line in rewritten, line)
+
+    def testHashedOnce(self):
+        hashed = []
+        old_checksum = backends.file_checksum
+        def file_checksum(path):
+            hashed.append(path)
+            return old_checksum(path)
+        backends.file_checksum = file_checksum
+        try:
+            for name in ('a', 'b', 'c'):
+                self.assets.rewrite('a { background: url(../img/big.png); }', 'css/%s.css' % name,
+                                    self.media_root)
+        finally:
+            backends.file_checksum = old_checksum
+        self.assertEqual(hashed, [os.path.join(self.media_root, 'img/big.png')])
+
+    def testSync(self):
+        client = backends.client()
+        client.media_root = self.media_root
+        client.processors = [self.processors.css_urls]
+        client.processor_chain = None
+        pushed = {}
+        client.put_callback = lambda *args: pushed.__setitem__(args[2], args[0])
+        mediasync.sync(client)
+        self.assertTrue(self.checksum('img/icon.png')[:12] in pushed['css/site.css'])
+
+        # Changing an image the stylesheet refers to is enough to sync the
+        # stylesheet again, incrementally or not.
+        for incremental in (False, True):
+            pushed.clear()
+            self.write('img/icon.png', 'y' * (11 + incremental))
+            mediasync.sync(client, incremental=incremental)
+            self.assertEqual(sorted(pushed), ['css/site.css', 'img/icon.png'])
+            self.assertTrue(self.checksum('img/icon.png')[:12] in pushed['css/site.css'])
+
+        pushed.clear()
+        mediasync.sync(client, incremental=True)
+        self.assertEqual(pushed, {})
+
+class CloudFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import cloudfiles
+        except ImportError:
+            self.cf = None
+            return
+        from mediasync.backends import rackspace_cloudfiles
+        from mediasync.tests.fakeswift import FakeSwiftServer
+        self.cf = rackspace_cloudfiles
+        self.server = FakeSwiftServer()
+        self.settings = ('CLOUDFILES_AUTH_URL', 'CLOUDFILES_USERNAME', 'CLOUDFILES_KEY',
+                         'CLOUDFILES_CONTAINER', 'CLOUDFILES_PREFIX', 'CLOUDFILES_INVENTORY',
+                         'CLOUDFILES_CDN_URL', 'CLOUDFILES_CDN_SSL_URL', 'CLOUDFILES_CDN_STATE')
+        self.old = [getattr(self.cf, name) for name in self.settings]
+        self.cf.CLOUDFILES_AUTH_URL = self.server.auth_url
+        self.cf.CLOUDFILES_USERNAME = self.cf.CLOUDFILES_KEY = 'fake'
+        self.cf.CLOUDFILES_CONTAINER = 'mediasync'
+        self.cf.CLOUDFILES_PREFIX = ''
+        self.cf.CLOUDFILES_INVENTORY = True
+        self.cf.CLOUDFILES_CDN_URL = self.cf.CLOUDFILES_CDN_SSL_URL = None
+        self.cf.CLOUDFILES_CDN_STATE = os.path.join(msettings.STATE_DIR, 'cloudfiles_cdn_test.json')
+        self.cf.cdn_uris.clear()
+        for path in (msettings.MANIFEST, self.cf.CLOUDFILES_CDN_STATE):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def tearDown(self):
+        if self.cf is None:
+            return
+        self.cf.cdn_uris.clear()
+        self.server.stop()
+        for name, value in zip(self.settings, self.old):
+            setattr(self.cf, name, value)
+
+    def testSync(self):
+        if self.cf is None:
+            return
+        client = self.cf.Client()
+        mediasync.sync(client, force=True, workers=2)
+        objects = self.server.containers['mediasync']
+        self.assertEqual(sorted(objects), ['css/1.css', 'css/2.css', 'js/1.js', 'js/2.js'])
+        body, headers = objects['css/1.css']
+        self.assertEqual(headers['Content-Type'], 'text/css')
+        self.assertEqual(headers['Cache-Control'], 'max-age=%d' % (client.expiration_days * 24 * 3600))
+        self.assertTrue('Expires' in headers)
+        # Published to the CDN, and the workers didn't log in again.
+        self.assertEqual(self.server.public, {'mediasync': client.expiration_days * 24 * 3600})
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(client.remote_media_url(), 'http://cdn.example.com/mediasync')
+        self.assertEqual(client.remote_media_url(with_ssl=True), 'https://ssl.cdn.example.com/mediasync')
+
+        # Another process gets the CDN URLs the sync saved, without logging in.
+        self.cf.cdn_uris.clear()
+        self.assertEqual(self.cf.Client().remote_media_url(), 'http://cdn.example.com/mediasync')
+        self.assertEqual(self.server.logins, 1)
+        os.remove(self.cf.CLOUDFILES_CDN_STATE)
+        self.cf.cdn_uris.clear()
+        self.assertEqual(self.cf.Client().remote_media_url(), 'http://cdn.example.com/mediasync')
+        self.assertEqual(self.server.logins, 2)
+
+        # Without the sync manifest, the container listing shows that
+        # nothing changed.
+        os.remove(msettings.MANIFEST)
+        del self.server.requests[:]
+        mediasync.sync(self.cf.Client(), workers=2)
+        self.assertEqual([r for r in self.server.requests if r[0] == 'PUT'], [])
+        self.assertEqual([r for r in self.server.requests if r[0] == 'GET'], [('GET', 'storage', 'mediasync')])
+
+    def testPut(self):
+        if self.cf is None:
+            return
+        self.cf.CLOUDFILES_PREFIX = 'static'
+        client = self.cf.Client()
+        client.open()
+        try:
+            data = 'body { color: red; }\n' * 100
+            self.assertEqual(client.put(data, 'text/css', 'css/big.css'), True)
+            body, headers = self.server.containers['mediasync']['static/css/big.css']
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gunzip(body), data)
+            self.assertEqual(client.put(data, 'text/css', 'css/big.css'), None)
+            self.assertEqual(client.plan_put(data, 'text/css', 'css/big.css'), None)
+            self.assertEqual(client.plan_put(data + ' ', 'text/css', 'css/big.css')[1], 1)
+            self.assertEqual(client.remote_media_url(), 'http://cdn.example.com/mediasync/static')
+
+            # Without an inventory, the object is looked up.
+            client._inventory = None
+            self.assertEqual(client.put(data, 'text/css', 'css/big.css'), None)
+            self.assertEqual(self.server.requests[-1], ('HEAD', 'storage', 'mediasync/static/css/big.css'))
+
+            self.assertEqual(client.list_remote().keys(), ['css/big.css'])
+            client.delete(['css/big.css', 'css/missing.css'])
+            self.assertEqual(self.server.containers['mediasync'], {})
+        finally:
+            client.close()
+
+    def testRetryable(self):
+        if self.cf is None:
+            return
+        from cloudfiles.errors import ResponseError
+        client = self.cf.Client()
+        self.assertTrue(client.is_retryable(ResponseError(503, 'Service Unavailable')))
+        self.assertTrue(client.is_retryable(ResponseError(422, 'Unprocessable Entity')))
+        self.assertFalse(client.is_retryable(ResponseError(403, 'Forbidden')))
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def testRun(self):
+        report = benchmarks.run(repeat=1, dirs=1, depth=1, files=2, size=256, joined=2)
+        self.assertEqual(sorted(report['results']), sorted(name for name, b in benchmarks.BENCHMARKS))
+        self.assertEqual(report['tree']['count'], 12)
+        self.assertEqual(report['results']['listdir_recursive']['items'], 12)
+        self.assertEqual(report['results']['combine_files']['items'], 4)
+        self.assertEqual(report['results']['tags']['items'], 2000)
+        for result in report['results'].values():
+            self.assertTrue(result['seconds'] >= 0)
+        self.assertTrue(report['results']['sync_s3']['requests'] > 0)
+
+        # The real sync state is left alone.
+        self.assertEqual(mediasync.MANIFEST, msettings.MANIFEST)
+        self.assertEqual(mediasync.JOINED, msettings.JOINED)
+
+        report = benchmarks.run(['tags'], repeat=1, files=1, depth=0)
+        self.assertEqual(report['results'].keys(), ['tags'])
+
+# Upper-cases files, following the protocol of the minifier 'command' engine.
+MINIFIER_WORKER = """
+import sys
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    data = sys.stdin.read(int(line))
+    if 'fail' in data:
+        sys.stdout.write('error 4\\nnope')
+    else:
+        sys.stdout.write('ok %d\\n%s' % (len(data), data.upper()))
+    sys.stdout.flush()
+"""
+
+class MinifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.script = tempfile.mkstemp(suffix='.py')
+        os.write(fd, MINIFIER_WORKER)
+        os.close(fd)
+        self.old_commands = minifiers.MINIFIER_COMMANDS
+        minifiers.MINIFIER_COMMANDS = {'js': [sys.executable, self.script]}
+
+    def tearDown(self):
+        minifiers.ENGINES['command'].close()
+        minifiers.MINIFIER_COMMANDS = self.old_commands
+        os.remove(self.script)
+
+    def testSlimmer(self):
+        engine = minifiers.ENGINES['slimmer']
+        if not engine.available('js'):
+            return
+        self.assertEqual(engine.minify('js', "var a = 1;\n\nvar b = 2;"), "var a=1;var b=2;")
+
+    def testCommand(self):
+        engine = minifiers.ENGINES['command']
+        self.assertTrue(engine.available('js'))
+        self.assertFalse(engine.available('css'))
+
+        worker = engine._worker('js')
+        self.assertEqual(engine.minify('js', "var a;"), "VAR A;")
+        self.assertEqual(engine.minify('js', "b();"), "B();")
+        self.assertTrue(engine._worker('js') is worker)
+
+        # An error doesn't cost the worker.
+        self.assertRaises(mediasync.SyncException, engine.minify, 'js', "fail")
+        self.assertTrue(engine._worker('js') is worker)
+
+    def testBenchmark(self):
+        results = minifiers.benchmark([('js', 'a();'), ('js', 'b();'), ('css', 'p {}')],
+                                      ['command'], repeat=2)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['engine'], 'command')
+        self.assertEqual(results[0]['files'], 2)
+        self.assertEqual(results[0]['size'], 8)
+        self.assertEqual(results[0]['minified_size'], 8)
+
 class ProcessorTestCase(unittest.TestCase):
 
     def setUp(self):
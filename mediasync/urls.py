@@ -3,12 +3,12 @@ Mediasync can serve media locally when MEDIASYNC['SERVE_REMOTE'] == False.
 The following urlpatterns are shimmed in, in that case.
 """
 from django.conf.urls.defaults import *
-from mediasync import backends
+from mediasync.msettings import MEDIA_URL
 
-client = backends.client()
-local_media_url = client.local_media_url.strip('/')
+# Taken from the settings rather than the client, so importing the urls
+# doesn't create one; the view makes the shared client on first request.
+local_media_url = MEDIA_URL.strip('/')
 
 urlpatterns = patterns('mediasync.views',
-    url(r'^%s/(?P<path>.*)$' % local_media_url, 'static_serve',
-        {'client': client}),
+    url(r'^%s/(?P<path>.*)$' % local_media_url, 'static_serve'),
 )
@@ -5,11 +5,243 @@ these are shimmed in.
 
 The static_serve() function is where the party starts.
 """
-from django.http import HttpResponse
-from django.views.static import serve
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+import urllib
+from django.core.servers.basehttp import FileWrapper
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
 from django.views.generic.simple import redirect_to
-from mediasync.msettings import CSS_PATH, JS_PATH, JOINED, SERVE_REMOTE, EMULATE_COMBO
-from mediasync import combine_files
+from mediasync.msettings import CSS_PATH, JS_PATH, JOINED, SERVE_REMOTE, EMULATE_COMBO, COMBO_CACHE, STREAM_THRESHOLD
+from mediasync import assets, backends, combine_files, compression, fingerprints, joined_dirname
+
+# Processed combo files, when COMBO_CACHE == 'memory'. Maps the combo file
+# path to a (signature, data, etag) tuple; see _combo_signature().
+_combo_cache = {}
+_combo_cache_lock = threading.Lock()
+
+# ETags of static files, so conditional requests can be answered without
+# reading or processing anything. Maps a file path to a (signature, etag,
+# dependencies) tuple, where signature is the file's (mtime, size), and
+# dependencies are the states of the files the processed content depends on
+# (see _dependency_states()).
+_etag_cache = {}
+
+def _make_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+def _etag_matches(request, etag):
+    """
+    Returns True if the request's If-None-Match header matches etag, or a
+    compressed variant of it.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    base = etag.strip('"')
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate == '*' or candidate == base or candidate.split('-')[0] == base:
+            return True
+    return False
+
+def _dependency_states(client, content, content_type, remote_path):
+    """
+    Returns a dict of path -> [size, mtime, checksum] of the files, besides
+    content, that processing it depends on (IE: images the css_urls
+    processor inlines).
+    """
+    dependencies = client.processor_dependencies(content, content_type, remote_path)
+    return assets.get_index(client.media_root).states_for(dependencies)
+
+def _dependencies_unchanged(client, states):
+    """
+    Returns True if the files recorded by _dependency_states() still have
+    the same content. Costs a stat() per file.
+    """
+    if not states:
+        return True
+    index = assets.get_index(client.media_root)
+    return assets.states_unchanged(index.states_for(states, states), states)
+
+def _last_modified(st, dependencies):
+    """
+    Returns when a file's processed content last changed: the latest mtime
+    of the file and the files processing it depends on.
+    """
+    return max([st.st_mtime] + [state[1] for state in (dependencies or {}).values() if state])
+
+def _not_modified(request, etag, mtime, content_type=None):
+    """
+    Returns an HttpResponseNotModified if the client's copy is current,
+    otherwise None. If-None-Match wins over If-Modified-Since. content_type
+    is that of the response the 304 stands in for, if it would be
+    compressed.
+    """
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        modified = etag is None or not _etag_matches(request, etag)
+    elif mtime is not None:
+        modified = was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), mtime)
+    else:
+        modified = True
+
+    if modified:
+        return None
+    response = HttpResponseNotModified()
+    if etag:
+        response['ETag'] = etag
+    if content_type is not None and compression.is_compressible(content_type):
+        # Same as the response it stands in for.
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+_range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(header, length):
+    """
+    Parses a single byte range from a Range header. Returns None if the
+    header should be ignored (missing, malformed or asking for several
+    ranges), False if the range can't be satisfied, or an inclusive
+    (first, last) tuple.
+    """
+    match = _range_re.match((header or '').strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # The final 'last' bytes.
+        suffix = int(last)
+        if suffix == 0:
+            return False
+        return (max(length - suffix, 0), length - 1)
+    first = int(first)
+    last = min(int(last), length - 1) if last else length - 1
+    if first >= length or first > last:
+        return False
+    return (first, last)
+
+def _finish_response(request, content, content_type, etag, mtime=None, fileobj=None, length=None):
+    """
+    Builds the response for a (possibly processed) file. Adds validators,
+    answers Range requests, and compresses the content for clients that
+    accept it. If fileobj is given, the content is streamed from it instead
+    of being held in memory.
+    """
+    if fileobj is None:
+        length = len(content)
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range or if_range == etag:
+        byte_range = _parse_range(request.META.get('HTTP_RANGE'), length)
+
+    if byte_range is False:
+        if fileobj is not None:
+            fileobj.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % length
+    elif byte_range:
+        first, last = byte_range
+        if fileobj is None:
+            body = content[first:last + 1]
+        else:
+            fileobj.seek(first)
+            body = fileobj.read(last - first + 1)
+            fileobj.close()
+        response = HttpResponse(body, status=206, mimetype=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, length)
+        response['Content-Length'] = str(len(body))
+    elif fileobj is not None:
+        response = HttpResponse(FileWrapper(fileobj), mimetype=content_type)
+        response['Content-Length'] = str(length)
+    else:
+        response = _compress_response(request, HttpResponse(content, mimetype=content_type))
+        if response.has_header('Content-Encoding'):
+            # Different bytes, so a different (but related) strong ETag.
+            etag = '"%s-%s"' % (etag.strip('"'), response['Content-Encoding'])
+
+    if response.status_code != 416:
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    if mtime is not None:
+        response['Last-Modified'] = http_date(mtime)
+    return response
+
+def _compress_response(request, response):
+    """
+    Replaces the content of a response with the best compressed variant the
+    client accepts. Variants are cached by content, so this only costs CPU
+    the first time a given file is served.
+    """
+    content_type = response['Content-Type'].split(';')[0].strip()
+    if response.status_code != 200 or not compression.is_compressible(content_type):
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = compression.best_encoding(request.META.get('HTTP_ACCEPT_ENCODING'), content_type)
+    if encoding:
+        response.content = compression.compress(response.content, encoding)
+        response['Content-Encoding'] = encoding
+    response['Content-Length'] = str(len(response.content))
+    return response
+
+def _combo_signature(sourcefiles, dirname, client):
+    """
+    Returns a value that changes whenever any of the source files of a combo
+    file change, based on their modification times and sizes.
+    """
+    signature = []
+    for sourcefile in sourcefiles:
+        sourcepath = os.path.join(client.media_root, dirname, sourcefile)
+        try:
+            st = os.stat(sourcepath)
+            signature.append((sourcefile, st.st_mtime, st.st_size))
+        except OSError:
+            # combine_files() skips missing files; so do we.
+            signature.append((sourcefile, None, None))
+    return tuple(signature)
+
+def _get_cached_combo(joinfile, signature, client):
+    """
+    Returns a (data, etag) tuple with the cached, processed contents of a
+    combo file, or None if there isn't any or the source files (or the files
+    processing them depends on) changed since it was cached.
+    """
+    if COMBO_CACHE == 'django':
+        from django.core.cache import cache
+        cached = cache.get('mediasync.combo.%s' % hashlib.md5(joinfile).hexdigest())
+    elif COMBO_CACHE:
+        cached = _combo_cache.get(joinfile)
+    else:
+        cached = None
+
+    if cached is not None and cached[0] == signature and \
+            _dependencies_unchanged(client, cached[3]):
+        return cached[1:3]
+    return None
+
+def _set_cached_combo(joinfile, signature, data, etag, dependencies):
+    if COMBO_CACHE == 'django':
+        from django.core.cache import cache
+        cache.set('mediasync.combo.%s' % hashlib.md5(joinfile).hexdigest(),
+                  (signature, data, etag, dependencies))
+    elif COMBO_CACHE:
+        _combo_cache_lock.acquire()
+        try:
+            _combo_cache[joinfile] = (signature, data, etag, dependencies)
+        finally:
+            _combo_cache_lock.release()
 
 def combo_serve(request, path, client):
     """
@@ -18,11 +250,12 @@ def combo_serve(request, path, client):
     the value that we would if we were serving from S3. This is a good way
     to make sure combo files work as intended before rolling out
     to production.
+
+    The result is cached (see COMBO_CACHE) until one of the source files
+    changes, so repeated requests only cost a stat() per source file.
     """
     joinfile = path
     sourcefiles = JOINED[path]
-    # Generate the combo file as a string.
-    combo_data, dirname = combine_files(joinfile, sourcefiles, client)
 
     if path.endswith('.css'):
         mime_type = 'text/css'
@@ -30,14 +263,36 @@ def combo_serve(request, path, client):
         mime_type = 'application/javascript'
     else:
         mime_type = 'application/octet-stream'
-        
-    remote_path = joinfile
-    if dirname:
-        remote_path = "%s/%s" % (dirname, remote_path)
-        
-    combo_data = client.process(combo_data, mime_type, remote_path)
 
-    return HttpResponse(combo_data, mimetype=mime_type)
+    dirname = joined_dirname(joinfile)
+    signature = _combo_signature(sourcefiles, dirname, client)
+    mtimes = [mtime for sourcefile, mtime, size in signature if mtime is not None]
+    mtime = max(mtimes) if mtimes else None
+    cached = _get_cached_combo(joinfile, signature, client)
+
+    if cached is not None:
+        combo_data, etag = cached
+        not_modified = _not_modified(request, etag, mtime, mime_type)
+        if not_modified is not None:
+            return not_modified
+    else:
+        # Generate the combo file as a string.
+        combo_data, dirname = combine_files(joinfile, sourcefiles, client)
+
+        remote_path = joinfile
+        if dirname:
+            remote_path = "%s/%s" % (dirname, remote_path)
+
+        dependencies = _dependency_states(client, combo_data, mime_type, remote_path)
+        combo_data = client.process(combo_data, mime_type, remote_path)
+        etag = _make_etag(combo_data)
+        _set_cached_combo(joinfile, signature, combo_data, etag, dependencies)
+
+        not_modified = _not_modified(request, etag, mtime, mime_type)
+        if not_modified is not None:
+            return not_modified
+
+    return _finish_response(request, combo_data, mime_type, etag, mtime)
 
 def _form_key_str(path):
     """
@@ -91,12 +346,16 @@ def _find_combo_match(path):
         # Combo match found, return the JOINED key.
         return key_str
 
-def static_serve(request, path, client):
+def static_serve(request, path, client=None):
     """
     Given a request for a media asset, this view does the necessary wrangling
     to get the correct thing delivered to the user. This can also emulate the
     combo behavior seen when SERVE_REMOTE == False and EMULATE_COMBO == True.
+    Uses the shared backend client unless one is given.
     """
+    if client is None:
+        client = backends.get_client()
+
     if SERVE_REMOTE:
         # We're serving from S3, redirect there.
         url = client.remote_media_url().strip('/') + '/%(path)s'
@@ -111,8 +370,94 @@ def static_serve(request, path, client):
             # We found a combo file match. Combine it and serve the result.
             return combo_serve(request, combo_match, client)
 
-    # No combo file, but we're serving locally. Use the standard (inefficient)
-    # Django static serve view.
-    resp = serve(request, path, document_root=client.media_root)
-    resp.content = client.process(resp.content, resp['Content-Type'], path)
-    return resp
+    # No combo file, but we're serving locally.
+    return file_serve(request, path, client)
+
+def _safe_path(path):
+    """
+    Normalizes a requested path the same way django.views.static.serve()
+    does, so it can't escape the media root.
+    """
+    path = posixpath.normpath(urllib.unquote(path))
+    path = path.lstrip('/')
+    newpath = ''
+    for part in path.split('/'):
+        if not part:
+            # Strip empty path components.
+            continue
+        drive, part = os.path.splitdrive(part)
+        head, part = os.path.split(part)
+        if part in (os.curdir, os.pardir):
+            # Strip '.' and '..' in path.
+            continue
+        newpath = os.path.join(newpath, part).replace('\\', '/')
+    return newpath
+
+def file_serve(request, path, client):
+    """
+    Serves a single file from the media root, run through the processors.
+
+    Responses carry a strong ETag based on the processed content and a
+    Last-Modified header. Conditional requests are answered with a 304 from
+    a stat() and a dict lookup, without reading or processing the file.
+    Single byte ranges are supported. Files larger than STREAM_THRESHOLD
+    are sent unprocessed straight from disk, as sync() does.
+    """
+    newpath = _safe_path(path)
+    fullpath = os.path.join(client.media_root, newpath)
+    logical = fingerprints.logical_path(newpath)
+    if logical is not None and not os.path.exists(fullpath):
+        # Fingerprinted names (IE: from the css_urls processor) are served
+        # with the file they were made from.
+        newpath = logical
+        fullpath = os.path.join(client.media_root, newpath)
+    if os.path.isdir(fullpath):
+        raise Http404("Directory indexes are not allowed here.")
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        raise Http404('"%s" does not exist' % fullpath)
+
+    content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+    signature = (st.st_mtime, st.st_size)
+    streamed = st.st_size > STREAM_THRESHOLD
+    # Streamed files are never compressed, so their responses don't vary.
+    vary_type = None if streamed else content_type
+
+    cached = _etag_cache.get(fullpath)
+    if cached is not None and cached[0] == signature and \
+            _dependencies_unchanged(client, cached[2]):
+        not_modified = _not_modified(request, cached[1], _last_modified(st, cached[2]),
+                                     vary_type)
+        if not_modified is not None:
+            return not_modified
+    else:
+        cached = None
+
+    if streamed:
+        if cached is not None:
+            etag = cached[1]
+        else:
+            etag = '"%s"' % backends.file_checksum(fullpath)
+            _etag_cache[fullpath] = (signature, etag, None)
+            not_modified = _not_modified(request, etag, st.st_mtime)
+            if not_modified is not None:
+                return not_modified
+        return _finish_response(request, None, content_type, etag, st.st_mtime,
+                                fileobj=open(fullpath, 'rb'), length=st.st_size)
+
+    f = open(fullpath, 'rb')
+    try:
+        content = f.read()
+    finally:
+        f.close()
+    dependencies = _dependency_states(client, content, content_type, newpath)
+    content = client.process(content, content_type, newpath)
+    etag = _make_etag(content)
+    _etag_cache[fullpath] = (signature, etag, dependencies)
+
+    mtime = _last_modified(st, dependencies)
+    not_modified = _not_modified(request, etag, mtime, vary_type)
+    if not_modified is not None:
+        return not_modified
+    return _finish_response(request, content, content_type, etag, mtime)
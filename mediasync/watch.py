@@ -0,0 +1,156 @@
+"""
+Keeps remote storage in sync with the media root as files change, for
+preview environments. Changes are picked up with inotify if pyinotify is
+installed, or by polling the tree otherwise. Bursts of changes (IE: a
+checkout or a build writing many files) are collected into a single sync.
+"""
+import os
+import time
+from mediasync.msettings import WATCH_INTERVAL, WATCH_DELAY
+from mediasync import backends, journal, is_state_path, is_syncable_path, static_files, sync
+
+try:
+    import pyinotify
+    PYINOTIFY_INSTALLED = True
+except ImportError:
+    PYINOTIFY_INSTALLED = False
+
+class PollingWatcher(object):
+    """
+    Finds changes by comparing snapshots of the tree every WATCH_INTERVAL
+    seconds.
+    """
+    def __init__(self, media_root, interval=None):
+        self.media_root = media_root
+        self.interval = interval or WATCH_INTERVAL
+        self.snapshot = journal.scan(static_files(media_root))
+
+    def changes(self, timeout):
+        """
+        Returns the set of paths, relative to the media root, that were
+        added, changed or removed, waiting up to timeout seconds for
+        something to happen.
+        """
+        deadline = time.time() + timeout
+        while True:
+            snapshot = journal.scan(static_files(self.media_root))
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """
+    Finds changes with inotify, so nothing is done until a file is written,
+    moved or deleted.
+    """
+    def __init__(self, media_root):
+        self.media_root = os.path.abspath(media_root)
+        self._changed = set()
+
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE |
+                pyinotify.IN_CREATE)
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._manager, self._event, timeout=0)
+        self._manager.add_watch(self.media_root, mask, rec=True, auto_add=True)
+
+    def _event(self, event):
+        if event.dir:
+            # auto_add takes care of new directories; their files show
+            # up as events of their own.
+            return
+        pathname = os.path.abspath(event.pathname)
+        if is_state_path(pathname):
+            # sync() writing its state and caches mustn't set off another
+            # sync.
+            return
+        path = os.path.relpath(pathname, self.media_root).replace(os.sep, '/')
+        # The same files static_files() would find.
+        if is_syncable_path(path):
+            self._changed.add(path)
+
+    def changes(self, timeout):
+        # Notifier.check_events() takes milliseconds.
+        if self._notifier.check_events(int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        changed = self._changed
+        self._changed = set()
+        return changed
+
+    def close(self):
+        self._notifier.stop()
+
+def get_watcher(media_root, interval=None):
+    """
+    Returns the best watcher available for the media root.
+    """
+    if PYINOTIFY_INSTALLED and not interval:
+        return InotifyWatcher(media_root)
+    return PollingWatcher(media_root, interval)
+
+def collect(watcher, delay=None, timeout=None):
+    """
+    Waits for changes and returns the paths that changed. Once something
+    changes, it keeps collecting until nothing has changed for delay
+    seconds, so that a burst of writes ends up in a single sync.
+    """
+    if delay is None:
+        delay = WATCH_DELAY
+    changed = watcher.changes(timeout or WATCH_INTERVAL)
+    if not changed:
+        return changed
+    while True:
+        more = watcher.changes(delay)
+        if not more:
+            return changed
+        changed |= more
+
+def watch(client=None, interval=None, delay=None, **sync_options):
+    """
+    Brings remote storage up to date, then syncs files as they change until
+    interrupted. The client is opened once and kept open throughout.
+
+    args:
+      client: (BaseClient) The backend client to sync with. Defaults to the
+                           client for the configured BACKEND.
+      interval: (float) Poll the tree every interval seconds instead of using
+                        inotify.
+      delay: (float) Seconds to wait for a burst of changes to settle.
+                     Defaults to MEDIASYNC['WATCH_DELAY'].
+      sync_options: Passed on to sync() (IE: workers).
+    """
+    if client is None:
+        client = backends.client()
+
+    client.serve_remote = True
+    client.open()
+    try:
+        # Watch first, so that nothing changed during the first sync is missed.
+        watcher = get_watcher(client.media_root, interval)
+        try:
+            sync(client, incremental=True, opened=True, **sync_options)
+            pending = set()
+            while True:
+                pending |= collect(watcher, delay)
+                if not pending:
+                    continue
+                try:
+                    sync(client, paths=sorted(pending), opened=True,
+                         **sync_options)
+                except Exception, e:
+                    # Keep going; the files are tried again with the next batch.
+                    print "Sync failed, will retry: %s" % e
+                else:
+                    pending = set()
+        finally:
+            watcher.close()
+    finally:
+        client.close()